@@ -1,14 +1,37 @@
+import time
+# How long this module's imports took, for the startup breakdown in debug mode
+import_start = time.perf_counter()
 import requests
 from requests import HTTPError
+from requests.adapters import HTTPAdapter
 import json
 import d20
+import numpy
 import argparse
 import datetime
-from azure.identity import DefaultAzureCredential
-from azure.keyvault.secrets import SecretClient
+import email.utils
+import copy
+from concurrent.futures import ThreadPoolExecutor, Future
+import random
+import hashlib
+import threading
+import re
+import math
+import difflib
+import glob
+import os
+from urllib.parse import urlparse
+import atexit
+import contextvars
+import tracing
+import_seconds = time.perf_counter() - import_start
 
 
 def get_api_key(key_vault_name, secret_name):
+    # The Azure SDK is slow to import and only needed when the key comes from Key Vault
+    from azure.identity import DefaultAzureCredential
+    from azure.keyvault.secrets import SecretClient
+
     # Set the key vault name and secret name
     key_vault_name = "aoaikeys"
     secret_name = "AOAIKey"
@@ -28,13 +51,77 @@ DEFAULT_ENDPOINT = "https://dasommer-oai-cmk.openai.azure.com/openai/deployments
 DEFAULT_KEY_VAULT = "aoaikeys"
 DEFAULT_SN = "AOAIKey"
 DEFAULT_SN = "AOAIKeySCUS"
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10.0
+DEFAULT_READ_TIMEOUT = 300.0
+DEFAULT_CONTEXT_BUDGET = 8000
+DEFAULT_CONTEXT_RECENT_TURNS = 10
+DEFAULT_CONTEXT_RECALL_TURNS = 3
+DEFAULT_STATE_RESYNC_TURNS = 10
+DEFAULT_PARSE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.lldm', 'parse_cache')
+DEFAULT_PARSE_CACHE_MB = 50
+DEFAULT_RATE_LIMIT_RPM = 0
+DEFAULT_RATE_LIMIT_TPM = 0
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_JOURNAL_SNAPSHOT_RECORDS = 100
+DEFAULT_KEY_CACHE_FILE = os.path.join(os.path.expanduser('~'), '.lldm', 'api_keys.json')
+DEFAULT_KEY_CACHE_HOURS = 8
 
 api_key = ''
 endpoint = ''
-player = {}
-player_text = ''
+stream_mode = False
 debug_mode = False
 
+# API keys fetched from Key Vault are cached on disk for key_cache_hours, so that starting a game does not
+# have to probe the Azure credential chain and call Key Vault every time.  The cache file is only readable by
+# its owner, and is ignored if its permissions have been loosened.
+key_cache_file = DEFAULT_KEY_CACHE_FILE
+key_cache_hours = DEFAULT_KEY_CACHE_HOURS
+
+
+def read_key_cache() -> dict:
+    try:
+        with open(key_cache_file, 'r') as f:
+            info = os.fstat(f.fileno())
+            if os.name == 'posix' and (info.st_mode & 0o077 or info.st_uid != os.getuid()):
+                print(f'Ignoring {key_cache_file}: it must be private to its owner')
+                return {}
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_key_cache(cache: dict):
+    os.makedirs(os.path.dirname(key_cache_file), mode=0o700, exist_ok=True)
+    temp_file = f'{key_cache_file}.{os.getpid()}.tmp'
+    with os.fdopen(os.open(temp_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f:
+        json.dump(cache, f)
+    os.replace(temp_file, key_cache_file)
+
+
+# Get the API key from Key Vault, or from the key cache while the cached copy is fresh
+def key_vault_api_key(key_vault_name: str, secret_name: str) -> str:
+    if not key_cache_hours:
+        return get_api_key(key_vault_name, secret_name).value
+    name = f'{key_vault_name}/{secret_name}'
+    cache = read_key_cache()
+    now = time.time()
+    # Drop expired keys
+    cache = {key: entry for key, entry in cache.items() if entry['expires'] > now}
+    if name in cache:
+        return cache[name]['value']
+    value = get_api_key(key_vault_name, secret_name).value
+    cache[name] = {
+        'value': value,
+        'expires': now + key_cache_hours * 3600
+    }
+    try:
+        write_key_cache(cache)
+    except OSError as e:
+        print(f'Could not cache the API key: {e}')
+    return value
+
+
 ability_schema = {
     "type": "object",
     "properties": {
@@ -260,6 +347,160 @@ game_state_schema = {
     "additionalProperties": False
 }
 
+# State delta schema.  Rather than regenerating the whole game state after every turn, the LLM reports only
+# what changed and the change is applied locally by apply_state_change.  Fields that did not change are null or empty.
+monster_update_schema = {
+    "type": "object",
+    "properties": {
+        "identifier": {
+            "type": "string"
+        },
+        "health": {
+            "type": ["integer", "null"]
+        },
+        "status": {
+            "type": ["string", "null"]
+        }
+    },
+    "required": ["identifier", "health", "status"],
+    "additionalProperties": False
+}
+
+npc_update_schema = {
+    "type": "object",
+    "properties": {
+        "Name": {
+            "type": "string"
+        },
+        "HP": {
+            "type": ["integer", "null"]
+        },
+        "Status": {
+            "type": ["string", "null"]
+        },
+        "gold_change": {
+            "type": "integer"
+        },
+        "add_inventory": {
+            "type": "array",
+            "items": {
+                "type": "string"
+            }
+        },
+        "remove_inventory": {
+            "type": "array",
+            "items": {
+                "type": "string"
+            }
+        }
+    },
+    "required": ["Name", "HP", "Status", "gold_change", "add_inventory", "remove_inventory"],
+    "additionalProperties": False
+}
+
+state_delta_schema = {
+    "type": "object",
+    "properties": {
+        "gold_change": {
+            "type": "integer"
+        },
+        "hp_change": {
+            "type": "integer"
+        },
+        "xp_change": {
+            "type": "integer"
+        },
+        "player_status": {
+            "type": ["string", "null"]
+        },
+        "add_inventory": {
+            "type": "array",
+            "items": {
+                "type": "string"
+            }
+        },
+        "remove_inventory": {
+            "type": "array",
+            "items": {
+                "type": "string"
+            }
+        },
+        "spell_slots_used": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "level": {
+                        "type": "integer"
+                    },
+                    "count": {
+                        "type": "integer"
+                    }
+                },
+                "required": ["level", "count"],
+                "additionalProperties": False
+            }
+        },
+        "spell_effects": {
+            "anyOf": [spell_effects_schema, {"type": "null"}]
+        },
+        "location": {
+            "type": ["string", "null"]
+        },
+        "danger": {
+            "type": ["string", "null"],
+            "enum": ["safe", "low", "medium", "high", "very high", None]
+        },
+        "time_of_day": {
+            "type": ["string", "null"]
+        },
+        "sunrise": {
+            "type": ["string", "null"]
+        },
+        "sunset": {
+            "type": ["string", "null"]
+        },
+        "date": {
+            "type": ["string", "null"]
+        },
+        "dark": {
+            "type": ["boolean", "null"]
+        },
+        "add_monsters": {
+            "type": "array",
+            "items": monster_schema
+        },
+        "remove_monsters": {
+            "type": "array",
+            "items": {
+                "type": "string"
+            }
+        },
+        "update_monsters": {
+            "type": "array",
+            "items": monster_update_schema
+        },
+        "add_NPCs": {
+            "type": "array",
+            "items": character_schema
+        },
+        "remove_NPCs": {
+            "type": "array",
+            "items": {
+                "type": "string"
+            }
+        },
+        "update_NPCs": {
+            "type": "array",
+            "items": npc_update_schema
+        }
+    },
+    "required": ["gold_change", "hp_change", "xp_change", "player_status", "add_inventory", "remove_inventory", "spell_slots_used",
+                 "spell_effects", "location", "danger", "time_of_day", "sunrise", "sunset", "date", "dark",
+                 "add_monsters", "remove_monsters", "update_monsters", "add_NPCs", "remove_NPCs", "update_NPCs"],
+    "additionalProperties": False
+}
+
 action_schema = {
     "type": "object",
     "properties": {
@@ -304,6 +545,17 @@ round_schema = {
     "additionalProperties": False
 }
 
+summary_schema = {
+    "type": "object",
+    "properties": {
+        "summary": {
+            "type": "string"
+        }
+    },
+    "required": ["summary"],
+    "additionalProperties": False
+}
+
 response_schema = {
     "type": "object",
     "properties": {
@@ -318,13 +570,625 @@ response_schema = {
     "additionalProperties": False
 }
 
-def make_structured_request(system_prompt: str, user_prompt: str, second_system_prompt: str, schema: dict, max_tokens: int, conversation_context: list = [], temperature: float=0.7, top_p: float=0.95) -> dict:
-    headers = {
-        "Content-Type": "application/json",
-        "api-key": api_key,
-        "Authorization": f"Bearer {api_key}"
+# Narration and state change together, for the merged state update mode.  player_response comes first so it
+# can be streamed to the player while the rest is generated.
+merged_response_schema = {
+    "type": "object",
+    "properties": {
+        "player_response": {
+            "type": "string"
+        },
+        "DM_response": {
+            "type": "string"
+        },
+        "state_change": state_delta_schema
+    },
+    "required": ["player_response", "DM_response", "state_change"],
+    "additionalProperties": False
+}
+
+# Shared HTTP session for all LLM calls.  Keeping one pooled, keep-alive session means we only pay the
+# TCP+TLS handshake once per connection instead of on every request.
+http_session = None
+http_timeout = (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+
+# Connection reuse statistics, accumulated across all LLM calls
+connection_stats = {
+    'calls': 0,
+    'new_connections': 0,
+    'reused_connections': 0,
+    'total_seconds': 0.0
+}
+
+def configure_http_session(pool_size: int = DEFAULT_POOL_SIZE, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT, read_timeout: float = DEFAULT_READ_TIMEOUT):
+    global http_session
+    global http_timeout
+
+    if http_session:
+        http_session.close()
+    http_session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    http_session.mount('https://', adapter)
+    http_session.mount('http://', adapter)
+    http_timeout = (connect_timeout, read_timeout)
+
+
+# Count the connections opened so far to the host serving this URL.  If the count does not change across
+# a request, the request was sent over a reused keep-alive connection.
+def count_connections(url: str) -> int:
+    host = urlparse(url).hostname
+    pools = http_session.get_adapter(url).poolmanager.pools
+    return sum(pools[key].num_connections for key in pools.keys() if key.key_host == host)
+
+
+# Client-side rate limiting, shared by every LLM call in the process: all sessions, threads and tasks.  Two token
+# buckets mirror the endpoint's quotas, requests per minute and tokens per minute.  Each request reserves one
+# request and its estimated tokens (prompt plus max_tokens, the way the service counts them) and waits until both
+# buckets cover it.  Reservations can drive a bucket negative, which queues later callers behind earlier ones.
+# The token estimate is corrected with the actual usage once the response arrives, and given back when the
+# attempt fails.  A 429 response pauses every
+# caller for as long as the endpoint asks in its Retry-After header.
+rate_limits = {
+    'requests_per_minute': 0,
+    'tokens_per_minute': 0,
+    'requests': 0.0,
+    'tokens': 0.0,
+    'updated': time.monotonic(),
+    'paused_until': 0.0
+}
+rate_limit_lock = threading.Lock()
+
+# Failed requests are retried on these statuses and on connection errors, up to max_retries times
+RETRY_STATUS_CODES = (408, 429, 500, 502, 503, 504)
+BACKOFF_SECONDS = 1.0
+MAX_BACKOFF_SECONDS = 60.0
+max_retries = DEFAULT_MAX_RETRIES
+
+# Jitter has its own generator so that retries do not disturb seeded dice rolls
+backoff_random = random.Random()
+
+rate_limit_stats = {
+    'queued_calls': 0,
+    'queue_seconds': 0.0,
+    'throttled': 0,
+    'retries': 0,
+    'failovers': 0
+}
+
+
+# Set the quotas; 0 means no limit
+def configure_rate_limiter(requests_per_minute: int = DEFAULT_RATE_LIMIT_RPM, tokens_per_minute: int = DEFAULT_RATE_LIMIT_TPM):
+    with rate_limit_lock:
+        rate_limits['requests_per_minute'] = requests_per_minute
+        rate_limits['tokens_per_minute'] = tokens_per_minute
+        rate_limits['requests'] = float(requests_per_minute)
+        rate_limits['tokens'] = float(tokens_per_minute)
+        rate_limits['updated'] = time.monotonic()
+
+
+# Tokens the endpoint will count against its quota for a request
+def estimate_request_tokens(payload: dict, body: str) -> int:
+    return estimate_tokens(body) + payload.get('max_tokens', 0)
+
+
+# Refill both buckets for the time since they were last updated.  Called with rate_limit_lock held.
+def refill_rate_limits(now: float):
+    elapsed = now - rate_limits['updated']
+    rate_limits['updated'] = now
+    for bucket, limit in [('requests', 'requests_per_minute'), ('tokens', 'tokens_per_minute')]:
+        rate_limits[bucket] = min(rate_limits[limit], rate_limits[bucket] + elapsed * rate_limits[limit] / 60)
+
+
+# Reserve capacity for one request and return the seconds the caller must wait before sending it
+def reserve_capacity(tokens: int) -> float:
+    with rate_limit_lock:
+        now = time.monotonic()
+        refill_rate_limits(now)
+        wait = max(0.0, rate_limits['paused_until'] - now)
+        for bucket, limit, amount in [('requests', 'requests_per_minute', 1), ('tokens', 'tokens_per_minute', tokens)]:
+            if rate_limits[limit] <= 0:
+                continue
+            # A request bigger than the whole bucket waits for a full bucket rather than forever
+            rate_limits[bucket] -= min(amount, rate_limits[limit])
+            if rate_limits[bucket] < 0:
+                wait = max(wait, -rate_limits[bucket] * 60 / rate_limits[limit])
+        if wait > 0:
+            rate_limit_stats['queued_calls'] += 1
+            rate_limit_stats['queue_seconds'] += wait
+        return wait
+
+
+# Correct a reservation with the tokens the request actually used
+def settle_capacity(reserved_tokens: int, usage: dict):
+    if not usage or rate_limits['tokens_per_minute'] <= 0:
+        return
+    with rate_limit_lock:
+        refill_rate_limits(time.monotonic())
+        reserved_tokens = min(reserved_tokens, rate_limits['tokens_per_minute'])
+        rate_limits['tokens'] = min(rate_limits['tokens_per_minute'], rate_limits['tokens'] + reserved_tokens - usage.get('total_tokens', reserved_tokens))
+
+
+# Give back the tokens reserved for an attempt the endpoint did not process: it failed to connect, timed out or
+# was answered with an error
+def refund_capacity(reserved_tokens: int):
+    settle_capacity(reserved_tokens, {'total_tokens': 0})
+
+
+# Hold back every caller after the endpoint throttled us
+def pause_rate_limiter(seconds: float):
+    with rate_limit_lock:
+        rate_limits['paused_until'] = max(rate_limits['paused_until'], time.monotonic() + seconds)
+        rate_limit_stats['throttled'] += 1
+
+
+# Seconds the endpoint asked us to wait, from the retry-after-ms or Retry-After header (seconds or an HTTP date)
+def parse_retry_after(headers) -> float:
+    try:
+        if headers.get('retry-after-ms'):
+            return max(0.0, float(headers['retry-after-ms']) / 1000)
+        value = headers.get('Retry-After')
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            retry_at = email.utils.parsedate_to_datetime(value)
+            return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+# Seconds to wait before retry number attempt + 1: what the endpoint asked for, or else exponential backoff with
+# full jitter so that callers that failed together do not all retry together
+def retry_delay(attempt: int, headers) -> float:
+    retry_after = parse_retry_after(headers)
+    if retry_after is not None:
+        return retry_after
+    return backoff_random.uniform(0, min(MAX_BACKOFF_SECONDS, BACKOFF_SECONDS * 2 ** attempt))
+
+
+# Routing.  By default every call goes to --endpoint with the model and sampling settings of the request.
+# A routing table (--routes) can send each type of call somewhere else: a JSON object keyed by call type, or
+# 'default' for every call type without its own entry, e.g.
+#   {"default": {"endpoints": ["https://big.example.com/..."]},
+#    "action": {"endpoints": ["https://small.example.com/...", {"url": "https://other.example.com/...", "api_key": "..."}],
+#               "model": "gpt-4o-mini", "max_tokens": 2000, "temperature": 0.2}}
+# Each endpoint is a URL, or an object with its own API key.  Endpoints after the first are fallbacks: a call
+# that is throttled or fails on one endpoint is retried on the next while the first recovers.
+ROUTE_CALL_TYPES = ('default', 'player_parse', 'scenario_parse', 'action', 'narration', 'narration_state',
+                    'state_delta', 'state_update', 'summary', 'self_play')
+ROUTE_SETTINGS = ('endpoints', 'model', 'max_tokens', 'temperature')
+routes = {}
+
+# When each endpoint that failed can be tried again, by URL
+endpoint_unavailable_until = {}
+
+
+def load_routes(filename: str) -> dict:
+    with open(filename, 'r') as f:
+        table = json.load(f)
+    for call_type, route in table.items():
+        if call_type not in ROUTE_CALL_TYPES:
+            raise ValueError(f"Unknown call type {call_type} in {filename}.  Call types are: {', '.join(ROUTE_CALL_TYPES)}")
+        for setting in route:
+            if setting not in ROUTE_SETTINGS:
+                raise ValueError(f"Unknown setting {setting} for {call_type} in {filename}.  Settings are: {', '.join(ROUTE_SETTINGS)}")
+        if 'endpoints' in route:
+            route['endpoints'] = [entry if isinstance(entry, dict) else {'url': entry} for entry in route['endpoints']]
+    return table
+
+
+def call_route(call_type: str) -> dict:
+    route = dict(routes.get('default', {}))
+    route.update(routes.get(call_type, {}))
+    return route
+
+
+# Apply the route's model and sampling settings to a request payload
+def route_payload(payload: dict, call_type: str):
+    route = call_route(call_type)
+    for setting in ['model', 'max_tokens', 'temperature']:
+        if setting in route:
+            payload[setting] = route[setting]
+
+
+def endpoint_available(entry: dict) -> bool:
+    return endpoint_unavailable_until.get(entry['url'], 0.0) <= time.monotonic()
+
+
+def mark_endpoint_unavailable(entry: dict, seconds: float):
+    endpoint_unavailable_until[entry['url']] = time.monotonic() + seconds
+
+
+# The endpoints routed for a call type, the primary one first
+def route_endpoints(call_type: str) -> list:
+    return call_route(call_type).get('endpoints') or [{'url': endpoint}]
+
+
+# The endpoints to send a call to, in the order to try them: those that are available first, then those that
+# will recover soonest
+def call_endpoints(call_type: str) -> list:
+    entries = route_endpoints(call_type)
+    return sorted(entries, key=lambda entry: 0.0 if endpoint_available(entry) else endpoint_unavailable_until[entry['url']])
+
+
+# Request headers with the endpoint's own API key, if it has one
+def endpoint_headers(headers: dict, entry: dict) -> dict:
+    if 'api_key' not in entry:
+        return headers
+    return dict(headers, **{'api-key': entry['api_key'], 'Authorization': f"Bearer {entry['api_key']}"})
+
+
+# The endpoints to make the next attempt of a call on, the first of them being the one to use
+def attempt_endpoints(call_type: str) -> list:
+    endpoints = call_endpoints(call_type)
+    tracing.set_attributes(endpoint=urlparse(endpoints[0]['url']).hostname)
+    return endpoints
+
+
+# Bookkeeping after an attempt failed and will be retried.  If another endpoint is available the call fails over
+# to it straight away while the failed one recovers; otherwise the call waits out the retry delay, and throttling
+# holds back every caller through the rate limiter.  Returns the seconds to wait before the next attempt.
+def failed_attempt(attempt: int, endpoints: list, delay: float, reason: str, throttled: bool) -> float:
+    rate_limit_stats['retries'] += 1
+    tracing.set_attributes(retries=attempt)
+    if len(endpoints) > 1 and endpoint_available(endpoints[1]):
+        mark_endpoint_unavailable(endpoints[0], delay)
+        rate_limit_stats['failovers'] += 1
+        if debug_mode:
+            print(f"LLM call failed ({reason}), retry {attempt} on {urlparse(endpoints[1]['url']).hostname}")
+        return 0.0
+    if debug_mode:
+        print(f'LLM call failed ({reason}), retry {attempt} in {delay:.1f}s')
+    if throttled:
+        pause_rate_limiter(delay)
+        return 0.0
+    return delay
+
+
+# Post a request through the rate limiter to the endpoints routed for its call type, retrying throttled and
+# failed attempts.  Returns the final response, which may still be an error, and the seconds spent queued in the
+# rate limiter.
+def post_with_retries(headers: dict, body: str, estimated_tokens: int, stream: bool = False, call_type: str = ''):
+    queue_seconds = 0.0
+    attempt = 0
+    while True:
+        wait = reserve_capacity(estimated_tokens)
+        if wait > 0:
+            time.sleep(wait)
+            queue_seconds += wait
+        endpoints = attempt_endpoints(call_type)
+        try:
+            response = http_session.post(endpoints[0]['url'], headers=endpoint_headers(headers, endpoints[0]), data=body.encode('utf-8'),
+                                         timeout=http_timeout, stream=stream)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            refund_capacity(estimated_tokens)
+            if attempt >= max_retries:
+                raise
+            failure = (retry_delay(attempt, {}), str(e), False)
+        else:
+            if response.status_code >= 400:
+                refund_capacity(estimated_tokens)
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                return response, queue_seconds
+            failure = (retry_delay(attempt, response.headers), f'status {response.status_code}', response.status_code == 429)
+            response.close()
+        attempt += 1
+        wait = failed_attempt(attempt, endpoints, *failure)
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Record/replay cassettes.  When recording, every request payload and the raw response text are appended to a
+# JSONL file.  When replaying, responses are served from the cassette instead of the endpoint, in the order they were
+# recorded for each distinct payload.  Together with a dice seed this makes a session fully deterministic.
+record_file = None
+replay_cassette = None
+cassette_lock = threading.Lock()
+
+
+def cassette_key(payload: dict) -> str:
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, separators=(',', ':')).encode('utf-8')).hexdigest()
+
+
+def load_cassette(filename: str) -> dict:
+    cassette = {}
+    with open(filename, 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                exchange = json.loads(line)
+                cassette.setdefault(exchange['key'], []).append(exchange)
+    return cassette
+
+
+def record_exchange(payload: dict, response):
+    exchange = {
+        'key': cassette_key(payload),
+        'request': payload,
+        'response': response
     }
+    with cassette_lock:
+        with open(record_file, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(exchange) + '\n')
+
+
+# Return the recorded response for a request.  A request that was never recorded is reported as a failed request,
+# just as if the endpoint had rejected it.
+def replay_exchange(payload: dict):
+    with cassette_lock:
+        exchanges = replay_cassette.get(cassette_key(payload))
+        if not exchanges:
+            raise HTTPError('No recorded response for this request in the replay cassette')
+        return exchanges.pop(0)['response']
+
+
+# Disk cache for parsing the static player and scenario files.  Responses are stored under a hash of the
+# primary endpoint routed for the call and the complete routed request payload (prompts, schema, model and
+# sampling settings), so any change to the input text, the rules, the schema or the routing misses the cache.
+# Failing over to another endpoint does not.  The least recently used entries are evicted once the
+# cache grows past its size limit.  The cache is bypassed while recording or replaying a cassette, so that the
+# cassette holds every exchange of the run and a replay never depends on what happens to be in the cache.
+parse_cache_dir = DEFAULT_PARSE_CACHE_DIR
+parse_cache_max_bytes = DEFAULT_PARSE_CACHE_MB * 1024 * 1024
+parse_cache_enabled = True
+
 
+# Whether a request that asks for the parse cache gets it
+def use_parse_cache(cached: bool) -> bool:
+    return cached and parse_cache_enabled and not record_file and replay_cassette is None
+
+
+def parse_cache_path(payload: dict, call_type: str) -> str:
+    key = hashlib.sha256((route_endpoints(call_type)[0]['url'] + '\n' + cassette_key(payload)).encode('utf-8')).hexdigest()
+    return os.path.join(parse_cache_dir, key + '.json')
+
+
+def read_parse_cache(payload: dict, call_type: str) -> dict:
+    path = parse_cache_path(payload, call_type)
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            choice = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    # Touch the entry so that eviction sees it as recently used
+    os.utime(path)
+    return choice
+
+
+def write_parse_cache(payload: dict, call_type: str, choice: dict):
+    os.makedirs(parse_cache_dir, exist_ok=True)
+    path = parse_cache_path(payload, call_type)
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    with open(temp_path, 'w', encoding='utf-8') as f:
+        json.dump(choice, f)
+    os.replace(temp_path, path)
+    evict_parse_cache()
+
+
+# Remove the least recently used entries until the cache fits in its size limit
+def evict_parse_cache():
+    entries = []
+    for entry in os.scandir(parse_cache_dir):
+        if entry.name.endswith('.json'):
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total_bytes = sum(entry[1] for entry in entries)
+    for mtime, size, path in sorted(entries):
+        if total_bytes <= parse_cache_max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total_bytes -= size
+
+
+# Per-call metrics.  When call_log is a list, every LLM call appends a record of its call type, duration,
+# payload sizes, token usage and time spent queued in the rate limiter.  Used by the benchmark suite.
+call_log = None
+
+def log_call(call_type: str, seconds: float, request_bytes: int, response_bytes: int, usage: dict, finish_reason: str = None, queue_seconds: float = 0.0):
+    usage = usage or {}
+    tracing.set_attributes(request_bytes=request_bytes, response_bytes=response_bytes, finish_reason=finish_reason, queue_seconds=queue_seconds,
+                           prompt_tokens=usage.get('prompt_tokens', 0), completion_tokens=usage.get('completion_tokens', 0),
+                           cached_tokens=(usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0))
+    if call_log is None:
+        return
+    call_log.append({
+        'call_type': call_type,
+        'seconds': seconds,
+        'request_bytes': request_bytes,
+        'response_bytes': response_bytes,
+        'prompt_tokens': usage.get('prompt_tokens', 0),
+        'completion_tokens': usage.get('completion_tokens', 0),
+        'cached_tokens': (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0),
+        'queue_seconds': queue_seconds
+    })
+
+
+# Name of the schema requested in the payload's response format, for tracing
+def payload_schema_name(payload: dict) -> str:
+    if 'response_format' not in payload:
+        return None
+    schema = payload['response_format']['json_schema']['schema']
+    for name, known_schema in named_schemas.items():
+        if schema is known_schema:
+            return name
+    return payload['response_format']['json_schema']['name']
+
+
+# Send a request to the LLM endpoint over the shared session and return the decoded JSON response
+def post_llm_request(headers: dict, payload: dict, call_type: str = '') -> dict:
+    with tracing.span('llm_request', call_type=call_type, schema=payload_schema_name(payload), retries=0):
+        return send_llm_request(headers, payload, call_type)
+
+
+# Decode a complete response, record it in the cassette and the call log, and settle the rate limiter
+# reservation made for it.  Replayed responses have no reservation.
+def finish_llm_request(payload: dict, call_type: str, body: str, response_text: str, start: float, estimated_tokens: int = None, queue_seconds: float = 0.0) -> dict:
+    if record_file:
+        record_exchange(payload, response_text)
+    result = json.loads(response_text)
+    if estimated_tokens is not None:
+        settle_capacity(estimated_tokens, result.get('usage'))
+    log_call(call_type, time.perf_counter() - start, len(body), len(response_text), result.get('usage'), result['choices'][0].get('finish_reason'), queue_seconds)
+    return result
+
+
+def send_llm_request(headers: dict, payload: dict, call_type: str) -> dict:
+    body = json.dumps(payload)
+    start = time.perf_counter()
+    if replay_cassette is not None:
+        return finish_llm_request(payload, call_type, body, replay_exchange(payload), start)
+    if not http_session:
+        configure_http_session()
+
+    estimated_tokens = estimate_request_tokens(payload, body)
+    url = call_endpoints(call_type)[0]['url']
+    connections_before = count_connections(url)
+    response, queue_seconds = post_with_retries(headers, body, estimated_tokens, call_type=call_type)
+    elapsed = time.perf_counter() - start
+    reused = count_connections(url) == connections_before
+
+    connection_stats['calls'] += 1
+    connection_stats['total_seconds'] += elapsed
+    if reused:
+        connection_stats['reused_connections'] += 1
+    else:
+        connection_stats['new_connections'] += 1
+    if debug_mode:
+        print(f"LLM call took {elapsed:.2f}s ({'reused' if reused else 'new'} connection)")
+
+    if response.status_code >= 400:
+        print(f"Error {response.status_code} - {response.text}")
+    response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
+    return finish_llm_request(payload, call_type, body, response.text, start, estimated_tokens, queue_seconds)
+
+
+# Decode server-sent event lines into the JSON events they carry
+def parse_sse_lines(lines):
+    for line in lines:
+        if not line or not line.startswith('data:'):
+            continue
+        data = line[len('data:'):].strip()
+        if data == '[DONE]':
+            break
+        yield json.loads(data)
+
+
+# Send a streaming request to the LLM endpoint over the shared session and yield each server-sent event as it arrives
+def post_llm_stream(headers: dict, payload: dict, call_type: str = ''):
+    with tracing.span('llm_request', call_type=call_type, schema=payload_schema_name(payload), retries=0, stream=True):
+        yield from send_llm_stream(headers, payload, call_type)
+
+
+# Finish reason carried by a streamed event, if any
+def event_finish_reason(event: dict) -> str:
+    if event.get('choices'):
+        return event['choices'][0].get('finish_reason')
+    return None
+
+
+# The lines of a streamed response as they arrive, with the usage and finish reason seen so far
+def new_stream_log() -> dict:
+    return {
+        'lines': [],
+        'usage': None,
+        'finish_reason': None
+    }
+
+
+# Add a line of a streamed response to its log and return the events it carries
+def read_stream_line(stream_log: dict, line: str) -> list:
+    stream_log['lines'].append(line)
+    events = list(parse_sse_lines([line]))
+    for event in events:
+        stream_log['usage'] = event.get('usage') or stream_log['usage']
+        stream_log['finish_reason'] = event_finish_reason(event) or stream_log['finish_reason']
+    return events
+
+
+# Same as finish_llm_request, for a streamed response that has been read to the end.  Returns the seconds the
+# request took.
+def finish_llm_stream(payload: dict, call_type: str, body: str, stream_log: dict, start: float, estimated_tokens: int = None, queue_seconds: float = 0.0) -> float:
+    if record_file:
+        record_exchange(payload, stream_log['lines'])
+    if estimated_tokens is not None:
+        settle_capacity(estimated_tokens, stream_log['usage'])
+    elapsed = time.perf_counter() - start
+    log_call(call_type, elapsed, len(body), sum(len(line) for line in stream_log['lines']), stream_log['usage'], stream_log['finish_reason'], queue_seconds)
+    return elapsed
+
+
+def send_llm_stream(headers: dict, payload: dict, call_type: str):
+    body = json.dumps(payload)
+    start = time.perf_counter()
+    stream_log = new_stream_log()
+    if replay_cassette is not None:
+        for line in replay_exchange(payload):
+            yield from read_stream_line(stream_log, line)
+        finish_llm_stream(payload, call_type, body, stream_log, start)
+        return
+    if not http_session:
+        configure_http_session()
+
+    estimated_tokens = estimate_request_tokens(payload, body)
+    url = call_endpoints(call_type)[0]['url']
+    connections_before = count_connections(url)
+    # Only opening the stream is retried; once events have been passed on, a broken stream fails the request
+    response, queue_seconds = post_with_retries(headers, body, estimated_tokens, stream=True, call_type=call_type)
+    reused = count_connections(url) == connections_before
+
+    connection_stats['calls'] += 1
+    if reused:
+        connection_stats['reused_connections'] += 1
+    else:
+        connection_stats['new_connections'] += 1
+
+    if response.status_code >= 400:
+        print(f"Error {response.status_code} - {response.text}")
+    response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
+
+    with response:
+        for line in response.iter_lines(decode_unicode=True):
+            yield from read_stream_line(stream_log, line)
+    elapsed = finish_llm_stream(payload, call_type, body, stream_log, start, estimated_tokens, queue_seconds)
+    connection_stats['total_seconds'] += elapsed
+    if debug_mode:
+        print(f"LLM streaming call took {elapsed:.2f}s ({'reused' if reused else 'new'} connection)")
+
+
+# Serialize game data for a prompt without indentation; pretty-printing costs thousands of whitespace tokens per call
+def compact_json(data) -> str:
+    return json.dumps(data, separators=(',', ':'))
+
+
+# Prompt caching statistics.  prefix_tokens is our estimate of the stable prompt prefix we send; cached_tokens
+# is what the endpoint reports it actually served from its prompt cache.
+prompt_cache_stats = {
+    'calls': 0,
+    'prefix_tokens': 0,
+    'prompt_tokens': 0,
+    'cached_tokens': 0
+}
+
+def record_prompt_cache(prefix_tokens: int, usage: dict):
+    usage = usage or {}
+    cached_tokens = (usage.get('prompt_tokens_details') or {}).get('cached_tokens', 0)
+    prompt_cache_stats['calls'] += 1
+    prompt_cache_stats['prefix_tokens'] += prefix_tokens
+    prompt_cache_stats['prompt_tokens'] += usage.get('prompt_tokens', 0)
+    prompt_cache_stats['cached_tokens'] += cached_tokens
+    if debug_mode:
+        print(f"Prompt: {usage.get('prompt_tokens', '?')} tokens, cacheable prefix ~{prefix_tokens} tokens, {cached_tokens} cached")
+
+
+# Build the chat completions payload shared by structured and streaming requests.
+# Messages are laid out so that the prompt prefix is byte-identical from one call to the next and can be served
+# from the provider's prompt cache: the static system prompt first, then the conversation context (which only
+# grows at the end), and only then the volatile parts: the current state, the second system prompt and the user's prompt.
+# Returns the payload and the estimated number of tokens in the cacheable prefix.
+def build_structured_payload(system_prompt: str, user_prompt: str, second_system_prompt: str, schema: dict, max_tokens: int, conversation_context: list = [], temperature: float=0.7, top_p: float=0.95, state_prompt: str = None, recalled_context: list = []):
     # Payload for the request
     payload = {
         "model": "gpt-4o-mini",
@@ -375,6 +1239,35 @@ def make_structured_request(system_prompt: str, user_prompt: str, second_system_
             ]
         })
 
+    # Everything up to here is the cacheable prefix
+    prefix_tokens = sum(estimate_tokens(message['content'][0]['text']) for message in payload['messages'])
+    if schema:
+        prefix_tokens += estimate_tokens(compact_json(schema))
+
+    # Recalled turns depend on the command, so they go after the prefix too
+    if recalled_context:
+        payload['messages'].append({
+            'role': 'system',
+            'content': [
+                {
+                    'type': 'text',
+                    'text': RECALLED_TURNS_PROMPT + '\n'.join(f'Player: {entry[0]}\nGame: {entry[1]}' for entry in recalled_context)
+                }
+            ]
+        })
+
+    # The current state changes every turn so it goes after the prefix
+    if state_prompt:
+        payload['messages'].append({
+            'role': 'system',
+            'content': [
+                {
+                    'type': 'text',
+                    'text': state_prompt
+                }
+            ]
+        })
+
     # Add a second system prompt if provided
     if second_system_prompt:
         payload['messages'].append({
@@ -397,18 +1290,493 @@ def make_structured_request(system_prompt: str, user_prompt: str, second_system_
             }
         ]
     })
+    return payload, prefix_tokens
+
+
+# Schemas by name, used to label requests in traces
+named_schemas = {
+    'character_schema': character_schema,
+    'game_state_schema': game_state_schema,
+    'state_delta_schema': state_delta_schema,
+    'round_schema': round_schema,
+    'response_schema': response_schema,
+    'merged_response_schema': merged_response_schema,
+    'summary_schema': summary_schema
+}
+
+
+# Structured output validation.  A response cut off at max_tokens is not valid JSON, and a model can leave out
+# or mistype fields even with a strict schema.  The character sheets, game state, actions and narration are too
+# important to the rest of the game to trust blindly, so responses for the schemas below are checked against
+# validators compiled from the schemas once at startup.  Small defects are repaired locally: values of the wrong
+# type are coerced, missing arrays are made empty, and missing or unusable fields are carried forward from the
+# previous value when the request has one (the game state being updated, say).  A truncated response keeps
+# every field that arrived complete.  Only the top-level fields that still cannot be repaired are requested
+# again, rather than repeating the whole request.
+VALIDATED_SCHEMAS = ['character_schema', 'game_state_schema', 'round_schema', 'response_schema', 'merged_response_schema']
+
+structured_output_prompt = '''
+Part of your response has already been received and is given below.  Respond with only the remaining fields, consistent with it.
+Response so far: '''
+
+structured_output_stats = {
+    'checked': 0,
+    'truncated': 0,
+    'repaired': 0,
+    'rerequested': 0
+}
+
+# Marks a field that is missing from a response, as opposed to one that is null
+MISSING_FIELD = object()
+
+
+def coerce_value(schema_type: str, value):
+    if schema_type == 'string':
+        if isinstance(value, str):
+            return value
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return str(value)
+    elif schema_type == 'integer':
+        if isinstance(value, int) and not isinstance(value, bool):
+            return value
+        if isinstance(value, float) and value.is_integer():
+            return int(value)
+        if isinstance(value, str) and re.fullmatch(r'\s*[+-]?\d+\s*', value):
+            return int(value)
+    elif schema_type == 'number':
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return value
+        if isinstance(value, str):
+            return float(value)
+    elif schema_type == 'boolean':
+        if isinstance(value, bool):
+            return value
+        if isinstance(value, str) and value.strip().lower() in ['true', 'false']:
+            return value.strip().lower() == 'true'
+        if value in [0, 1]:
+            return bool(value)
+    raise ValueError(f'not a valid {schema_type}')
+
+
+# Compile a JSON schema into a function that checks and repairs a value: validate(value, previous, path, report).
+# It returns the repaired value and records the path of every repair, and of every field it could not repair,
+# in the report.
+def compile_validator(schema: dict):
+    if 'anyOf' in schema:
+        nullable = {'type': 'null'} in schema['anyOf']
+        inner = compile_validator([option for option in schema['anyOf'] if option != {'type': 'null'}][0])
+
+        def validate_any_of(value, previous, path, report):
+            if nullable and (value is None or value is MISSING_FIELD):
+                return None
+            return inner(value, previous, path, report)
+        return validate_any_of
+
+    types = schema['type'] if isinstance(schema['type'], list) else [schema['type']]
+    nullable = 'null' in types
+    schema_type = [t for t in types if t != 'null'][0]
+
+    if schema_type == 'object':
+        properties = {key: compile_validator(value) for key, value in schema['properties'].items()}
+
+        def validate_object(value, previous, path, report):
+            if nullable and (value is None or value is MISSING_FIELD):
+                return None
+            if not isinstance(value, dict):
+                if value is not MISSING_FIELD:
+                    report['repaired'].append(path)
+                value = {}
+            if set(value) - set(properties):
+                report['repaired'].append(path)
+            previous = previous if isinstance(previous, dict) else {}
+            return {key: validate(value.get(key, MISSING_FIELD), previous.get(key), path + [key], report) for key, validate in properties.items()}
+        return validate_object
+
+    if schema_type == 'array':
+        items = compile_validator(schema['items'])
+        # Items of the previous value are matched up by their first field, e.g. a monster's identifier
+        item_key = schema['items']['required'][0] if schema['items'].get('type') == 'object' else None
+
+        def validate_array(value, previous, path, report):
+            if nullable and (value is None or value is MISSING_FIELD):
+                return None
+            if value is None or value is MISSING_FIELD:
+                report['repaired'].append(path)
+                return copy.deepcopy(previous) if isinstance(previous, list) else []
+            if not isinstance(value, list):
+                report['repaired'].append(path)
+                value = [value]
+            previous_items = {}
+            if item_key and isinstance(previous, list):
+                previous_items = {str(item.get(item_key)): item for item in previous if isinstance(item, dict)}
+            return [items(item, previous_items.get(str(item.get(item_key))) if item_key and isinstance(item, dict) else None, path + [index], report)
+                    for index, item in enumerate(value)]
+        return validate_array
+
+    enum = schema.get('enum')
+
+    def validate_value(value, previous, path, report):
+        if nullable and (value is None or value is MISSING_FIELD):
+            return None
+        try:
+            coerced = coerce_value(schema_type, value)
+            if enum and coerced not in enum:
+                coerced = [option for option in enum if option.lower() == coerced.strip().lower()][0]
+        except (ValueError, AttributeError, IndexError):
+            if previous is None:
+                report['failed'].append(path)
+                return None
+            report['repaired'].append(path)
+            return previous
+        if coerced != value or type(coerced) is not type(value):
+            report['repaired'].append(path)
+        return coerced
+    return validate_value
+
+
+structured_validators = {name: compile_validator(named_schemas[name]) for name in VALIDATED_SCHEMAS}
+
+
+# Recover what arrived complete of a JSON object that was cut off: the top-level members that arrived whole.
+# The document is cut after the last complete member of the innermost object or array and the open objects and
+# arrays are closed; the top-level member that was cut short is dropped.  Returns None if nothing parses.
+def close_truncated_json(text: str):
+    closers = []
+    cuts = []
+    in_string = False
+    escaped = False
+    for position, char in enumerate(text):
+        if in_string:
+            if escaped:
+                escaped = False
+            elif char == '\\':
+                escaped = True
+            elif char == '"':
+                in_string = False
+        elif char == '"':
+            in_string = True
+        elif char in '{[':
+            closers.append('}' if char == '{' else ']')
+        elif char in '}]' and closers:
+            closers.pop()
+            cuts.append((position + 1, ''.join(reversed(closers))))
+        elif char == ',':
+            cuts.append((position, ''.join(reversed(closers))))
+    for position, closing in reversed(cuts):
+        try:
+            value = json.loads(text[:position] + closing)
+        except ValueError:
+            continue
+        if len(closing) > 1 and isinstance(value, dict) and value:
+            del value[list(value)[-1]]
+        return value
+    return None
+
+
+# Check a structured response against its schema and repair what can be repaired.  Returns the repaired value,
+# the top-level fields that still have to be requested again, and whether the content changed at all.
+def check_structured_output(schema_name: str, content: str, finish_reason: str, previous: dict = None, call_type: str = ''):
+    structured_output_stats['checked'] += 1
+    truncated = False
+    try:
+        value = json.loads(content)
+    except ValueError:
+        truncated = True
+        value = close_truncated_json(content)
+    if finish_reason == 'length':
+        truncated = True
+    if truncated:
+        structured_output_stats['truncated'] += 1
+
+    value = value if isinstance(value, dict) else {}
+    # Fields lost to truncation are not defaulted, only carried forward
+    lost = [key for key in named_schemas[schema_name]['properties'] if truncated and key not in value and key not in (previous or {})]
+    report = {'repaired': [], 'failed': [[key] for key in lost]}
+    value = structured_validators[schema_name](value, previous, [], report)
+    failing = [key for key in named_schemas[schema_name]['properties'] if any(path[0] == key for path in report['failed'])]
+    repaired = [path for path in report['repaired'] if not path or path[0] not in failing]
+    if repaired:
+        structured_output_stats['repaired'] += 1
+    if debug_mode and (truncated or repaired or failing):
+        print(f"{call_type} response{' was truncated' if truncated else ''}: repaired {len(repaired)} fields, "
+              f"{len(failing)} to request again {failing}")
+    return value, failing, truncated or bool(repaired) or bool(failing)
+
+
+# Request for just the fields of a response that could not be repaired, given the rest of the response
+def structured_repair_payload(payload: dict, schema_name: str, value: dict, failing: list) -> dict:
+    schema = named_schemas[schema_name]
+    repair = dict(payload)
+    received = {key: field for key, field in value.items() if key not in failing}
+    repair['messages'] = payload['messages'] + [{
+        "role": "system",
+        "content": [
+            {
+            "type": "text",
+            "text": structured_output_prompt + compact_json(received)
+            }
+        ]
+    }]
+    repair['response_format'] = {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "game_response",
+            "schema": {
+                "type": "object",
+                "properties": {key: schema['properties'][key] for key in failing},
+                "required": failing,
+                "additionalProperties": False
+            },
+            "strict": True
+        }
+    }
+    return repair
+
+
+# Merge the response to a structured_repair_payload request into the response being repaired
+def merge_structured_repair(schema_name: str, value: dict, failing: list, repair_choice: dict, previous: dict = None, call_type: str = '') -> dict:
+    structured_output_stats['rerequested'] += 1
+    try:
+        fields = json.loads(repair_choice['message']['content'])
+    except ValueError:
+        fields = close_truncated_json(repair_choice['message']['content']) or {}
+    report = {'repaired': [], 'failed': []}
+    merged = structured_validators[schema_name](dict(value, **{key: fields.get(key, MISSING_FIELD) for key in failing}), previous, [], report)
+    if report['failed']:
+        raise ValueError(f"{call_type} response is incomplete: {', '.join('/'.join(str(part) for part in path) for path in report['failed'])}")
+    return merged
+
+
+def repaired_choice(choice: dict, value: dict) -> dict:
+    return dict(choice, message=dict(choice['message'], content=json.dumps(value)))
+
+
+# First half of checking a structured response: repair what can be repaired locally and work out which fields
+# have to be requested again.  The returned check carries the payload of that repair request, if one is needed.
+def start_structured_check(payload: dict, choice: dict, previous: dict = None, call_type: str = '') -> dict:
+    check = {
+        'choice': choice,
+        'schema_name': payload_schema_name(payload),
+        'previous': previous,
+        'call_type': call_type,
+        'repair_payload': None
+    }
+    if check['schema_name'] not in structured_validators:
+        return check
+    check['value'], check['failing'], check['changed'] = check_structured_output(check['schema_name'], choice['message']['content'], choice.get('finish_reason'), previous, call_type)
+    if check['failing']:
+        check['repair_payload'] = structured_repair_payload(payload, check['schema_name'], check['value'], check['failing'])
+    return check
+
+
+# Second half: merge the response to the repair request and return the choice with the checked content
+def finish_structured_check(check: dict, repair_choice: dict = None) -> dict:
+    if 'value' not in check:
+        return check['choice']
+    value = check['value']
+    if check['failing']:
+        value = merge_structured_repair(check['schema_name'], value, check['failing'], repair_choice, check['previous'], check['call_type'])
+    return repaired_choice(check['choice'], value) if check['changed'] else check['choice']
+
+
+# Check a structured response, repair it and request the fields that could not be repaired again.  Returns the
+# choice with the checked content.
+def validate_structured_choice(headers: dict, payload: dict, choice: dict, previous: dict = None, call_type: str = '') -> dict:
+    check = start_structured_check(payload, choice, previous, call_type)
+    repair_choice = None
+    if check['repair_payload']:
+        repair_choice = post_llm_request(headers, check['repair_payload'], call_type)['choices'][0]
+    return finish_structured_check(check, repair_choice)
+
+
+def request_headers() -> dict:
+    return {
+        "Content-Type": "application/json",
+        "api-key": api_key,
+        "Authorization": f"Bearer {api_key}"
+    }
+
+
+# Build the payload of a structured request and route it to the model for its call type.  Returns the payload
+# and the number of tokens in its cacheable prefix.
+def structured_request_payload(system_prompt: str, user_prompt: str, second_system_prompt: str, schema: dict, max_tokens: int, conversation_context: list, temperature: float, top_p: float, state_prompt: str, recalled_context: list, call_type: str, stream: bool = False):
+    payload, prefix_tokens = build_structured_payload(system_prompt, user_prompt, second_system_prompt, schema, max_tokens, conversation_context, temperature, top_p, state_prompt, recalled_context)
+    route_payload(payload, call_type)
+    if stream:
+        payload['stream'] = True
+        payload['stream_options'] = {'include_usage': True}
+    return payload, prefix_tokens
+
+
+# The response to a cached request from the parse cache, or None if it has to be sent
+def cached_choice(payload: dict, call_type: str, cached: bool) -> dict:
+    if not use_parse_cache(cached):
+        return None
+    choice = read_parse_cache(payload, call_type)
+    if not choice:
+        tracing.increment(f'parse_cache.{call_type}.misses')
+        return None
+    tracing.increment(f'parse_cache.{call_type}.hits')
+    if debug_mode:
+        print(f'{call_type} served from the parse cache')
+    return choice
+
+
+# Keep the response to a cached request in the parse cache.  Only complete responses are worth keeping.
+def cache_choice(payload: dict, call_type: str, cached: bool, choice: dict):
+    if use_parse_cache(cached) and choice.get('finish_reason') == 'stop':
+        write_parse_cache(payload, call_type, choice)
+
+
+# Set cached to serve the response from the parse cache when the identical request has been made before
+def make_structured_request(system_prompt: str, user_prompt: str, second_system_prompt: str, schema: dict, max_tokens: int, conversation_context: list = [], temperature: float=0.7, top_p: float=0.95, state_prompt: str = None, recalled_context: list = [], call_type: str = '', cached: bool = False, previous: dict = None) -> dict:
+    payload, prefix_tokens = structured_request_payload(system_prompt, user_prompt, second_system_prompt, schema, max_tokens, conversation_context, temperature, top_p, state_prompt, recalled_context, call_type)
+    choice = cached_choice(payload, call_type, cached)
+    if choice:
+        return choice
 
     # Send request
-    response = requests.post(endpoint, headers=headers, json=payload)
-    if response.status_code >= 400:
-        print(f"Error {response.status_code} - {response.text}")
-    response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
+    headers = request_headers()
+    response = post_llm_request(headers, payload, call_type)
+    record_prompt_cache(prefix_tokens, response.get('usage'))
+    choice = validate_structured_choice(headers, payload, response['choices'][0], previous, call_type)
+    cache_choice(payload, call_type, cached, choice)
 
     # Handle the response as needed (e.g., print or process)
-    return response.json()['choices'][0]
+    return choice
+
+
+# Start an incremental parser that extracts the value of one top-level string field from a JSON document
+# that arrives in pieces
+def new_field_stream(field: str) -> dict:
+    return {
+        'field': field,
+        'buffer': '',
+        'position': None,
+        'done': False
+    }
+
+
+# Feed the next piece of the JSON document to the parser and return any newly decoded text of the field
+def feed_field_stream(stream: dict, chunk: str) -> str:
+    stream['buffer'] += chunk
+    buffer = stream['buffer']
+    if stream['done']:
+        return ''
+    if stream['position'] is None:
+        # An unescaped quote before the colon means this cannot match the field name inside another string value
+        match = re.search('"' + re.escape(stream['field']) + r'"\s*:\s*"', buffer)
+        if not match:
+            return ''
+        stream['position'] = match.end()
+
+    text = ''
+    position = stream['position']
+    while position < len(buffer):
+        char = buffer[position]
+        if char == '"':
+            stream['done'] = True
+            break
+        if char != '\\':
+            text += char
+            position += 1
+            continue
+        # Escape sequences may be split across chunks; wait until the whole sequence has arrived
+        length = 6 if buffer[position + 1:position + 2] == 'u' else 2
+        if length == 6 and 0xD800 <= int(buffer[position + 2:position + 6] or '0', 16) <= 0xDBFF:
+            length = 12
+        if position + length > len(buffer):
+            break
+        text += json.loads('"' + buffer[position:position + length] + '"')
+        position += length
+    stream['position'] = position
+    return text
+
+
+# A structured response as its streamed events arrive.  When stream_field is given, the decoded text of that
+# top-level string field is extracted as it arrives.
+def new_streamed_choice(stream_field: str = None) -> dict:
+    return {
+        'content': '',
+        'finish_reason': None,
+        'usage': None,
+        'field_stream': new_field_stream(stream_field) if stream_field else None
+    }
+
+
+# Add a streamed event to the response and return any newly decoded text of the streamed field
+def feed_streamed_choice(streamed: dict, event: dict) -> str:
+    if event.get('usage'):
+        streamed['usage'] = event['usage']
+    if not event.get('choices'):
+        return ''
+    choice = event['choices'][0]
+    if choice.get('finish_reason'):
+        streamed['finish_reason'] = choice['finish_reason']
+    chunk = (choice.get('delta') or {}).get('content')
+    if not chunk:
+        return ''
+    streamed['content'] += chunk
+    field_stream = streamed['field_stream']
+    if field_stream and not field_stream['done']:
+        return feed_field_stream(field_stream, chunk)
+    return ''
+
+
+# The complete streamed response, in the same form as a choice of a response that was not streamed
+def streamed_choice(streamed: dict) -> dict:
+    return {
+        'message': {
+            'role': 'assistant',
+            'content': streamed['content']
+        },
+        'finish_reason': streamed['finish_reason']
+    }
 
 
-def make_self_play_request(system_prompt: str, user_prompt: str, conversation_context: list = [], max_tokens: int = 5000, temperature: float=0.7, top_p: float=0.95) -> str:
+# Make a structured request with a streamed response.  The value of stream_field is printed as soon as it starts
+# arriving; the full response is returned in the same form as make_structured_request.
+def make_streaming_request(system_prompt: str, user_prompt: str, second_system_prompt: str, schema: dict, max_tokens: int, conversation_context: list = [], stream_field: str = None, temperature: float=0.7, top_p: float=0.95, state_prompt: str = None, recalled_context: list = [], call_type: str = '') -> dict:
+    headers = request_headers()
+    payload, prefix_tokens = structured_request_payload(system_prompt, user_prompt, second_system_prompt, schema, max_tokens, conversation_context, temperature, top_p, state_prompt, recalled_context, call_type, stream=True)
+
+    start = time.perf_counter()
+    first_text_seconds = None
+    streamed = new_streamed_choice(stream_field)
+    field_stream = streamed['field_stream']
+    for event in post_llm_stream(headers, payload, call_type):
+        was_done = field_stream is None or field_stream['done']
+        text = feed_streamed_choice(streamed, event)
+        if text:
+            if first_text_seconds is None:
+                first_text_seconds = time.perf_counter() - start
+            print(text, end='', flush=True)
+        if not was_done and field_stream['done']:
+            print()
+    if field_stream and field_stream['position'] is not None and not field_stream['done']:
+        print()
+    if debug_mode and first_text_seconds is not None:
+        print(f'First {stream_field} text after {first_text_seconds:.2f}s')
+    record_prompt_cache(prefix_tokens, streamed['usage'])
+
+    return validate_structured_choice(headers, payload, streamed_choice(streamed), None, call_type)
+
+
+# A self-play turn that fails is retried with the same command this many times, then the command is dropped and
+# a new one requested, so that a command the game cannot handle does not stall the game
+SELF_PLAY_TURN_RETRIES = 2
+
+
+# Whether a self-play command that has failed this many times in a row should be tried again.  Waits the retry
+# backoff first.
+def retry_self_play_command(failures: int) -> bool:
+    if failures > SELF_PLAY_TURN_RETRIES:
+        return False
+    time.sleep(retry_delay(failures - 1, {}))
+    return True
+
+
+def make_self_play_request(system_prompt: str, user_prompt: str, conversation_context: list = [], max_tokens: int = 5000, temperature: float=0.7, top_p: float=0.95, call_type: str = 'self_play') -> str:
     headers = {
         "Content-Type": "application/json",
         "api-key": api_key,
@@ -463,30 +1831,71 @@ def make_self_play_request(system_prompt: str, user_prompt: str, conversation_co
             }
         ]
     })
+    route_payload(payload, call_type)
 
     # Send request
-    print(json.dumps(payload, indent=4))
-    response = requests.post(endpoint, headers=headers, json=payload)
-    if response.status_code >= 400:
-        print(f"Error {response.status_code} - {response.text}")
-    response.raise_for_status()  # Will raise an HTTPError if the HTTP request returned an unsuccessful status code
+    if debug_mode:
+        print(json.dumps(payload, indent=4))
+    response = post_llm_request(headers, payload, call_type)
 
     # Handle the response as needed (e.g., print or process)
-    return response.json()['choices'][0]['message']['content']
+    return response['choices'][0]['message']['content']
+
+
+# Remove one occurrence of each named item from an inventory list, matching case-insensitively
+def remove_items(inventory: list, items: list) -> list:
+    new_inventory = list(inventory)
+    for item in items:
+        for i, existing in enumerate(new_inventory):
+            if existing.lower() == item.lower():
+                del new_inventory[i]
+                break
+    return new_inventory
 
 
-# Apply the defined state change to the game state
+# Apply the defined state change (see state_delta_schema) to the game state
 def apply_state_change(state: dict, change: dict):
-    state['gold'] += change['add_gold']
-    new_inventory = []
-    for item in state['inventory']:
-        if item not in change['remove_inventory']:
-            new_inventory.append(item)
-    for item in change['add_inventory']:
-        new_inventory.append(item)
-    state['inventory'] = new_inventory
-    if change['set_location']:
-        state['location'] = change['set_location']
+    player_state = state['player']
+    player_state['Gold'] = max(0, player_state['Gold'] + change['gold_change'])
+    player_state['HP'] = min(player_state['Max HP'], player_state['HP'] + change['hp_change'])
+    player_state['XP'] += change['xp_change']
+    if change['player_status'] is not None:
+        player_state['Status'] = change['player_status']
+    player_state['Inventory'] = remove_items(player_state['Inventory'], change['remove_inventory']) + change['add_inventory']
+    for used in change['spell_slots_used']:
+        for slot in player_state['Magic']['Spell Slots']:
+            if slot['level'] == used['level']:
+                slot['slots'] = min(slot['max slots'], max(0, slot['slots'] - used['count']))
+    if change['spell_effects'] is not None:
+        player_state['Spell Effects'] = change['spell_effects']
+
+    for field in ['location', 'danger', 'time_of_day', 'sunrise', 'sunset', 'date', 'dark']:
+        if change[field] is not None:
+            state[field] = change[field]
+
+    removed = [identifier.lower() for identifier in change['remove_monsters']]
+    state['monsters'] = [monster for monster in state['monsters'] if monster['identifier'].lower() not in removed]
+    for update in change['update_monsters']:
+        for monster in state['monsters']:
+            if monster['identifier'].lower() == update['identifier'].lower():
+                if update['health'] is not None:
+                    monster['health'] = update['health']
+                if update['status'] is not None:
+                    monster['status'] = update['status']
+    state['monsters'] += change['add_monsters']
+
+    removed = [name.lower() for name in change['remove_NPCs']]
+    state['NPCs'] = [npc for npc in state['NPCs'] if npc['Name'].lower() not in removed]
+    for update in change['update_NPCs']:
+        for npc in state['NPCs']:
+            if npc['Name'].lower() == update['Name'].lower():
+                if update['HP'] is not None:
+                    npc['HP'] = min(npc['Max HP'], update['HP'])
+                if update['Status'] is not None:
+                    npc['Status'] = update['Status']
+                npc['Gold'] = max(0, npc['Gold'] + update['gold_change'])
+                npc['Inventory'] = remove_items(npc['Inventory'], update['remove_inventory']) + update['add_inventory']
+    state['NPCs'] += change['add_NPCs']
 
 
 game_rules = '''
@@ -587,6 +1996,21 @@ The status indicator determines if the monster has some unusual status that migh
 
 Any NPCs in the room should be listed in the NPC section.
 NPCs have statistics very similar to those of a player character, and each NPC has a name and pronouns.
+Only list the monsters and NPCs present at the current location.  When the player leaves, remove those who stay behind; they are remembered
+and brought back when the player returns.
+'''
+
+state_delta_rules = '''
+Do not generate the whole game state.  Instead describe only how the game state changed, in JSON matching the supplied format:
+gold_change, hp_change and xp_change are the amounts to add to the player's Gold, HP and XP (negative for a loss, 0 if unchanged).
+add_inventory and remove_inventory list the items the player gained or lost.  Use the exact item names from the current inventory when removing.
+spell_slots_used lists the number of spell slots of each level the player used up.  Use a negative count when slots are regained, for example after a long rest.
+spell_effects is the complete new list of spell effects on the player, or null if they did not change.
+player_status, location, danger, time_of_day, sunrise, sunset, date and dark are the new values, or null if unchanged.
+add_monsters lists monsters that appeared, remove_monsters lists the identifiers of monsters that left or died,
+and update_monsters gives the new health and status of monsters already present that changed.
+add_NPCs lists NPCs that appeared with their full statistics, remove_NPCs lists the names of NPCs that left,
+and update_NPCs describes changes to NPCs already present.
 '''
 
 action_rules = '''
@@ -630,6 +2054,20 @@ If the player tries to load the game or restore the game, create an action with
 If the player tries to quit the game, create an action with action_type set to precisely quit_game
 '''
 
+summary_rules = '''
+You are helping the Dungeon Master of a fantasy role-playing game keep track of a long adventure.
+You will be given a summary of the adventure so far, which may be empty, followed by a transcript of the turns played since then.
+Each turn consists of the command the player typed and the response the player saw.
+Produce an updated summary that merges the new turns into the existing summary.
+Keep every fact that may matter later: places visited, NPCs met and what was learned from them, deals and promises made,
+items acquired or lost, enemies defeated, and quests or mysteries that are still unresolved.
+Drop flavor text and blow-by-blow detail.  Write in the past tense from the Dungeon Master's perspective.
+'''
+
+merged_response_rules = '''
+Third, in state_change, describe how the game state changed during the turn, following these rules:
+''' + state_change_rules + state_delta_rules
+
 death_rules = '''
 The user is playing a fantasy role-playing game set in a typical medieval sword-and-sorcery RPG setting and you are the Dungeon Master.
 The player has just died.  Display an appropriate game over message and summarize the player's achievements.
@@ -650,16 +2088,222 @@ and go on an adventure seeking fame and riches!  On the way you may have to talk
 fight monsters, disarm traps, and more.
 '''
 
-game_state = {}
+# How the game state is updated after each turn: 'delta' applies a state change locally, 'full' regenerates
+# the whole game state.  In delta mode the full state is still regenerated every state_resync_turns turns.
+state_update_mode = 'delta'
+state_resync_turns = DEFAULT_STATE_RESYNC_TURNS
+
+# When pipelining, the state update for a turn runs in the background while the player types their next command.
+# A single worker keeps the updates in turn order.
+pipeline_mode = False
+state_update_executor = None
+
+# Context entries pinned by read_scenario_file.  These are always sent verbatim and never summarized.
+PINNED_CONTEXT_ENTRIES = ('Game World', 'Player')
+SUMMARY_CONTEXT_ENTRY = 'Summary of earlier events'
+
+context_budget = DEFAULT_CONTEXT_BUDGET
+context_recent_turns = DEFAULT_CONTEXT_RECENT_TURNS
+context_recall_turns = DEFAULT_CONTEXT_RECALL_TURNS
+
+
+# Everything that belongs to one game.  The command line game plays a single session; the game server
+# (server.py) hosts many sessions at once.
+class GameSession:
+    def __init__(self, session_id: str = ''):
+        self.session_id = session_id
+        self.player = {}
+        self.player_text = ''
+        self.game_state = {}
+        self.context = []
+        # NPCs and monsters away from the player's location (see page_world)
+        self.world = {}
+        # Rolling summary of the turns that have been folded out of the context sent to the LLM.
+        # 'turns' counts how many of the unpinned context entries are covered by the summary.
+        self.context_summary = {
+            'summary': '',
+            'turns': 0
+        }
+        # Search index over the turns played, for recalling summarized turns (see recall_turns)
+        self.history_index = None
+        self.debug_mode = False
+        self.turns_since_resync = 0
+        # State update running in the background when pipelining, or left to retry after it failed
+        self.pending_state_update = None
+        # The command and dice outcome of a turn that failed after its dice were rolled.  Retrying the same
+        # command resumes at the phase that failed instead of rolling again.
+        self.failed_turn = None
+        # Set when the player quits
+        self.finished = False
+        # Autosave journal, if the session is being autosaved
+        self.journal = None
+
+
+# Rough token estimate, about four characters per token for English text
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def estimate_context_tokens(conversation_context: list) -> int:
+    return sum(estimate_tokens(entry[0]) + estimate_tokens(entry[1]) for entry in conversation_context)
+
+
+# Build the conversation context to send with a request: the pinned entries, the summary of older turns, then
+# the turns not yet covered by the summary verbatim.  Only the newest turns change from one request to the next,
+# so the rest stays a cacheable prefix.
+def build_request_context(context: list, context_summary: dict) -> list:
+    pinned = [entry for entry in context if entry[0] in PINNED_CONTEXT_ENTRIES]
+    turns = [entry for entry in context if entry[0] not in PINNED_CONTEXT_ENTRIES]
+    request_context = pinned
+    if context_summary['summary']:
+        request_context.append((SUMMARY_CONTEXT_ENTRY, context_summary['summary']))
+    return request_context + turns[context_summary['turns']:]
+
+
+# Recall of summarized turns.  The summary keeps the gist of older turns but loses their detail, so each request
+# also carries the few summarized turns that best match the player's command and the current scene, ranked by
+# BM25 over an index of every turn's command and response.  The index is extended as turns are played and
+# rebuilt if the context is replaced, e.g. by loading a game.  The recalled turns depend on the command, so they
+# are sent in a system message after the cacheable prefix rather than in the conversation context.
+RECALLED_TURNS_PROMPT = 'Earlier turns that may be relevant to this command, in the order they were played:\n'
+RECALL_STOP_WORDS = {
+    'a', 'an', 'and', 'are', 'as', 'at', 'be', 'but', 'by', 'for', 'from', 'has', 'have', 'he', 'her', 'his', 'i',
+    'in', 'into', 'is', 'it', 'its', 'me', 'my', 'of', 'on', 'or', 'she', 'so', 'that', 'the', 'their', 'them',
+    'then', 'there', 'they', 'this', 'to', 'was', 'were', 'with', 'you', 'your'
+}
+BM25_K1 = 1.2
+BM25_B = 0.75
 
-character = {}
 
-context = []
+def recall_terms(text: str) -> list:
+    return [term for term in re.findall(r"[a-z0-9']+", text.lower()) if term not in RECALL_STOP_WORDS]
 
-def read_player_file(player_file: str):
-    global player
-    global player_text
 
+# Add the turns played since the index was last updated
+def update_history_index(session: GameSession, turns: list):
+    index = session.history_index
+    if index is None or len(turns) < len(index['lengths']):
+        index = session.history_index = {
+            'lengths': [],
+            'total_length': 0,
+            'postings': {}
+        }
+    for turn_number in range(len(index['lengths']), len(turns)):
+        terms = recall_terms(turns[turn_number][0] + ' ' + turns[turn_number][1])
+        for term in terms:
+            postings = index['postings'].setdefault(term, {})
+            postings[turn_number] = postings.get(turn_number, 0) + 1
+        index['lengths'].append(len(terms))
+        index['total_length'] += len(terms)
+
+
+# The summarized turns most relevant to the command, the current location and the NPCs present, in the order
+# they were played
+def recall_turns(session: GameSession, command: str) -> list:
+    summarized = session.context_summary['turns']
+    if context_recall_turns <= 0 or summarized == 0:
+        return []
+    turns = [entry for entry in session.context if entry[0] not in PINNED_CONTEXT_ENTRIES]
+    update_history_index(session, turns)
+    index = session.history_index
+
+    query = command + ' ' + session.game_state.get('location', '')
+    query += ' ' + ' '.join(npc['Name'] for npc in session.game_state.get('NPCs', []))
+    document_count = len(index['lengths'])
+    average_length = index['total_length'] / document_count or 1
+    scores = {}
+    for term in set(recall_terms(query)):
+        postings = index['postings'].get(term)
+        if not postings:
+            continue
+        idf = math.log(1 + (document_count - len(postings) + 0.5) / (len(postings) + 0.5))
+        for turn_number, frequency in postings.items():
+            if turn_number >= summarized:
+                continue
+            length_norm = 1 - BM25_B + BM25_B * index['lengths'][turn_number] / average_length
+            scores[turn_number] = scores.get(turn_number, 0) + idf * frequency * (BM25_K1 + 1) / (frequency + BM25_K1 * length_norm)
+    best = sorted(scores, key=scores.get, reverse=True)[:context_recall_turns]
+    return [turns[turn_number] for turn_number in sorted(best)]
+
+
+# If the context sent with each request has grown past the token budget, build the request that folds every
+# turn except the most recent ones into the rolling summary.  Only the newly folded turns are sent to the LLM
+# along with the previous summary, so the cost of compaction does not grow with the length of the session.
+# Returns the request arguments and the number of turns the new summary covers, or None if no compaction is needed.
+def compaction_request(context: list, context_summary: dict, budget: int, recent_turns: int):
+    if budget <= 0:
+        return None
+    if estimate_context_tokens(build_request_context(context, context_summary)) <= budget:
+        return None
+    turns = [entry for entry in context if entry[0] not in PINNED_CONTEXT_ENTRIES]
+    fold_until = len(turns) - recent_turns
+    if fold_until <= context_summary['turns']:
+        return None
+
+    transcript = ''
+    for entry in turns[context_summary['turns']:fold_until]:
+        transcript += f'Player: {entry[0]}\nGame: {entry[1]}\n\n'
+    summary_prompt = f"Summary so far:\n{context_summary['summary']}\n\nNew turns:\n{transcript}"
+    request = {
+        'system_prompt': summary_rules,
+        'user_prompt': summary_prompt,
+        'second_system_prompt': None,
+        'schema': summary_schema,
+        'max_tokens': 2000,
+        'call_type': 'summary'
+    }
+    return request, fold_until
+
+
+def apply_compaction(context_summary: dict, result: dict, fold_until: int):
+    context_summary['summary'] = json.loads(result['message']['content'])['summary']
+    context_summary['turns'] = fold_until
+
+
+@tracing.traced('compact_context')
+def compact_context(context: list, context_summary: dict, budget: int, recent_turns: int):
+    compaction = compaction_request(context, context_summary, budget, recent_turns)
+    if compaction:
+        request, fold_until = compaction
+        apply_compaction(context_summary, make_structured_request(**request), fold_until)
+
+
+# Request that parses the text of a player file into a character sheet
+def player_parse_request(player_text: str) -> dict:
+    return {
+        'system_prompt': character_rules,
+        'user_prompt': player_text,
+        'second_system_prompt': None,
+        'schema': character_schema,
+        'max_tokens': 2000,
+        'call_type': 'player_parse',
+        'cached': True
+    }
+
+
+# Request that determines the initial game state from the text in the scenario file
+def scenario_parse_request(player: dict, scenario_text: str, player_text: str) -> dict:
+    return {
+        'system_prompt': state_change_rules + '\n' + compact_json(player),
+        'user_prompt': scenario_text + '\n' + player_text,
+        'second_system_prompt': None,
+        'schema': game_state_schema,
+        'max_tokens': 5000,
+        'call_type': 'scenario_parse',
+        'cached': True,
+        # A truncated game state can still take the player from the parsed character sheet
+        'previous': {'player': player}
+    }
+
+
+# Set up the session's world from the parsed scenario: the initial game state and the pinned context entries
+def start_scenario(session: GameSession, scenario_text: str, initial_state_response: dict):
+    session.game_state = json.loads(initial_state_response['message']['content'])
+    session.context.append(('Game World', scenario_text))
+    session.context.append(('Player', session.player_text))
+
+
+def read_player_file(session: GameSession, player_file: str):
     file_content = None
     try:
         with open(player_file, 'r') as file:
@@ -668,14 +2312,11 @@ def read_player_file(player_file: str):
         print(f"The player file at {player_file} was not found.")
         exit(0)
     
-    player_response = make_structured_request(character_rules, file_content, None, character_schema, 2000, [])
-    player = json.loads(player_response['message']['content'])
-    player_text = file_content
-
-def read_scenario_file(scenario_file: str):
-    global context
-    global game_state
+    player_response = make_structured_request(**player_parse_request(file_content))
+    session.player = json.loads(player_response['message']['content'])
+    session.player_text = file_content
 
+def read_scenario_file(session: GameSession, scenario_file: str):
     file_content = None
     try:
         with open(scenario_file, 'r') as file:
@@ -685,28 +2326,81 @@ def read_scenario_file(scenario_file: str):
         exit(0)
     
     # Make an LLM call to determine the initial game state from the text in the scenario file
-    initial_state_response = make_structured_request(state_change_rules + '\n' + json.dumps(player, indent=4), file_content + '\n' + player_text, None, game_state_schema, 5000, [])
-    #initial_state_response = make_structured_request(state_change_rules + '\n' + json.dumps(player, indent=4), file_content + '\n' + player_text, None, None, 5000, [])
-    game_state = json.loads(initial_state_response['message']['content'])
-    context.append(('Game World', file_content))
-    context.append(('Player', player_text))
+    initial_state_response = make_structured_request(**scenario_parse_request(session.player, file_content, session.player_text))
+    start_scenario(session, file_content, initial_state_response)
+
+
+# Dice.  Expressions in the common NdM+K form (any sum of dice and constants, e.g. '1d20+5' or '2d6 + 1d4 - 1')
+# are compiled once into their terms and rolled with NumPy, as many times as needed in one call.  Anything
+# else, such as '4d6kh3', is rolled by d20.  seed_dice seeds both, so that a session can be reproduced.
+# The LLM writes the expressions, so anything d20 would refuse (more than its 1000 dice in one roll) or with
+# numbers too large to add up in 64 bits is also left to d20, which reports it as a RollError.
+DICE_EXPRESSION = re.compile(r'[+-]?(\d*d\d+|\d+)([+-](\d*d\d+|\d+))*')
+DICE_TERM = re.compile(r'([+-]?)(?:(\d*)d(\d+)|(\d+))')
+DICE_CACHE_SIZE = 1024
+DICE_MAX_ROLLS = 1000
+DICE_MAX_VALUE = 2 ** 31
+
+dice_rng = numpy.random.default_rng()
+# Compiled dice expressions: (constant, [(count, sides, sign)]), or None for expressions only d20 can roll
+compiled_dice = {}
+
+
+def seed_dice(seed: int):
+    global dice_rng
+
+    dice_rng = numpy.random.default_rng(seed)
+    random.seed(seed)
+
+
+def compile_dice(dice_to_roll: str):
+    if dice_to_roll in compiled_dice:
+        return compiled_dice[dice_to_roll]
+    expression = dice_to_roll.replace(' ', '')
+    compiled = None
+    if DICE_EXPRESSION.fullmatch(expression):
+        constant = 0
+        dice = []
+        for sign, count, sides, number in DICE_TERM.findall(expression):
+            sign = -1 if sign == '-' else 1
+            if number:
+                constant += sign * int(number)
+            else:
+                dice.append((int(count or 1), int(sides), sign))
+        # d20 reports zero-sided dice as an error
+        if (all(0 < sides <= DICE_MAX_VALUE for _, sides, _ in dice) and sum(count for count, _, _ in dice) <= DICE_MAX_ROLLS
+                and abs(constant) <= DICE_MAX_VALUE):
+            compiled = (constant, dice)
+    if len(compiled_dice) >= DICE_CACHE_SIZE:
+        compiled_dice.clear()
+    compiled_dice[dice_to_roll] = compiled
+    return compiled
+
+
+# Roll a dice expression the given number of times and return the totals
+def roll_dice_batch(dice_to_roll: str, rolls: int) -> list:
+    compiled = compile_dice(dice_to_roll)
+    if compiled is None:
+        return [d20.roll(dice_to_roll).total for _ in range(rolls)]
+    constant, dice = compiled
+    totals = numpy.full(rolls, constant)
+    for count, sides, sign in dice:
+        totals += sign * dice_rng.integers(1, sides, size=(rolls, count), endpoint=True).sum(axis=1)
+    return totals.tolist()
 
 
 # Roll dice, taking into account advantage and disadvantage 
 def roll_dice(dice_to_roll: str, advantage: bool, disadvantage: bool) -> int:
-    result = d20.roll(dice_to_roll).total
+    rolls = roll_dice_batch(dice_to_roll, 1 + advantage + disadvantage)
+    result = rolls[0]
     if advantage:
-        result2 = d20.roll(dice_to_roll).total
-        if result2 > result:
-            result = result2
+        result = max(result, rolls[1])
     if disadvantage:
-        result2 = d20.roll(dice_to_roll).total
-        if result2 < result:
-            result = result2
+        result = min(result, rolls[-1])
     return result
 
 
-def generate_save_filename(character_name):
+def generate_save_filename(character_name, extension='.sav'):
     # Convert the character name to lowercase and replace spaces with underscores
     formatted_name = character_name.lower().replace(" ", "_")
     
@@ -717,128 +2411,1147 @@ def generate_save_filename(character_name):
     timestamp = now.strftime("%Y%m%d_%H%M%S")
     
     # Combine the formatted name and timestamp
-    return f"{formatted_name}_{timestamp}.sav"
+    return f"{formatted_name}_{timestamp}{extension}"
 
-# Save the game by recording the player sheet, game state, and game context
-def save_game(player: dict, game_state: dict, context: list) -> str:
+# Convert the player sheet, game state, and game context to the JSON structure used by save files
+def game_to_json(player: dict, game_state: dict, context: list, context_summary: dict = None, world: dict = None) -> dict:
     json_save = {
         'player': player,
         'game_state': game_state,
         'context': []
     }
+    if context_summary:
+        json_save['context_summary'] = context_summary
+    if world:
+        json_save['world'] = world
     for context_entry in context:
         json_entry = {
             'player': context_entry[0],
             'game': context_entry[1]
         }
         json_save['context'].append(json_entry)
-    filename = generate_save_filename(player['Name'])
+    return json_save
+
+
+# Save the game by recording the player sheet, game state, and game context
+def save_game(player: dict, game_state: dict, context: list, context_summary: dict = None, filename: str = None, world: dict = None) -> str:
+    json_save = game_to_json(player, game_state, context, context_summary, world)
+    filename = filename or generate_save_filename(player['Name'])
     with open(filename, 'w') as f:
         json.dump(json_save, f, indent=4)
 
     return filename
 
-def load_game(filename: str) -> str:
-    global player
-    global game_state
-    global context
 
-    saved_game = None
-    with open(filename, 'r') as f:
-        saved_game = json.load(f)
-    player = saved_game['player']
-    game_state = saved_game['game_state']
-    context = []
+# Write a session to a file in save file format, without indentation to keep it quick.  The game server uses this
+# to spill idle sessions to disk.
+def save_session(session: GameSession, filename: str):
+    json_save = game_to_json(session.player, session.game_state, session.context, session.context_summary, session.world)
+    json_save['turns_since_resync'] = session.turns_since_resync
+    temp_filename = f'{filename}.tmp'
+    with open(temp_filename, 'w') as f:
+        json.dump(json_save, f, separators=(',', ':'))
+    os.replace(temp_filename, filename)
+
+
+# Make a game in save file format the session's current game
+def restore_game(session: GameSession, saved_game: dict):
+    # Don't let a background update from the current game overwrite the restored state
+    finish_state_update(session, False)
+
+    session.player = saved_game['player']
+    session.game_state = saved_game['game_state']
+    session.context = []
     for context_entry in saved_game['context']:
         new_entry = (context_entry['player'], context_entry['game'])
-        context.append(new_entry)
-
-    print('Game loaded')
-    print()
-    print(context[-1][1])
+        session.context.append(new_entry)
+    session.context_summary = saved_game.get('context_summary', {'summary': '', 'turns': 0})
+    session.history_index = None
+    session.world = saved_game.get('world', {})
+    session.turns_since_resync = saved_game.get('turns_since_resync', 0)
+    session.failed_turn = None
+    # The autosave journal now follows the restored game
+    if session.journal:
+        write_journal_snapshot(session)
+
+
+def load_game(session: GameSession, filename: str, autosave: bool = False) -> str:
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if autosave:
+        # The session switches to autosaving to the loaded journal, or to a new one, so the current journal is done
+        close_journal(session)
+    if data.startswith(JOURNAL_HEADER):
+        saved_game, records, journal_length = read_journal(data)
+        restore_game(session, saved_game)
+        if autosave:
+            # Carry on appending to the same journal rather than writing a new snapshot
+            resume_journal(session, filename, records, journal_length)
+    else:
+        restore_game(session, json.loads(data))
+        if autosave:
+            start_journal(session, generate_save_filename(session.player['Name'], '.journal'))
 
     # Return the response we just sent to the player.
-    return context[-1][1]
+    return session.context[-1][1]
+
+
+# Autosave journals.  A journal starts with a snapshot of the game in save file format, on one line, followed by
+# one line per record of what changed since: new context entries, patches to the game state and world registry,
+# and the context summary and resync counter when they change.  Each record is fsynced as it is written, so autosaving every
+# turn costs one small append rather than rewriting the whole game.  Every journal_snapshot_records records the
+# journal is rewritten as a fresh snapshot, which keeps resuming (read the snapshot, replay the tail) quick.
+JOURNAL_FORMAT = 'lldm-journal'
+JOURNAL_VERSION = 1
+# Journals are told apart from save files by how the snapshot line starts
+JOURNAL_HEADER = b'{"format":"lldm-journal"'
+journal_snapshot_records = DEFAULT_JOURNAL_SNAPSHOT_RECORDS
+
+
+# The changes between two game states, as a list of [path, value] to set and [path] to delete.  Dictionaries
+# are compared key by key; anything else that changed is replaced whole.
+def state_patch(old: dict, new: dict, path: list = []) -> list:
+    patch = []
+    for key, value in new.items():
+        if key in old and old[key] == value:
+            continue
+        if key in old and isinstance(old[key], dict) and isinstance(value, dict):
+            patch += state_patch(old[key], value, path + [key])
+        else:
+            patch.append([path + [key], value])
+    for key in old:
+        if key not in new:
+            patch.append([path + [key]])
+    return patch
+
+
+def apply_state_patch(state: dict, patch: list):
+    for change in patch:
+        target = state
+        for key in change[0][:-1]:
+            target = target[key]
+        if len(change) == 2:
+            target[change[0][-1]] = change[1]
+        else:
+            del target[change[0][-1]]
+
+
+# Rebuild the game from the contents of a journal.  Returns the game in save file format, the number of records
+# after the snapshot, and the length of the journal up to the last complete record.  A record cut short by a
+# crash is ignored.
+def read_journal(data: bytes):
+    lines = data.split(b'\n')
+    snapshot = json.loads(lines[0])
+    if snapshot.get('version') != JOURNAL_VERSION:
+        raise ValueError(f'not a version {JOURNAL_VERSION} journal')
+    length = len(lines[0]) + 1
+    records = 0
+    # The last element is whatever follows the final newline, which is empty unless a write was interrupted
+    for line in lines[1:-1]:
+        try:
+            record = json.loads(line)
+        except ValueError:
+            break
+        snapshot['context'] += [{'player': entry[0], 'game': entry[1]} for entry in record.get('context', [])]
+        apply_state_patch(snapshot['game_state'], record.get('state', []))
+        apply_state_patch(snapshot.setdefault('world', {}), record.get('world', []))
+        if 'context_summary' in record:
+            snapshot['context_summary'] = record['context_summary']
+        if 'turns_since_resync' in record:
+            snapshot['turns_since_resync'] = record['turns_since_resync']
+        records += 1
+        length += len(line) + 1
+    return snapshot, records, length
+
+
+# Remember what has been written to the journal, so that the next record only holds what changed since.
+# The game state, summary and resync counter are left alone while a state update is pending.
+def track_journal(session: GameSession, include_state: bool):
+    journal = session.journal
+    journal['context_length'] = len(session.context)
+    if include_state:
+        journal['game_state'] = copy.deepcopy(session.game_state)
+        journal['world'] = copy.deepcopy(session.world)
+        journal['context_summary'] = dict(session.context_summary)
+        journal['turns_since_resync'] = session.turns_since_resync
+
+
+def write_journal_snapshot(session: GameSession):
+    journal = session.journal
+    snapshot = {
+        'format': JOURNAL_FORMAT,
+        'version': JOURNAL_VERSION
+    }
+    snapshot.update(game_to_json(session.player, session.game_state, session.context, session.context_summary, session.world))
+    snapshot['turns_since_resync'] = session.turns_since_resync
+    temp_filename = f"{journal['filename']}.tmp"
+    with open(temp_filename, 'wb') as f:
+        f.write(json.dumps(snapshot, separators=(',', ':')).encode() + b'\n')
+        f.flush()
+        os.fsync(f.fileno())
+    if journal['file']:
+        journal['file'].close()
+    os.replace(temp_filename, journal['filename'])
+    journal['file'] = open(journal['filename'], 'ab')
+    journal['records'] = 0
+    track_journal(session, True)
+
+
+# Start autosaving the session to a new journal
+def start_journal(session: GameSession, filename: str):
+    session.journal = {
+        'filename': filename,
+        'file': None
+    }
+    write_journal_snapshot(session)
 
-# Determine whether the next action will succeeed or fail, using the LLM to do most of the work
-# Returns two values:
-# message indicates the success message to append to the next prompt
-# command will be set if the user's request was a special command (e.g. saving the game, turning debug mode on or off)
-def llm_action_response(command: str, debug: bool):
-    global debug_mode
-    global player
-    global game_state
-    global context
 
-    # Determine what die roll to make
-    result = make_structured_request(action_rules + json.dumps(player, indent=4) + json.dumps(game_state, indent=4), command, None, round_schema, 5000, context)
-    actions = json.loads(result['message']['content'])
-    if debug:
-        print(json.dumps(actions, indent=4))
+# Carry on autosaving to the journal the session was just loaded from
+def resume_journal(session: GameSession, filename: str, records: int, length: int):
+    with open(filename, 'r+b') as f:
+        f.truncate(length)
+    session.journal = {
+        'filename': filename,
+        'file': open(filename, 'ab'),
+        'records': records
+    }
+    track_journal(session, True)
+
+
+# Stop autosaving the session and close its journal, if it has one
+def close_journal(session: GameSession):
+    if session.journal and session.journal['file']:
+        session.journal['file'].close()
+    session.journal = None
+
+
+# Append what changed since the last autosave to the session's journal, if it has one
+def autosave(session: GameSession):
+    journal = session.journal
+    if not journal:
+        return
+    record = {}
+    if len(session.context) > journal['context_length']:
+        record['context'] = [list(entry) for entry in session.context[journal['context_length']:]]
+    # A pending state update may still be changing these in the background; they are saved when it finishes
+    include_state = not session.pending_state_update
+    if include_state:
+        patch = state_patch(journal['game_state'], session.game_state)
+        if patch:
+            record['state'] = patch
+        patch = state_patch(journal['world'], session.world)
+        if patch:
+            record['world'] = patch
+        if session.context_summary != journal['context_summary']:
+            record['context_summary'] = session.context_summary
+        if session.turns_since_resync != journal['turns_since_resync']:
+            record['turns_since_resync'] = session.turns_since_resync
+    if not record:
+        return
+
+    if journal['records'] >= journal_snapshot_records and include_state:
+        write_journal_snapshot(session)
+        return
+    journal['file'].write(json.dumps(record, separators=(',', ':')).encode() + b'\n')
+    journal['file'].flush()
+    os.fsync(journal['file'].fileno())
+    journal['records'] += 1
+    track_journal(session, include_state)
+
+# Game commands that control the game itself, and the phrases that invoke them.  These are recognized locally
+# by parse_game_command before any LLM call; the action resolution request can still identify them as a fallback.
+game_commands = {
+    'debug_mode_on': ['debug on', 'debug mode on', 'turn on debug', 'turn on debug mode', 'turn debug mode on', 'enable debug', 'enable debug mode'],
+    'debug_mode_off': ['debug off', 'debug mode off', 'turn off debug', 'turn off debug mode', 'turn debug mode off', 'disable debug', 'disable debug mode'],
+    'save_game': ['save', 'save game', 'save the game', 'save my game'],
+    'load_game': ['load', 'load game', 'load the game', 'restore', 'restore game', 'restore the game'],
+    'quit_game': ['quit', 'quit game', 'quit the game', 'exit game', 'exit the game'],
+    'show_status': ['status', 'stats', 'show status', 'character sheet', 'show character sheet'],
+    'show_inventory': ['inventory', 'inv', 'show inventory', 'list inventory']
+}
 
-    # Check for game commands and handle them here
-    if len(actions) >= 1:
-        command = actions['actions'][0]['action_type']
-        if command == 'debug_mode_on':
-            debug_mode = True
-            print('Debug mode on')
-            return None
-        if command == 'debug_mode_off':
-            debug_mode = False
-            print('Debug mode off')
+# Commands that take an argument, such as the file name in 'load mygame.sav' or 'load mygame.journal'
+argument_commands = {
+    'load': 'load_game',
+    'restore': 'load_game'
+}
+SAVE_FILE_EXTENSIONS = ('.sav', '.journal')
+
+# Fuzzy matching catches typos like 'sav game' or 'quitt'.  It compares word by word against phrases with the
+# same number of words, so that in-game actions like 'exit gate' are not mistaken for game commands.
+# Quitting is never fuzzy matched; a misheard quit is worse than an extra round-trip to the LLM.
+# A single word is matched more strictly, since a word one letter off a command is often just another word
+# ('statue' is not 'status'): only a dropped, extra or swapped letter counts, and only in command words of at
+# least FUZZY_MATCH_MIN_LENGTH letters.
+FUZZY_MATCH_CUTOFF = 0.8
+FUZZY_MATCH_MIN_LENGTH = 5
+FUZZY_MATCH_EXCLUDED = ['quit_game']
+
+
+# Whether word is target with one letter dropped, added, or swapped with the next one
+def single_typo(word: str, target: str) -> bool:
+    if len(target) < FUZZY_MATCH_MIN_LENGTH or word == target:
+        return False
+    if len(word) == len(target):
+        differences = [i for i in range(len(word)) if word[i] != target[i]]
+        return (len(differences) == 2 and differences[1] == differences[0] + 1
+                and word[differences[0]] == target[differences[1]] and word[differences[1]] == target[differences[0]])
+    shorter, longer = sorted([word, target], key=len)
+    if len(longer) - len(shorter) != 1:
+        return False
+    return any(longer[:i] + longer[i + 1:] == shorter for i in range(len(longer)))
+
+
+def fuzzy_phrase_match(words: list, phrase: str) -> bool:
+    phrase_words = phrase.split()
+    if len(words) != len(phrase_words):
+        return False
+    if len(words) == 1:
+        return single_typo(words[0], phrase_words[0])
+    return all(difflib.SequenceMatcher(None, word, phrase_word).ratio() >= FUZZY_MATCH_CUTOFF for word, phrase_word in zip(words, phrase_words))
+
+
+# Recognize a game command locally.  Returns a (command, argument) tuple, or None if this should go to the LLM.
+def parse_game_command(command: str):
+    normalized = ' '.join(re.sub(r"[^a-z0-9_.\-/\\ ]", ' ', command.lower()).split())
+    if not normalized:
+        return None
+
+    aliases = {alias: game_command for game_command, phrases in game_commands.items() for alias in phrases}
+    if normalized in aliases:
+        return (aliases[normalized], '')
+
+    words = normalized.split(' ', 1)
+    if words[0] in argument_commands and len(words) > 1 and words[1].endswith(SAVE_FILE_EXTENSIONS):
+        return (argument_commands[words[0]], command.strip().split(' ', 1)[1].strip())
+
+    matches = [alias for alias in aliases if aliases[alias] not in FUZZY_MATCH_EXCLUDED and fuzzy_phrase_match(normalized.split(), alias)]
+    if len(set(aliases[match] for match in matches)) == 1:
+        return (aliases[matches[0]], '')
+
+    # Anything else, including input that fuzzily matches more than one command, is left to the LLM
+    return None
+
+
+# Find the most recent save file for a character
+def find_latest_save(character_name: str) -> str:
+    formatted_name = character_name.lower().replace(" ", "_")
+    save_files = sorted(glob.glob(f"{formatted_name}_*.sav") + glob.glob(f"{formatted_name}_*.journal"))
+    return save_files[-1] if save_files else None
+
+
+def format_status(state: dict) -> str:
+    sheet = state['player']
+    lines = [
+        f"{sheet['Name']}, level {sheet['Level']} {sheet['Race']} {sheet['Class']} ({sheet['Status']})",
+        f"HP: {sheet['HP']}/{sheet['Max HP']}  AC: {sheet['AC']}  XP: {sheet['XP']}  Gold: {sheet['Gold']}"
+    ]
+    for slot in sheet['Magic']['Spell Slots']:
+        lines.append(f"Level {slot['level']} spell slots: {slot['slots']}/{slot['max slots']}")
+    for effect in sheet['Spell Effects']:
+        lines.append(f"{effect['effect']} ({effect['minutes_remaining']} minutes remaining)")
+    lines.append(f"Location: {state['location']}, {state['date']} {state['time_of_day']}")
+    return '\n'.join(lines)
+
+
+def format_inventory(state: dict) -> str:
+    inventory = state['player']['Inventory']
+    if not inventory:
+        return 'You are not carrying anything.'
+    return '\n'.join(inventory)
+
+
+# Carry out a game command and return the text to show the player.  Quitting saves the game and marks the
+# session finished; it is up to the caller to end the game.
+def run_game_command(session: GameSession, command: str, argument: str, debug: bool) -> str:
+    if command == 'debug_mode_on':
+        session.debug_mode = True
+        return 'Debug mode on'
+    if command == 'debug_mode_off':
+        session.debug_mode = False
+        return 'Debug mode off'
+
+    # Everything else works from the current game state
+    finish_state_update(session, debug)
+    if command == 'save_game':
+        filename = save_game(session.player, session.game_state, session.context, session.context_summary, world=session.world)
+        return f'Game saved to file {filename}'
+    if command == 'load_game':
+        filename = argument or find_latest_save(session.player['Name'])
+        if not filename:
+            return 'No saved game found.'
+        try:
+            return 'Game loaded\n\n' + load_game(session, filename)
+        except (FileNotFoundError, ValueError, KeyError) as e:
+            return f'Could not load {filename}: {e}'
+    if command == 'quit_game':
+        filename = save_game(session.player, session.game_state, session.context, session.context_summary, world=session.world)
+        session.finished = True
+        close_journal(session)
+        return f'Game saved to file {filename}\nThank you for playing!'
+    if command == 'show_status':
+        return format_status(session.game_state)
+    if command == 'show_inventory':
+        return format_inventory(session.game_state)
+    return ''
+
+
+# Scenario packs hold everything needed to start a new game of an adventure without any LLM calls: for each
+# player, the parsed player sheet, the initial game state, the pinned context entries and the opening narration,
+# all in save file format.  Packs are compiled once with --compile_pack.
+PACK_FORMAT = 'lldm-scenario-pack'
+PACK_VERSION = 1
+
+
+# Name a player is selected by in a pack: the player file name without its extension
+def pack_player_name(player_file: str) -> str:
+    return os.path.splitext(os.path.basename(player_file))[0]
+
+
+def compile_pack(pack_file: str, scenario_file: str, player_files: list):
+    pack = {
+        'format': PACK_FORMAT,
+        'version': PACK_VERSION,
+        'scenario': os.path.basename(scenario_file),
+        'players': {}
+    }
+    for player_file in player_files:
+        print(f'Compiling {scenario_file} with {player_file}')
+        session = GameSession()
+        read_player_file(session, player_file)
+        read_scenario_file(session, scenario_file)
+        opening = turn(session, 'begin the game', False)
+        finish_state_update(session, False)
+        pack_entry = game_to_json(session.player, session.game_state, session.context, session.context_summary, session.world)
+        pack_entry['opening'] = opening
+        pack['players'][pack_player_name(player_file)] = pack_entry
+
+    with open(pack_file, 'w') as f:
+        json.dump(pack, f, indent=4)
+    print(f"Scenario pack written to {pack_file} with players: {', '.join(pack['players'])}")
+
+
+# Start a new game from a compiled scenario pack.  Returns the opening narration.
+def start_from_pack(session: GameSession, pack_file: str, player_name: str) -> str:
+    with open(pack_file, 'r') as f:
+        pack = json.load(f)
+    if pack.get('format') != PACK_FORMAT or pack.get('version') != PACK_VERSION:
+        raise ValueError(f'{pack_file} is not a version {PACK_VERSION} scenario pack')
+    if not player_name:
+        if len(pack['players']) != 1:
+            raise ValueError(f"Choose a player from the pack with --pack_player: {', '.join(pack['players'])}")
+        player_name = next(iter(pack['players']))
+    if player_name not in pack['players']:
+        raise ValueError(f"Player {player_name} is not in the pack.  Available players: {', '.join(pack['players'])}")
+
+    # Each game gets its own copy, so the pack can be reused
+    pack_entry = copy.deepcopy(pack['players'][player_name])
+    restore_game(session, pack_entry)
+    return pack_entry['opening']
+
+
+# The steps of a turn are split into building each request and handling its response, so that the same game
+# logic drives both the blocking engine below and the asyncio engine in async_engine.py.
+
+# Request that determines the actions of the upcoming turn and the dice rolls that decide them
+def action_request(session: GameSession, command: str) -> dict:
+    return {
+        'system_prompt': action_rules + '\nPlayer character sheet: ' + compact_json(session.player),
+        'user_prompt': command,
+        'second_system_prompt': None,
+        'schema': round_schema,
+        'max_tokens': 5000,
+        'conversation_context': build_request_context(session.context, session.context_summary),
+        'recalled_context': recall_turns(session, command),
+        'state_prompt': 'Current game state: ' + compact_json(session.game_state),
+        'call_type': 'action'
+    }
+
+
+# The game command identified by the action request, if the local parser did not recognize one
+def action_game_command(actions: dict) -> str:
+    if len(actions['actions']) >= 1 and actions['actions'][0]['action_type'] in game_commands:
+        return actions['actions'][0]['action_type']
+    return None
+
+
+# Perform the die rolls and return the success message to append to the narration prompt
+def resolve_actions(actions: dict) -> str:
+    message = ''
+    with tracing.span('resolve_dice', actions=len(actions['actions'])) as dice_span:
+        rolls = 0
+        for action in actions['actions']:
+            if action['dice_to_roll']:
+                try:
+                    roll = roll_dice(action['dice_to_roll'], action['advantage'], action['disadvantage'])
+                    rolls += 1
+                    if roll >= action['number_to_beat']:
+                        message += action['result_if_successful'] + "\n"
+                    else:
+                        message += action['result_if_failed'] + "\n"
+                except d20.errors.RollError as e:
+                    # on the off chance we gat bad die roll syntax, show the error but don't halt the game; just omit the action message
+                    print(f'Die roll error: {e}')
+        dice_span['attributes']['rolls'] = rolls
+    return message
+
+
+# Local fast path for routine commands.  Moving, talking and looking around out of combat need no dice, and
+# attacks and ability checks can be worked out from the character sheet and the game state with the usual
+# D&D 5th Edition rules, so these are resolved here, producing the same actions an action request would,
+# without an LLM call.  Anything the rules below are not sure about (several actions in one command, spell
+# effects or an unusual condition on the player, NPCs joining a fight, darkness, moving through any area that is
+# not safe, where a wandering encounter check is due) goes to the LLM as before.
+fast_path_enabled = True
+
+# Medium difficulty, for checks whose difficulty the command does not reveal
+FAST_PATH_CHECK_DC = 15
+
+FAST_PATH_NO_DICE_VERBS = {
+    'move': ['walk', 'go', 'head', 'move', 'travel', 'return', 'continue', 'proceed', 'enter', 'leave', 'exit', 'follow', 'approach'],
+    'talk': ['talk', 'speak', 'ask', 'greet', 'chat', 'say', 'tell', 'thank'],
+    'look': ['look', 'examine', 'inspect']
+}
+FAST_PATH_ATTACK_VERBS = ['attack', 'hit', 'strike', 'stab', 'slash', 'shoot', 'fight', 'swing']
+# A move verb only makes a move when it says where to: a direction ('go north'), a destination after one of these
+# words ('return to the inn', 'head back along the road'), or the place itself for verbs like 'enter the cave'.
+# Without one the verb may take something else as its object ('move the boulder', 'leave the sword on the
+# altar', 'go to sleep'), so the command goes to the LLM.
+FAST_PATH_DIRECTIONS = ['north', 'south', 'east', 'west', 'northeast', 'northwest', 'southeast', 'southwest', 'up', 'down', 'upstairs',
+                        'downstairs', 'in', 'inside', 'out', 'outside', 'back', 'forward', 'ahead', 'onward', 'left', 'right', 'away', 'home']
+FAST_PATH_DESTINATION_WORDS = ['to', 'into', 'toward', 'towards', 'through', 'along', 'across', 'over', 'around', 'past', 'onto']
+FAST_PATH_DETERMINERS = ['the', 'a', 'an', 'my', 'our', 'this', 'that']
+FAST_PATH_PLACE_VERBS = ['enter', 'exit', 'follow', 'approach']
+FAST_PATH_BARE_MOVES = ['continue', 'proceed', 'leave', 'exit']
+# Ordinals that pick one of several monsters with the same name, e.g. 'the second goblin' for Goblin 2
+FAST_PATH_ORDINALS = {
+    'first': '1', 'second': '2', 'third': '3', 'fourth': '4', 'fifth': '5',
+    'sixth': '6', 'seventh': '7', 'eighth': '8', 'ninth': '9', 'tenth': '10'
+}
+FAST_PATH_MULTIPLE_ACTIONS = re.compile(r"\b(and|then|while|before|after)\b|[,;]")
+
+# Words or phrases that make a command an ability check when the command starts with them, and the skill it uses
+FAST_PATH_SKILLS = {
+    'search': 'Investigation',
+    'sneak': 'Stealth',
+    'hide': 'Stealth',
+    'climb': 'Athletics',
+    'jump': 'Athletics',
+    'swim': 'Athletics',
+    'pick the lock': 'Sleight of Hand',
+    'pick a lock': 'Sleight of Hand',
+    'pickpocket': 'Sleight of Hand',
+    'persuade': 'Persuasion',
+    'convince': 'Persuasion',
+    'haggle': 'Persuasion',
+    'bargain': 'Persuasion',
+    'intimidate': 'Intimidation',
+    'threaten': 'Intimidation',
+    'bluff': 'Deception',
+    'deceive': 'Deception',
+    'listen': 'Perception',
+    'track': 'Survival'
+}
+SKILL_ABILITIES = {
+    'Athletics': 'Strength',
+    'Sleight of Hand': 'Dexterity',
+    'Stealth': 'Dexterity',
+    'Investigation': 'Intelligence',
+    'Perception': 'Wisdom',
+    'Survival': 'Wisdom',
+    'Deception': 'Charisma',
+    'Intimidation': 'Charisma',
+    'Persuasion': 'Charisma'
+}
+
+# Weapons by the name used to find them in the inventory: damage dice, whether they use Strength (melee),
+# Dexterity (ranged) or the better of the two (finesse), and whether they are simple or martial weapons
+FAST_PATH_WEAPONS = {
+    'quarterstaff': ('1d6', 'melee', 'simple'),
+    'staff': ('1d6', 'melee', 'simple'),
+    'club': ('1d4', 'melee', 'simple'),
+    'dagger': ('1d4', 'finesse', 'simple'),
+    'handaxe': ('1d6', 'melee', 'simple'),
+    'mace': ('1d6', 'melee', 'simple'),
+    'spear': ('1d6', 'melee', 'simple'),
+    'javelin': ('1d6', 'melee', 'simple'),
+    'light crossbow': ('1d8', 'ranged', 'simple'),
+    'sling': ('1d4', 'ranged', 'simple'),
+    'shortbow': ('1d6', 'ranged', 'simple'),
+    'battleaxe': ('1d8', 'melee', 'martial'),
+    'greataxe': ('1d12', 'melee', 'martial'),
+    'greatsword': ('2d6', 'melee', 'martial'),
+    'longsword': ('1d8', 'melee', 'martial'),
+    'short sword': ('1d6', 'finesse', 'martial'),
+    'shortsword': ('1d6', 'finesse', 'martial'),
+    'rapier': ('1d8', 'finesse', 'martial'),
+    'scimitar': ('1d6', 'finesse', 'martial'),
+    'warhammer': ('1d8', 'melee', 'martial'),
+    'longbow': ('1d8', 'ranged', 'martial')
+}
+
+# Conditions the fast path knows the effect of.  Any other player status, or monster status, is left to the LLM.
+FAST_PATH_PLAYER_STATUSES = ['', 'normal', 'healthy', 'alive', 'conscious', 'fine', 'ok', 'good', 'well', 'rested', 'uninjured', 'injured', 'wounded']
+FAST_PATH_HOSTILE_STATUSES = ['hostile', 'aggressive', 'attacking', 'angry', 'fighting', 'in combat', 'enraged']
+
+fast_path_stats = {
+    'commands': 0,
+    'resolved': 0,
+    # Latency of the action requests the fast path did not resolve, to estimate the time saved on the rest
+    'llm_calls': 0,
+    'llm_seconds': 0.0
+}
+
+
+def fast_path_summary() -> dict:
+    llm_calls = fast_path_stats['llm_calls']
+    return {
+        'commands': fast_path_stats['commands'],
+        'resolved': fast_path_stats['resolved'],
+        'hit_rate': fast_path_stats['resolved'] / fast_path_stats['commands'] if fast_path_stats['commands'] else None,
+        'estimated_seconds_saved': fast_path_stats['resolved'] * fast_path_stats['llm_seconds'] / llm_calls if llm_calls else None
+    }
+
+
+def ability_modifier(score: int) -> int:
+    return (score - 10) // 2
+
+
+def proficiency_bonus(level: int) -> int:
+    return 2 + (max(level, 1) - 1) // 4
+
+
+def dice_with_modifier(dice: str, modifier: int) -> str:
+    return f'{dice}{modifier:+d}' if modifier else dice
+
+
+# The command as a description of what the player will do, e.g. 'pick the lock on my chest' becomes
+# 'pick the lock on their chest'
+def player_phrase(command: str) -> str:
+    replacements = {'my': 'their', 'me': 'them', 'myself': 'themselves', 'mine': 'theirs'}
+    words = [replacements.get(word.lower(), word) for word in command.strip().rstrip('.!').split()]
+    return ' '.join(words)[:1].lower() + ' '.join(words)[1:]
+
+
+def living_monsters(state: dict) -> list:
+    return [monster for monster in state['monsters'] if monster['health'] > 0]
+
+
+# The words of a monster's name that the player may use for it, including its number, e.g. ['goblin', '2']
+def name_terms(name: str) -> set:
+    return set(term for term in re.findall(r'[a-z]+|[0-9]+', name.lower()) if term not in RECALL_STOP_WORDS)
+
+
+# The monster the command attacks, or None unless exactly one fits.  Every number in the command ('goblin 2', 'the
+# second goblin') has to be part of the monster's name, and of the monsters left the one with the most words of
+# its name in the command is the target; a tie is not certain.
+def attack_target(monsters: list, words: list) -> dict:
+    words = set(FAST_PATH_ORDINALS.get(word, word) for word in words)
+    numbers = set(word for word in words if word.isdigit())
+    scores = {}
+    for index, monster in enumerate(monsters):
+        terms = name_terms(monster['identifier'])
+        named = len(set(term for term in terms if not term.isdigit()) & words)
+        if named and numbers <= terms:
+            scores[index] = named
+    best = [index for index, score in scores.items() if score == max(scores.values())]
+    return monsters[best[0]] if len(best) == 1 else None
+
+
+# Whether a command starting with a move verb says where to go (see FAST_PATH_DIRECTIONS)
+def is_move(words: list) -> bool:
+    rest = words[1:]
+    directions = 0
+    while directions < len(rest) and rest[directions] in FAST_PATH_DIRECTIONS:
+        directions += 1
+    rest = rest[directions:]
+    if not rest:
+        return directions > 0 or words[0] in FAST_PATH_BARE_MOVES
+    if rest[0] in FAST_PATH_DETERMINERS:
+        return directions > 0 or words[0] in FAST_PATH_PLACE_VERBS
+    return rest[0] in FAST_PATH_DESTINATION_WORDS and len(rest) > 2 and rest[1] in FAST_PATH_DETERMINERS
+
+
+def local_action(action_type: str, how_to_resolve: str, dice_to_roll: str, number_to_beat: int, disadvantage: bool, result_if_successful: str, result_if_failed: str) -> dict:
+    return {
+        'action_type': action_type,
+        'how_to_resolve': how_to_resolve,
+        'advantage': False,
+        'disadvantage': disadvantage,
+        'dice_to_roll': dice_to_roll,
+        'number_to_beat': number_to_beat,
+        'result_if_successful': result_if_successful,
+        'result_if_failed': result_if_failed
+    }
+
+
+# The player's weapon attack, or None if the weapon or the target is not certain
+def local_attack(player: dict, monsters: list, words: list, dark: bool) -> dict:
+    target_monster = attack_target(monsters, words)
+    if not target_monster:
+        return None
+    target = target_monster['identifier']
+
+    # The weapon the command names, or else the first weapon in the inventory
+    inventory = ' | '.join(player['Inventory']).lower()
+    command_text = ' '.join(words)
+    named = [name for name in FAST_PATH_WEAPONS if re.search(rf'\b{name}s?\b', command_text)]
+    carried = [name for name in FAST_PATH_WEAPONS if re.search(rf'\b{name}s?\b', inventory)]
+    weapons = [name for name in named if name in carried] if named else carried
+    if not weapons:
+        return None
+    weapon = max(weapons, key=len) if named else min(weapons, key=lambda name: inventory.index(name))
+    dice, kind, category = FAST_PATH_WEAPONS[weapon]
+
+    strength = ability_modifier(player['Abilities']['Strength'])
+    dexterity = ability_modifier(player['Abilities']['Dexterity'])
+    modifier = {'melee': strength, 'ranged': dexterity, 'finesse': max(strength, dexterity)}[kind]
+    proficiencies = ' | '.join(player['Proficiencies']['Weapons']).lower()
+    proficient = f'{category} weapons' in proficiencies or weapon in proficiencies
+    attack_bonus = modifier + (proficiency_bonus(player['Level']) if proficient else 0)
+    return local_action('attack', f"Attack roll with the {weapon}: d20 + ability modifier{' + proficiency bonus' if proficient else ''} against the {target}'s AC",
+                        dice_with_modifier('1d20', attack_bonus), target_monster['AC'], dark,
+                        f"The player's {weapon} will strike the {target} for {dice_with_modifier(dice, modifier)} points of damage",
+                        f"The player's {weapon} will miss the {target}")
+
+
+# A hostile monster's attack on the player
+def local_monster_attack(monster: dict, player: dict, dark: bool) -> dict:
+    abilities = monster['abilities']
+    attack_bonus = max(ability_modifier(abilities['Strength']), ability_modifier(abilities['Dexterity'])) + proficiency_bonus(1)
+    return local_action('attack', "Attack roll: d20 + ability modifier + proficiency bonus against the player's AC",
+                        dice_with_modifier('1d20', attack_bonus), player['AC'], dark,
+                        f"The {monster['identifier']} will hit the player",
+                        f"The {monster['identifier']} will miss the player")
+
+
+def local_check(player: dict, skill: str, phrase: str, dark: bool) -> dict:
+    ability = SKILL_ABILITIES[skill]
+    proficient = skill.lower() in [known.lower() for known in player['Proficiencies']['Skills']]
+    bonus = ability_modifier(player['Abilities'][ability]) + (proficiency_bonus(player['Level']) if proficient else 0)
+    return local_action('check', f"{skill} check: d20 + {ability} modifier{' + proficiency bonus' if proficient else ''} against DC {FAST_PATH_CHECK_DC}",
+                        dice_with_modifier('1d20', bonus), FAST_PATH_CHECK_DC, dark,
+                        f'The player will {phrase}',
+                        f'The player will attempt to {phrase} but will fail')
+
+
+# Resolve a routine command locally.  Returns the actions for the turn in round_schema form, or None to ask the LLM.
+def local_actions(state: dict, command: str) -> dict:
+    # Numbers are kept, as they tell monsters with the same name apart ('goblin 2', '2nd goblin')
+    normalized = ' '.join(re.sub(r"[^a-z0-9 ,;']", ' ', re.sub(r'\b([0-9]+)(st|nd|rd|th)\b', r'\1', command.lower())).split())
+    words = normalized.replace(',', ' ').replace(';', ' ').split()
+    if not words or FAST_PATH_MULTIPLE_ACTIONS.search(normalized):
+        return None
+    player = state['player']
+    if player['Status'].lower().strip(' .') not in FAST_PATH_PLAYER_STATUSES or player['Spell Effects']:
+        return None
+    monsters = living_monsters(state)
+    phrase = player_phrase(command)
+    dark = state['dark']
+
+    if words[0] in FAST_PATH_ATTACK_VERBS:
+        # A straightforward fight: only hostile monsters, no NPCs who might join in
+        if state['NPCs'] or any(monster['status'].lower().strip(' .') not in FAST_PATH_HOSTILE_STATUSES for monster in monsters):
             return None
-        if command == 'save_game':
-            filename = save_game(player, game_state, context)
-            print(f'Game saved to file {filename}')
+        attack = local_attack(player, monsters, words, dark)
+        if not attack:
             return None
-        if command == 'quit_game':
-            filename = save_game(player, game_state, context)
-            print(f'Game saved to file {filename}')
-            print('Thank you for playing!')
-            exit(0)
+        return {'actions': [attack] + [local_monster_attack(monster, player, dark) for monster in monsters]}
+
+    # Everything else is only routine when there is nothing around to fight
+    if monsters:
+        return None
+    skills = set(skill for phrase, skill in FAST_PATH_SKILLS.items() if re.match(rf'{phrase}\b', normalized))
+    if len(skills) > 1:
+        return None
+    if skills:
+        return {'actions': [local_check(player, skills.pop(), phrase, dark)]}
+    for action_type, verbs in FAST_PATH_NO_DICE_VERBS.items():
+        if words[0] in verbs:
+            # Moving in the dark takes a check, and moving anywhere that is not safe a wandering encounter check
+            # (even low danger areas roll for one)
+            if action_type == 'move' and (dark or state['danger'] != 'safe' or not is_move(words)):
+                return None
+            # Looking for something is a search, which takes a check
+            if action_type == 'look' and 'for' in words:
+                return None
+            return {'actions': [local_action(action_type, 'No die roll is necessary', '', 0, False, f'The player will {phrase}', f'The player will not {phrase}')]}
+    return None
+
+
+# The actions for a command from the fast path, or None if it has to go to the LLM
+def fast_path_actions(session: GameSession, command: str) -> dict:
+    if not fast_path_enabled:
+        return None
+    fast_path_stats['commands'] += 1
+    try:
+        actions = local_actions(session.game_state, command)
+    except (KeyError, TypeError, AttributeError):
+        # A game state without the fields the rules need is left to the LLM
+        actions = None
+    if actions:
+        fast_path_stats['resolved'] += 1
+        tracing.set_attributes(fast_path=True)
+    return actions
+
+
+def record_action_call(seconds: float):
+    fast_path_stats['llm_calls'] += 1
+    fast_path_stats['llm_seconds'] += seconds
+
+
+# Request that narrates the turn to the player and describes it for the DM
+def narration_request(session: GameSession, command: str, success_message: str) -> dict:
+    if merged_turn(session):
+        return {
+            'system_prompt': game_rules + '\n' + response_rules + merged_response_rules,
+            'user_prompt': command,
+            'second_system_prompt': success_message,
+            'schema': merged_response_schema,
+            'max_tokens': 5000,
+            'conversation_context': build_request_context(session.context, session.context_summary),
+            'recalled_context': recall_turns(session, command),
+            'state_prompt': 'Current game state: ' + compact_json(session.game_state),
+            'call_type': 'narration_state'
+        }
+    return {
+        'system_prompt': game_rules + '\n' + response_rules,
+        'user_prompt': command,
+        'second_system_prompt': success_message,
+        'schema': response_schema,
+        'max_tokens': 5000,
+        'conversation_context': build_request_context(session.context, session.context_summary),
+        'recalled_context': recall_turns(session, command),
+        'state_prompt': 'Current game state: ' + compact_json(session.game_state),
+        'call_type': 'narration'
+    }
+
+
+# Apply the state change that came back with the narration of a merged turn.  Returns False if it could not be
+# applied, in which case the turn falls back to a separate state update.
+def apply_narrated_state_change(session: GameSession, change: dict, debug: bool) -> bool:
+    if debug:
+        print(json.dumps(change, indent=4))
+    new_state = copy.deepcopy(session.game_state)
+    try:
+        apply_state_change(new_state, change)
+    except (KeyError, TypeError, ValueError) as e:
+        print(f'Could not apply state change, requesting a state update: {e}')
+        return False
+    session.game_state = page_world(session, session.game_state, new_state, debug)
+    session.turns_since_resync += 1
+    return True
+
+
+# World registry.  Only the NPCs and monsters at the player's current location are kept in the game state, which
+# is sent with every request and regenerated on resync.  When the player moves on, the entities left behind are
+# stored in the session's world registry, keyed by location and then by name or identifier, as compact JSON.
+# They are put back into the game state when the player returns, so that prompt and state update size follow
+# the scene rather than the whole campaign.
+WORLD_ENTITY_KINDS = {
+    'NPCs': ('Name', 'HP'),
+    'monsters': ('identifier', 'health')
+}
+
+
+def location_key(location: str) -> str:
+    return ' '.join(location.lower().split())
+
+
+# Page entities in and out of the game state after a state update moved the player.  Entities the update
+# dropped are stored under the location being left, unless they died; entities stored for the new location
+# are restored, replacing any the update made up with the same name.  Returns the new state.
+def page_world(session: GameSession, old_state: dict, new_state: dict, debug: bool) -> dict:
+    old_location = location_key(old_state.get('location', ''))
+    new_location = location_key(new_state.get('location', ''))
+    if old_location == new_location:
+        return new_state
+
+    paged_out = 0
+    paged_in = 0
+    for kind, (key_field, health_field) in WORLD_ENTITY_KINDS.items():
+        present = {entity[key_field].lower() for entity in new_state[kind]}
+        for entity in old_state[kind]:
+            if entity[key_field].lower() not in present and entity[health_field] > 0:
+                session.world.setdefault(old_location, {}).setdefault(kind, {})[entity[key_field].lower()] = compact_json(entity)
+                paged_out += 1
+
+        stored = session.world.get(new_location, {}).pop(kind, {})
+        if stored:
+            new_state[kind] = [entity for entity in new_state[kind] if entity[key_field].lower() not in stored]
+            new_state[kind] += [json.loads(entity) for entity in stored.values()]
+            paged_in += len(stored)
+    if new_location in session.world and not session.world[new_location]:
+        del session.world[new_location]
+    if debug and (paged_out or paged_in):
+        print(f'World registry: {paged_out} entities left at {old_location}, {paged_in} restored at {new_location}')
+    return new_state
+
+
+# Whether the next state update regenerates the full game state rather than requesting a delta
+def needs_resync(session: GameSession) -> bool:
+    return state_update_mode == 'full' or (state_resync_turns > 0 and session.turns_since_resync + 1 >= state_resync_turns)
+
+
+# Whether the narration of the next turn also carries its state change.  Resync turns are played the usual way.
+def merged_turn(session: GameSession) -> bool:
+    return state_update_mode == 'merged' and not needs_resync(session)
+
+
+# How far the game state built up from deltas has drifted: every time the full state is regenerated, the number
+# of fields that differ from the state it replaces.  This includes the changes from the turn itself.
+state_drift_stats = {
+    'resyncs': 0,
+    'changed_fields': 0
+}
+
+
+def record_resync(state: dict, new_state: dict):
+    state_drift_stats['resyncs'] += 1
+    state_drift_stats['changed_fields'] += len(state_patch(state, new_state))
+
+
+# Request for the state change after a turn, or for the full new game state when resyncing
+def state_update_request(state: dict, DM_response: str, resync: bool) -> dict:
+    if resync:
+        return {
+            'system_prompt': game_rules + '\n' + state_change_rules,
+            'user_prompt': DM_response,
+            'second_system_prompt': None,
+            'schema': game_state_schema,
+            'max_tokens': 5000,
+            'state_prompt': 'Current game state: ' + compact_json(state),
+            'call_type': 'state_update',
+            'previous': state
+        }
+    return {
+        'system_prompt': game_rules + '\n' + state_change_rules + state_delta_rules,
+        'user_prompt': DM_response,
+        'second_system_prompt': None,
+        'schema': state_delta_schema,
+        'max_tokens': 2000,
+        'state_prompt': 'Current game state: ' + compact_json(state),
+        'call_type': 'state_delta'
+    }
+
+
+# Work out the new game state from the response to a state update request
+def apply_state_update(state: dict, result: dict, resync: bool, debug: bool) -> dict:
+    if resync:
+        return json.loads(result['message']['content'])
+    change = json.loads(result['message']['content'])
+    if debug:
+        print(json.dumps(change, indent=4))
+    new_state = copy.deepcopy(state)
+    apply_state_change(new_state, change)
+    return new_state
+
+
+# Determine whether the next action will succeeed or fail, using the LLM to do most of the work
+# Returns the success message to append to the next prompt, or None if the user's request was a special
+# command (e.g. saving the game, turning debug mode on or off)
+@tracing.traced('llm_action_response')
+def llm_action_response(session: GameSession, command: str, debug: bool):
+    # The action request needs the game state as of the end of the previous turn
+    finish_state_update(session, debug)
+
+    # Determine what die roll to make, locally for routine commands
+    actions = fast_path_actions(session, command)
+    if actions is None:
+        start = time.perf_counter()
+        result = make_structured_request(**action_request(session, command))
+        record_action_call(time.perf_counter() - start)
+        actions = json.loads(result['message']['content'])
+    if debug:
+        print(json.dumps(actions, indent=4))
+
+    # Check for game commands the local parser did not recognize and handle them here
+    game_command = action_game_command(actions)
+    if game_command:
+        print(run_game_command(session, game_command, '', debug))
+        return None
 
     # Perform the die roll and see if we beat the target
-    message = ''
-    for action in actions['actions']:
-        if action['dice_to_roll']:
-            try:
-                roll = roll_dice(action['dice_to_roll'], action['advantage'], action['disadvantage'])
-                if roll >= action['number_to_beat']:
-                    message += action['result_if_successful'] + "\n"
-                else:
-                    message += action['result_if_failed'] + "\n"
-            except d20.errors.RollSyntaxError as e:
-                # on the off chance we gat bad die roll syntax, show the error but don't halt the game; just omit the action message
-                print(f'Die roll error: {e}')
-    return message
+    return resolve_actions(actions)
 
 
-def turn(command: str, debug: bool) -> str:
-    global game_state
-    global context
+# Apply the response to a state update request and return the new game state
+def finish_game_state_update(session: GameSession, state: dict, result: dict, resync: bool, debug: bool) -> dict:
+    new_state = apply_state_update(state, result, resync, debug)
+    if resync:
+        session.turns_since_resync = 0
+        record_resync(state, new_state)
+    else:
+        session.turns_since_resync += 1
+    return page_world(session, state, new_state, debug)
 
-    # Determine success or failure of all actions on the upcoming turn
-    success_message = llm_action_response(command, debug)
-    if success_message is None:
-        return 'Game command'
 
-    # Perform the action
+# Work out how the game state changed from the DM's description of the turn and return the new game state.
+# In delta mode only the changes are requested and applied locally; the full state is regenerated periodically
+# to resync, and whenever a delta cannot be applied.
+@tracing.traced('state_update')
+def update_game_state(session: GameSession, state: dict, DM_response: str, debug: bool) -> dict:
+    if not needs_resync(session):
+        try:
+            delta_response = make_structured_request(**state_update_request(state, DM_response, False))
+            return finish_game_state_update(session, state, delta_response, False, debug)
+        except (KeyError, TypeError, ValueError) as e:
+            print(f'Could not apply state change, regenerating the game state: {e}')
+
+    new_state_response = make_structured_request(**state_update_request(state, DM_response, True))
+    return finish_game_state_update(session, state, new_state_response, True, debug)
+
+
+# Background half of a pipelined turn: update the game state, then compact the context if needed
+def run_state_update(session: GameSession, state: dict, DM_response: str) -> dict:
+    new_state = update_game_state(session, state, DM_response, False)
+    try:
+        compact_context(session.context, session.context_summary, context_budget, context_recent_turns)
+    except (requests.RequestException, KeyError, ValueError) as e:
+        print(f'Context compaction failed: {e}')
+    return new_state
+
+
+def start_state_update(session: GameSession, state: dict, DM_response: str):
+    global state_update_executor
+
+    if not state_update_executor:
+        state_update_executor = ThreadPoolExecutor(max_workers=1)
+    session.pending_state_update = {
+        'future': state_update_executor.submit(contextvars.copy_context().run, run_state_update, session, state, DM_response),
+        'state': state,
+        'DM_response': DM_response
+    }
+
+
+# Leave a failed state update pending, so that it is retried before the next turn needs the game state
+def defer_state_update(session: GameSession, state: dict, DM_response: str, error: Exception):
+    future = Future()
+    future.set_exception(error)
+    session.pending_state_update = {
+        'future': future,
+        'state': state,
+        'DM_response': DM_response
+    }
+
+
+# Wait for the pending background state update, if any, and make it the current game state.  If the update
+# failed it is retried once in the foreground; if that fails too the game carries on with the previous state.
+def finish_state_update(session: GameSession, debug: bool):
+    if not session.pending_state_update:
+        return
+    pending = session.pending_state_update
+    session.pending_state_update = None
+    try:
+        new_state = pending['future'].result()
+    except (requests.RequestException, KeyError, ValueError) as e:
+        print(f'Background state update failed, retrying: {e}')
+        try:
+            new_state = update_game_state(session, pending['state'], pending['DM_response'], debug)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            print(f'State update failed, keeping the previous game state: {e}')
+            return
+    session.game_state = new_state
+    autosave(session)
     if debug:
-        print(success_message)
-    result = make_structured_request(game_rules + '\n' + json.dumps(game_state, indent=4) + '\n' + response_rules, command, success_message, response_schema, 5000, context)
+        print(json.dumps(session.game_state, indent=4))
+
+
+# The success message already rolled for the command, if the player is retrying a turn that failed after its
+# dice were rolled
+def retried_turn(session: GameSession, command: str) -> str:
+    if session.failed_turn and session.failed_turn['command'] == command:
+        return session.failed_turn['success_message']
+    session.failed_turn = None
+    return None
+
+
+# Remember the rolled dice until the turn has been narrated, so that a retry cannot reroll them.  Returns the
+# narration request.
+def start_narration(session: GameSession, command: str, success_message: str) -> dict:
+    session.failed_turn = {
+        'command': command,
+        'success_message': success_message
+    }
+    return narration_request(session, command, success_message)
+
+
+# Record the narration of a turn in the context and apply any state change it carries.  Returns the player and
+# DM responses and whether the game state has already been updated.
+def finish_narration(session: GameSession, command: str, result: dict, debug: bool):
     full_response = json.loads(result['message']['content'])
     player_response = full_response['player_response']
     DM_response = full_response['DM_response']
+    session.failed_turn = None
+    session.context.append((command, player_response))
+    narrated_change = 'state_change' in full_response and apply_narrated_state_change(session, full_response['state_change'], debug)
+    return player_response, DM_response, narrated_change
+
+
+@tracing.traced('turn')
+def turn(session: GameSession, command: str, debug: bool) -> str:
+    # Game commands are handled locally without an LLM round-trip
+    game_command = parse_game_command(command)
+    if game_command:
+        print(run_game_command(session, game_command[0], game_command[1], debug))
+        return 'Game command'
+
+    # Determine success or failure of all actions on the upcoming turn, unless this is a retry of a turn
+    # that already rolled its dice
+    success_message = retried_turn(session, command)
+    if success_message is not None:
+        finish_state_update(session, debug)
+    else:
+        success_message = llm_action_response(session, command, debug)
+    if success_message is None:
+        return 'Game command'
+    request = start_narration(session, command, success_message)
+
+    # Perform the action
     if debug:
-        print(f'DM response: {DM_response}')
-        print('\nPlayer response:')
-    print(player_response)
-    new_state_response = make_structured_request(game_rules + '\n' + state_change_rules + '\nCurrent game state: ' + json.dumps(game_state, indent=4), DM_response, None, game_state_schema, 5000, [])
-    new_state = json.loads(new_state_response['message']['content'])
-    context.append((command, player_response))
-    game_state = new_state
+        print(success_message)
+    if stream_mode:
+        # player_response is printed as it arrives; DM_response is only needed once the response is complete
+        if debug:
+            print('\nPlayer response:')
+        result = make_streaming_request(**request, stream_field='player_response')
+        player_response, DM_response, narrated_change = finish_narration(session, command, result, debug)
+        if debug:
+            print(f'DM response: {DM_response}')
+    else:
+        result = make_structured_request(**request)
+        player_response, DM_response, narrated_change = finish_narration(session, command, result, debug)
+        if debug:
+            print(f'DM response: {DM_response}')
+            print('\nPlayer response:')
+        print(player_response)
+    if pipeline_mode and not narrated_change:
+        # Hand control back to the player now; the next turn waits for the state update when it needs it
+        start_state_update(session, session.game_state, DM_response)
+        autosave(session)
+        return player_response
+    if not narrated_change:
+        try:
+            session.game_state = update_game_state(session, session.game_state, DM_response, debug)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            # The player has seen the narration, so the turn stands
+            defer_state_update(session, session.game_state, DM_response, e)
+            print(f'State update failed, it will be retried before the next turn: {e}')
+    compact_context(session.context, session.context_summary, context_budget, context_recent_turns)
+    autosave(session)
     if debug:
-        print(json.dumps(game_state, indent=4))
+        print(json.dumps(session.game_state, indent=4))
+        print(f"LLM connections: {connection_stats['reused_connections']} reused, {connection_stats['new_connections']} new")
+        print(f"Prompt tokens: {prompt_cache_stats['prompt_tokens']} sent, {prompt_cache_stats['cached_tokens']} cached")
+        print(f"Rate limiting: {rate_limit_stats['queued_calls']} calls queued for {rate_limit_stats['queue_seconds']:.1f}s, "
+              f"{rate_limit_stats['throttled']} throttled, {rate_limit_stats['retries']} retries, {rate_limit_stats['failovers']} failed over")
+        print(f"Structured outputs: {structured_output_stats['checked']} checked, {structured_output_stats['truncated']} truncated, "
+              f"{structured_output_stats['repaired']} repaired, {structured_output_stats['rerequested']} partly requested again")
+        fast_path = fast_path_summary()
+        if fast_path['commands']:
+            saved = fast_path['estimated_seconds_saved']
+            print(f"Fast path: {fast_path['resolved']} of {fast_path['commands']} commands resolved locally"
+                  + (f", about {saved:.1f}s saved" if saved is not None else ''))
     '''
     if game_state['health'] <= 0:
         death_response = make_structured_request(death_rules + json.dumps(game_state, indent=4), '', None, None, 2000, context)
@@ -853,6 +3566,23 @@ def main():
     global api_key
     global endpoint
     global debug_mode
+    global context_budget
+    global context_recent_turns
+    global context_recall_turns
+    global state_update_mode
+    global state_resync_turns
+    global stream_mode
+    global pipeline_mode
+    global record_file
+    global parse_cache_dir
+    global parse_cache_max_bytes
+    global parse_cache_enabled
+    global replay_cassette
+    global max_retries
+    global journal_snapshot_records
+    global routes
+    global fast_path_enabled
+    global key_cache_hours
 
     # Create the argument parser
     parser = argparse.ArgumentParser(description="Game World Setup")
@@ -860,72 +3590,226 @@ def main():
     # Add arguments
     parser.add_argument('--scenario', type=str, required=False,
                         help='Path to the scenario file describing the world for the game.')
-    parser.add_argument('--player', type=str, required=False,
-                        help='Path to the player file describing attributes of the player.')
+    parser.add_argument('--player', type=str, nargs='+', required=False,
+                        help='Path to the player file describing attributes of the player.  Several may be given with --compile_pack.')
     parser.add_argument('--endpoint', type=str, default=DEFAULT_ENDPOINT,
                         help='URI to OAI or AOAI gpt4o endpoint.')
     parser.add_argument('--api_key', type=str, required=False,
                         help='API Key for (A)OAI endpoint (if not using keyvault)')
+    parser.add_argument('--routes', type=str, required=False,
+                        help='JSON routing table giving each type of LLM call its own endpoints, model, max_tokens and temperature.')
     parser.add_argument('--key_vault', type=str, default=DEFAULT_KEY_VAULT,
                         help='Name of the key vault to use to lookup the API Key')
     parser.add_argument('--secret_name', type=str, default=DEFAULT_SN,
                         help='Name of the secret in the key vault containing the API Key')
+    parser.add_argument('--key_cache_hours', type=float, default=DEFAULT_KEY_CACHE_HOURS,
+                        help='Hours to cache the API Key from the key vault on disk (0 to always fetch it).')
     parser.add_argument('--load_game', type=str, required=False,
                         help='Set this to a filename to restore a saved game.')
+    parser.add_argument('--compile_pack', type=str, required=False,
+                        help='Compile the scenario and player files into this scenario pack file, then exit.')
+    parser.add_argument('--pack', type=str, required=False,
+                        help='Start a new game from a compiled scenario pack.')
+    parser.add_argument('--pack_player', type=str, required=False,
+                        help='Player to start as when the scenario pack holds more than one (e.g. wizard).')
     parser.add_argument('--debug', type=bool, default=False, nargs='?',
                         const=True, help='Enable or disable debug mode (default: False).')
     parser.add_argument('--self_play', type=bool, default=False, nargs='?',
                         const=True, help='Enable or disable self-play mode (default: False).')
+    parser.add_argument('--stream', type=bool, default=False, nargs='?',
+                        const=True, help='Stream the narration to the player as it is generated (default: False).')
+    parser.add_argument('--pipeline', type=bool, default=False, nargs='?',
+                        const=True, help='Update the game state in the background while the player types the next command (default: False).')
+    parser.add_argument('--seed', type=int, required=False,
+                        help='Seed the dice so that a session can be reproduced.')
+    parser.add_argument('--record', type=str, required=False,
+                        help='Append every LLM request and response to this cassette file.')
+    parser.add_argument('--replay', type=str, required=False,
+                        help='Serve LLM responses from this cassette file instead of the endpoint.')
+    parser.add_argument('--trace_file', type=str, required=False,
+                        help='Append a JSONL trace of every turn phase and LLM request to this file.')
+    parser.add_argument('--metrics', type=bool, default=False, nargs='?',
+                        const=True, help='Collect latency and token metrics and print them on exit (default: False).')
+    parser.add_argument('--parse_cache_dir', type=str, default=DEFAULT_PARSE_CACHE_DIR,
+                        help='Directory for caching parsed player and scenario files.')
+    parser.add_argument('--parse_cache_mb', type=int, default=DEFAULT_PARSE_CACHE_MB,
+                        help='Maximum size of the parse cache in megabytes.')
+    parser.add_argument('--no_parse_cache', type=bool, default=False, nargs='?',
+                        const=True, help='Always parse the player and scenario files with the LLM (default: False).')
+    parser.add_argument('--no_fast_path', type=bool, default=False, nargs='?',
+                        const=True, help='Resolve every command with the LLM, including routine ones (default: False).')
+    parser.add_argument('--pool_size', type=int, default=DEFAULT_POOL_SIZE,
+                        help='Maximum number of keep-alive connections to keep open to the endpoint.')
+    parser.add_argument('--connect_timeout', type=float, default=DEFAULT_CONNECT_TIMEOUT,
+                        help='Seconds to wait when connecting to the endpoint.')
+    parser.add_argument('--read_timeout', type=float, default=DEFAULT_READ_TIMEOUT,
+                        help='Seconds to wait for the endpoint to respond.')
+    parser.add_argument('--rate_limit_rpm', type=int, default=DEFAULT_RATE_LIMIT_RPM,
+                        help='Requests per minute allowed by the endpoint quota (0 for no limit).')
+    parser.add_argument('--rate_limit_tpm', type=int, default=DEFAULT_RATE_LIMIT_TPM,
+                        help='Tokens per minute allowed by the endpoint quota (0 for no limit).')
+    parser.add_argument('--max_retries', type=int, default=DEFAULT_MAX_RETRIES,
+                        help='Times to retry an LLM call that was throttled or failed.')
+    parser.add_argument('--no_autosave', type=bool, default=False, nargs='?',
+                        const=True, help='Do not autosave the game to a journal after every turn (default: False).')
+    parser.add_argument('--autosave_snapshot_records', type=int, default=DEFAULT_JOURNAL_SNAPSHOT_RECORDS,
+                        help='Rewrite the autosave journal as a fresh snapshot after this many records.')
+    parser.add_argument('--state_updates', type=str, choices=['delta', 'full', 'merged'], default='delta',
+                        help='Update the game state each turn from a delta (default), by regenerating the full state, or from a delta returned with the narration.')
+    parser.add_argument('--state_resync_turns', type=int, default=DEFAULT_STATE_RESYNC_TURNS,
+                        help='In delta mode, regenerate the full game state every this many turns (0 to never resync).')
+    parser.add_argument('--context_budget', type=int, default=DEFAULT_CONTEXT_BUDGET,
+                        help='Approximate token budget for the conversation context sent with each request (0 disables compaction).')
+    parser.add_argument('--context_recent_turns', type=int, default=DEFAULT_CONTEXT_RECENT_TURNS,
+                        help='Number of most recent turns always sent verbatim rather than summarized.')
+    parser.add_argument('--context_recall_turns', type=int, default=DEFAULT_CONTEXT_RECALL_TURNS,
+                        help='Number of summarized turns relevant to the command to send verbatim with each request (0 disables recall).')
 
     # Parse arguments
     args = parser.parse_args()
+    # Where the time goes before the first prompt, shown in debug mode
+    startup_seconds = {'import': import_seconds, 'auth': 0.0}
 
-    if not args.load_game:
+    if not args.load_game and not args.pack:
         if not args.player or not args.scenario:
-            parser.error("--player and --scenario are required if --load_game is not specified.")
+            parser.error("--player and --scenario are required if --load_game or --pack is not specified.")
+    if args.player and len(args.player) > 1 and not args.compile_pack:
+        parser.error("Only one --player may be given unless compiling a scenario pack.")
+
+    if args.record and args.replay:
+        parser.error("--record and --replay cannot be used together.")
 
-    if not args.api_key:
+    if args.replay:
+        # Replayed sessions never contact the endpoint, so no API key is needed
+        api_key = args.api_key or ''
+    elif not args.api_key:
         if not args.key_vault or not args.secret_name:
             parser.error("Must specify either --api_key or both --key_vault and --secret_name")
-        api_key = get_api_key(args.key_vault, args.secret_name).value
+        key_cache_hours = args.key_cache_hours
+        auth_start = time.perf_counter()
+        api_key = key_vault_api_key(args.key_vault, args.secret_name)
+        startup_seconds['auth'] = time.perf_counter() - auth_start
     else:
         api_key = args.api_key
     endpoint = args.endpoint
+    if args.routes:
+        try:
+            routes = load_routes(args.routes)
+        except (OSError, ValueError) as e:
+            parser.error(f'Could not load the routing table: {e}')
+    configure_http_session(args.pool_size, args.connect_timeout, args.read_timeout)
+    configure_rate_limiter(args.rate_limit_rpm, args.rate_limit_tpm)
+    max_retries = args.max_retries
+    journal_snapshot_records = args.autosave_snapshot_records
+    context_budget = args.context_budget
+    context_recent_turns = args.context_recent_turns
+    context_recall_turns = args.context_recall_turns
+    state_update_mode = args.state_updates
+    state_resync_turns = args.state_resync_turns
 
     # Access the arguments
     scenario_file = args.scenario
-    player_file = args.player
+    player_file = args.player[0] if args.player else None
     debug_mode = args.debug
     self_play = args.self_play
-
+    autosave_mode = not args.no_autosave
+    stream_mode = args.stream
+    pipeline_mode = args.pipeline
+    if args.seed is not None:
+        seed_dice(args.seed)
+    record_file = args.record
+    parse_cache_dir = args.parse_cache_dir
+    parse_cache_max_bytes = args.parse_cache_mb * 1024 * 1024
+    parse_cache_enabled = not args.no_parse_cache
+    fast_path_enabled = not args.no_fast_path
+    if args.trace_file:
+        tracing.add_sink(tracing.jsonl_sink(args.trace_file))
+    if args.metrics:
+        tracing.add_sink(tracing.metrics_sink)
+        atexit.register(lambda: print(tracing.metrics_report()))
+    if args.replay:
+        replay_cassette = load_cassette(args.replay)
+
+    if args.compile_pack:
+        compile_pack(args.compile_pack, scenario_file, args.player)
+        return
+
+    if args.pack:
+        # Everything needed to start the game was prepared when the pack was compiled
+        player_file = None
+        scenario_file = None
+
+    session = GameSession()
+    session.debug_mode = debug_mode
     if player_file:
-        read_player_file(player_file)
+        start = time.perf_counter()
+        read_player_file(session, player_file)
+        startup_seconds['player parse'] = time.perf_counter() - start
         if debug_mode:
-            print(json.dumps(player, indent=4))
+            print(json.dumps(session.player, indent=4))
     if scenario_file:
-        read_scenario_file(scenario_file)
+        start = time.perf_counter()
+        read_scenario_file(session, scenario_file)
+        startup_seconds['scenario parse'] = time.perf_counter() - start
         if debug_mode:
-            print(json.dumps(game_state, indent=4))
+            print(json.dumps(session.game_state, indent=4))
 
     self_play_context = None
+    failed_command = None
+    failures = 0
 
+    start = time.perf_counter()
     if args.load_game:
-        last_response = load_game(args.load_game)
+        last_response = load_game(session, args.load_game, autosave_mode)
+        print('Game loaded')
+        print()
+        print(last_response)
+    elif args.pack:
+        try:
+            last_response = start_from_pack(session, args.pack, args.pack_player)
+        except (FileNotFoundError, ValueError) as e:
+            parser.error(str(e))
+        print(last_response)
     else:
-        last_response = turn('begin the game', debug_mode)
+        last_response = turn(session, 'begin the game', debug_mode)
+    startup_seconds['opening turn'] = time.perf_counter() - start
+    if debug_mode:
+        print('Startup: ' + ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in startup_seconds.items()))
+    if autosave_mode:
+        if not session.journal:
+            start_journal(session, generate_save_filename(session.player['Name'], '.journal'))
+        print(f"Autosaving to {session.journal['filename']}")
     if self_play:
         self_play_context = []
-    while True:
-        if self_play:
+    while not session.finished:
+        if self_play and failed_command:
+            command = failed_command
+            print(f'> {command}')
+        elif self_play:
             command = make_self_play_request(self_play_prompt, last_response, self_play_context)
             self_play_context.append((last_response, command))
             print(f'> {command}')
         else:
             command = input('>')
+            if failed_command and not command.strip():
+                command = failed_command
         try:
-            last_response = turn(command, debug_mode)
-        except HTTPError as e:
+            last_response = turn(session, command, session.debug_mode)
+            failed_command = None
+            failures = 0
+        except (requests.RequestException, KeyError, ValueError) as e:
+            # Retrying the same command carries on from the phase that failed
             print(f'Turn failed with exception: {e}')
+            if not self_play:
+                print('Press enter to try the same command again.')
+            failed_command = command
+            failures += 1
+            if self_play and not retry_self_play_command(failures):
+                print('Giving up on this command')
+                failed_command = None
+                failures = 0
+        # Debug mode can be switched by a game command
+        debug_mode = session.debug_mode
 
 if __name__=="__main__":
     main()
@@ -0,0 +1,304 @@
+import json
+import time
+import asyncio
+import aiohttp
+import requests
+import adventure
+import tracing
+
+# asyncio version of the game engine, used by the game server (server.py) to host many sessions in one process.
+# The game logic is shared with adventure.py: the same functions build each request and handle its response.
+# Only the LLM calls and the turn itself are coroutines here, so a session waiting on the endpoint holds no
+# thread.  Endpoint, API key, modes and budgets are read from the adventure module's settings.
+
+DEFAULT_POOL_SIZE = 100
+
+pool_size = DEFAULT_POOL_SIZE
+connect_timeout = adventure.DEFAULT_CONNECT_TIMEOUT
+read_timeout = adventure.DEFAULT_READ_TIMEOUT
+http_client = None
+
+# Errors that fail a single turn without affecting the rest of the server
+REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, requests.RequestException, KeyError, ValueError)
+
+# Set by the game server.  Its clients must not reach the server's file system or console, so the game commands
+# that save, load or print debug output are answered here instead, and quitting ends the game without writing a
+# save file.  Sessions on the server are kept by its session store.
+server_mode = False
+SERVER_GAME_COMMAND_REPLIES = {
+    'save_game': 'Your game is saved automatically.',
+    'load_game': 'Saved games cannot be loaded here.',
+    'debug_mode_on': 'Debug mode is not available here.',
+    'debug_mode_off': 'Debug mode is not available here.',
+    'quit_game': 'Thank you for playing!'
+}
+
+
+# The shared client session.  Connections to the endpoint are kept alive and reused by every game session.
+def get_http_client() -> aiohttp.ClientSession:
+    global http_client
+
+    if http_client is None or http_client.closed:
+        http_client = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=pool_size),
+            timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout))
+    return http_client
+
+
+async def close_http_client():
+    global http_client
+
+    if http_client is not None:
+        await http_client.close()
+        http_client = None
+
+
+# Same as adventure.post_with_retries.  The rate limiter and endpoint health are shared with every other caller
+# in the process.
+async def post_with_retries(headers: dict, body: str, estimated_tokens: int, call_type: str = ''):
+    queue_seconds = 0.0
+    attempt = 0
+    while True:
+        wait = adventure.reserve_capacity(estimated_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+            queue_seconds += wait
+        endpoints = adventure.attempt_endpoints(call_type)
+        try:
+            response = await get_http_client().post(endpoints[0]['url'], headers=adventure.endpoint_headers(headers, endpoints[0]), data=body.encode('utf-8'))
+        except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            adventure.refund_capacity(estimated_tokens)
+            if attempt >= adventure.max_retries:
+                raise
+            failure = (adventure.retry_delay(attempt, {}), str(e) or type(e).__name__, False)
+        else:
+            if response.status >= 400:
+                adventure.refund_capacity(estimated_tokens)
+            if response.status not in adventure.RETRY_STATUS_CODES or attempt >= adventure.max_retries:
+                return response, queue_seconds
+            failure = (adventure.retry_delay(attempt, response.headers), f'status {response.status}', response.status == 429)
+            response.release()
+        attempt += 1
+        wait = adventure.failed_attempt(attempt, endpoints, *failure)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+# Send a request to the LLM endpoint and return the decoded JSON response
+async def post_llm_request(headers: dict, payload: dict, call_type: str = '') -> dict:
+    with tracing.span('llm_request', call_type=call_type, schema=adventure.payload_schema_name(payload), retries=0):
+        body = json.dumps(payload)
+        start = time.perf_counter()
+        if adventure.replay_cassette is not None:
+            return adventure.finish_llm_request(payload, call_type, body, adventure.replay_exchange(payload), start)
+        estimated_tokens = adventure.estimate_request_tokens(payload, body)
+        response, queue_seconds = await post_with_retries(headers, body, estimated_tokens, call_type)
+        async with response:
+            response_text = await response.text()
+            if response.status >= 400:
+                print(f"Error {response.status} - {response_text}")
+            response.raise_for_status()
+        return adventure.finish_llm_request(payload, call_type, body, response_text, start, estimated_tokens, queue_seconds)
+
+
+# Send a streaming request to the LLM endpoint and yield each server-sent event as it arrives
+async def post_llm_stream(headers: dict, payload: dict, call_type: str = ''):
+    with tracing.span('llm_request', call_type=call_type, schema=adventure.payload_schema_name(payload), retries=0, stream=True):
+        body = json.dumps(payload)
+        start = time.perf_counter()
+        stream_log = adventure.new_stream_log()
+        if adventure.replay_cassette is not None:
+            for line in adventure.replay_exchange(payload):
+                for event in adventure.read_stream_line(stream_log, line):
+                    yield event
+            adventure.finish_llm_stream(payload, call_type, body, stream_log, start)
+            return
+        estimated_tokens = adventure.estimate_request_tokens(payload, body)
+        # Only opening the stream is retried; once events have been passed on, a broken stream fails the request
+        response, queue_seconds = await post_with_retries(headers, body, estimated_tokens, call_type)
+        async with response:
+            if response.status >= 400:
+                print(f"Error {response.status} - {await response.text()}")
+            response.raise_for_status()
+            async for raw_line in response.content:
+                for event in adventure.read_stream_line(stream_log, raw_line.decode('utf-8').rstrip('\r\n')):
+                    yield event
+        adventure.finish_llm_stream(payload, call_type, body, stream_log, start, estimated_tokens, queue_seconds)
+
+
+# Same as adventure.validate_structured_choice
+async def validate_structured_choice(payload: dict, choice: dict, previous: dict = None, call_type: str = '') -> dict:
+    check = adventure.start_structured_check(payload, choice, previous, call_type)
+    repair_choice = None
+    if check['repair_payload']:
+        repair_choice = (await post_llm_request(adventure.request_headers(), check['repair_payload'], call_type))['choices'][0]
+    return adventure.finish_structured_check(check, repair_choice)
+
+
+# Same as adventure.make_structured_request
+async def make_structured_request(system_prompt: str, user_prompt: str, second_system_prompt: str, schema: dict, max_tokens: int, conversation_context: list = [], temperature: float=0.7, top_p: float=0.95, state_prompt: str = None, recalled_context: list = [], call_type: str = '', cached: bool = False, previous: dict = None) -> dict:
+    payload, prefix_tokens = adventure.structured_request_payload(system_prompt, user_prompt, second_system_prompt, schema, max_tokens, conversation_context, temperature, top_p, state_prompt, recalled_context, call_type)
+    choice = adventure.cached_choice(payload, call_type, cached)
+    if choice:
+        return choice
+
+    response = await post_llm_request(adventure.request_headers(), payload, call_type)
+    adventure.record_prompt_cache(prefix_tokens, response.get('usage'))
+    choice = await validate_structured_choice(payload, response['choices'][0], previous, call_type)
+    adventure.cache_choice(payload, call_type, cached, choice)
+    return choice
+
+
+# Same as adventure.make_streaming_request, except that the decoded text of stream_field is passed to the
+# on_text coroutine function as it arrives instead of being printed
+async def make_streaming_request(system_prompt: str, user_prompt: str, second_system_prompt: str, schema: dict, max_tokens: int, conversation_context: list = [], stream_field: str = None, on_text=None, temperature: float=0.7, top_p: float=0.95, state_prompt: str = None, recalled_context: list = [], call_type: str = '') -> dict:
+    payload, prefix_tokens = adventure.structured_request_payload(system_prompt, user_prompt, second_system_prompt, schema, max_tokens, conversation_context, temperature, top_p, state_prompt, recalled_context, call_type, stream=True)
+
+    streamed = adventure.new_streamed_choice(stream_field)
+    async for event in post_llm_stream(adventure.request_headers(), payload, call_type):
+        text = adventure.feed_streamed_choice(streamed, event)
+        if text and on_text:
+            await on_text(text)
+    adventure.record_prompt_cache(prefix_tokens, streamed['usage'])
+    return await validate_structured_choice(payload, adventure.streamed_choice(streamed), None, call_type)
+
+
+# Parse the player and scenario text into a new game and play its opening turn.  Returns the opening narration.
+async def start_game(session: adventure.GameSession, scenario_text: str, player_text: str, on_text=None) -> str:
+    player_response = await make_structured_request(**adventure.player_parse_request(player_text))
+    session.player = json.loads(player_response['message']['content'])
+    session.player_text = player_text
+    initial_state_response = await make_structured_request(**adventure.scenario_parse_request(session.player, scenario_text, player_text))
+    adventure.start_scenario(session, scenario_text, initial_state_response)
+    return await turn(session, 'begin the game', on_text)
+
+
+# Same as adventure.update_game_state
+async def update_game_state(session: adventure.GameSession, state: dict, DM_response: str) -> dict:
+    with tracing.span('state_update'):
+        if not adventure.needs_resync(session):
+            try:
+                delta_response = await make_structured_request(**adventure.state_update_request(state, DM_response, False))
+                return adventure.finish_game_state_update(session, state, delta_response, False, session.debug_mode)
+            except (KeyError, TypeError, ValueError) as e:
+                print(f'Could not apply state change, regenerating the game state: {e}')
+
+        new_state_response = await make_structured_request(**adventure.state_update_request(state, DM_response, True))
+        return adventure.finish_game_state_update(session, state, new_state_response, True, session.debug_mode)
+
+
+async def compact_context(session: adventure.GameSession):
+    with tracing.span('compact_context'):
+        compaction = adventure.compaction_request(session.context, session.context_summary, adventure.context_budget, adventure.context_recent_turns)
+        if compaction:
+            request, fold_until = compaction
+            adventure.apply_compaction(session.context_summary, await make_structured_request(**request), fold_until)
+
+
+# Second half of a turn: update the game state, then compact the context if needed
+async def run_state_update(session: adventure.GameSession, state: dict, DM_response: str) -> dict:
+    new_state = await update_game_state(session, state, DM_response)
+    try:
+        await compact_context(session)
+    except REQUEST_ERRORS as e:
+        print(f'Context compaction failed: {e}')
+    return new_state
+
+
+# Same as adventure.defer_state_update
+def defer_state_update(session: adventure.GameSession, state: dict, DM_response: str, error: Exception):
+    future = asyncio.get_running_loop().create_future()
+    future.set_exception(error)
+    session.pending_state_update = {
+        'task': future,
+        'state': state,
+        'DM_response': DM_response
+    }
+
+
+# When pipelining, the state update runs as a task while the player reads the narration
+def start_state_update(session: adventure.GameSession, state: dict, DM_response: str):
+    session.pending_state_update = {
+        'task': asyncio.create_task(run_state_update(session, state, DM_response)),
+        'state': state,
+        'DM_response': DM_response
+    }
+
+
+# Same as adventure.finish_state_update
+async def finish_state_update(session: adventure.GameSession):
+    if not session.pending_state_update:
+        return
+    pending = session.pending_state_update
+    session.pending_state_update = None
+    try:
+        new_state = await pending['task']
+    except REQUEST_ERRORS as e:
+        print(f'Background state update failed, retrying: {e}')
+        try:
+            new_state = await update_game_state(session, pending['state'], pending['DM_response'])
+        except REQUEST_ERRORS as e:
+            print(f'State update failed, keeping the previous game state: {e}')
+            return
+    session.game_state = new_state
+    adventure.autosave(session)
+
+
+async def run_game_command(session: adventure.GameSession, command: str, argument: str) -> str:
+    if server_mode and command in SERVER_GAME_COMMAND_REPLIES:
+        if command == 'quit_game':
+            session.finished = True
+        return SERVER_GAME_COMMAND_REPLIES[command]
+    # Game commands work from the current game state, so the pending update must land first
+    await finish_state_update(session)
+    return adventure.run_game_command(session, command, argument, session.debug_mode)
+
+
+# Play one turn and return the text to show the player: the narration, or the output of a game command.
+# If on_text is given the narration is streamed to it as it is generated.
+async def turn(session: adventure.GameSession, command: str, on_text=None) -> str:
+    with tracing.span('turn'):
+        # Game commands are handled locally without an LLM round-trip
+        game_command = adventure.parse_game_command(command)
+        if game_command:
+            return await run_game_command(session, game_command[0], game_command[1])
+
+        # Determine success or failure of all actions on the upcoming turn, unless this is a retry of a turn
+        # that already rolled its dice
+        with tracing.span('llm_action_response'):
+            await finish_state_update(session)
+            success_message = adventure.retried_turn(session, command)
+            if success_message is None:
+                actions = adventure.fast_path_actions(session, command)
+                if actions is None:
+                    start = time.perf_counter()
+                    result = await make_structured_request(**adventure.action_request(session, command))
+                    adventure.record_action_call(time.perf_counter() - start)
+                    actions = json.loads(result['message']['content'])
+                game_command = adventure.action_game_command(actions)
+                if game_command:
+                    return await run_game_command(session, game_command, '')
+                success_message = adventure.resolve_actions(actions)
+
+        # Perform the action
+        request = adventure.start_narration(session, command, success_message)
+        if on_text:
+            result = await make_streaming_request(**request, stream_field='player_response', on_text=on_text)
+        else:
+            result = await make_structured_request(**request)
+        player_response, DM_response, narrated_change = adventure.finish_narration(session, command, result, session.debug_mode)
+        if adventure.pipeline_mode and not narrated_change:
+            # Reply to the player now; the next turn waits for the state update when it needs it
+            start_state_update(session, session.game_state, DM_response)
+            adventure.autosave(session)
+            return player_response
+        if not narrated_change:
+            try:
+                session.game_state = await update_game_state(session, session.game_state, DM_response)
+            except REQUEST_ERRORS as e:
+                # The narration is ready, so the turn stands
+                defer_state_update(session, session.game_state, DM_response, e)
+                print(f'State update failed, it will be retried before the next turn: {e}')
+        await compact_context(session)
+        adventure.autosave(session)
+        return player_response
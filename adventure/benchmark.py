@@ -0,0 +1,225 @@
+import io
+import os
+import json
+import time
+import argparse
+import datetime
+import contextlib
+import requests
+import adventure
+import mock_llm
+
+# Self-play benchmark.  Plays a fixed number of turns for each scenario/player pair and reports where the time
+# goes: latency percentiles, token usage and payload sizes for each type of LLM call, turn latency, how the
+# context sent with each request grows over the game, and how far the game state drifts between full resyncs.
+# Results are written as JSON so they can be compared between versions and --state_updates modes.
+#   python benchmark.py --turns 10 --output results.json                  (against a local mock endpoint)
+#   python benchmark.py --endpoint <url> --api_key <key> --turns 10       (against a real endpoint)
+
+ADVENTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ['scenario.txt', 'dungeon.txt']
+PLAYERS = ['wizard.txt', 'cleric.txt', 'rogue.txt', 'paladin.txt']
+DEFAULT_TURNS = 10
+
+
+# Nearest-rank percentile
+def percentile(values: list, p: float) -> float:
+    ordered = sorted(values)
+    rank = max(1, int(-(-p * len(ordered) // 100)))
+    return ordered[rank - 1]
+
+
+def summarize(values: list) -> dict:
+    if not values:
+        return {'count': 0}
+    return {
+        'count': len(values),
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p95': percentile(values, 95),
+        'p99': percentile(values, 99),
+        'max': max(values)
+    }
+
+
+# Summarize the call log by call type
+def summarize_calls(calls: list) -> dict:
+    summary = {}
+    for call_type in sorted(set(call['call_type'] for call in calls)):
+        typed_calls = [call for call in calls if call['call_type'] == call_type]
+        summary[call_type] = {
+            'latency_seconds': summarize([call['seconds'] for call in typed_calls]),
+            'prompt_tokens': summarize([call['prompt_tokens'] for call in typed_calls]),
+            'completion_tokens': summarize([call['completion_tokens'] for call in typed_calls]),
+            'cached_tokens': sum(call['cached_tokens'] for call in typed_calls),
+            'queue_seconds': summarize([call['queue_seconds'] for call in typed_calls]),
+            'request_bytes': summarize([call['request_bytes'] for call in typed_calls]),
+            'response_bytes': summarize([call['response_bytes'] for call in typed_calls])
+        }
+    return summary
+
+
+# Play one self-play game and return its measurements
+def run_game(scenario: str, player: str, turns: int) -> dict:
+    session = adventure.GameSession()
+    adventure.call_log = []
+    adventure.state_drift_stats.update(resyncs=0, changed_fields=0)
+    adventure.fast_path_stats.update(commands=0, resolved=0, llm_calls=0, llm_seconds=0.0)
+    turn_seconds = []
+    context_growth = []
+    failures = 0
+
+    # The game's own output is not interesting here
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        adventure.read_player_file(session, os.path.join(ADVENTURE_DIR, player))
+        adventure.read_scenario_file(session, os.path.join(ADVENTURE_DIR, scenario))
+        last_response = adventure.turn(session, 'begin the game', False)
+        startup_seconds = time.perf_counter() - start
+
+        self_play_context = []
+        for turn_number in range(1, turns + 1):
+            try:
+                command = adventure.make_self_play_request(adventure.self_play_prompt, last_response, self_play_context)
+                self_play_context.append((last_response, command))
+                turn_start = time.perf_counter()
+                last_response = adventure.turn(session, command, False)
+                turn_seconds.append(time.perf_counter() - turn_start)
+            except (requests.RequestException, KeyError, ValueError):
+                failures += 1
+            request_context = adventure.build_request_context(session.context, session.context_summary)
+            context_growth.append({
+                'turn': turn_number,
+                'context_entries': len(session.context),
+                'request_context_entries': len(request_context),
+                'request_context_tokens': adventure.estimate_context_tokens(request_context)
+            })
+        adventure.finish_state_update(session, False)
+
+    calls = adventure.call_log
+    adventure.call_log = None
+    return {
+        'scenario': scenario,
+        'player': player,
+        'turns': turns,
+        'failed_turns': failures,
+        'startup_seconds': startup_seconds,
+        'turn_seconds': turn_seconds,
+        'turn_latency_seconds': summarize(turn_seconds),
+        'call_types': summarize_calls(calls),
+        'context_growth': context_growth,
+        # Fields that differed from the delta-built state each time the full state was regenerated
+        'state_resyncs': adventure.state_drift_stats['resyncs'],
+        'resync_changed_fields': adventure.state_drift_stats['changed_fields'],
+        # Commands resolved by the local fast path rather than an action request
+        'fast_path': adventure.fast_path_summary(),
+        'calls': calls
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Self-play latency and token benchmark")
+    parser.add_argument('--endpoint', type=str, required=False,
+                        help='URI to OAI or AOAI gpt4o endpoint.  If omitted a local mock endpoint is used.')
+    parser.add_argument('--api_key', type=str, default='',
+                        help='API Key for (A)OAI endpoint.')
+    parser.add_argument('--routes', type=str, required=False,
+                        help='JSON routing table giving each type of LLM call its own endpoints, model, max_tokens and temperature.')
+    parser.add_argument('--turns', type=int, default=DEFAULT_TURNS,
+                        help='Number of self-play turns per game.')
+    parser.add_argument('--scenarios', type=str, nargs='+', default=SCENARIOS,
+                        help='Scenario files to benchmark.')
+    parser.add_argument('--players', type=str, nargs='+', default=PLAYERS,
+                        help='Player files to benchmark.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the dice.')
+    parser.add_argument('--stream', type=bool, default=False, nargs='?', const=True,
+                        help='Benchmark with streaming narration.')
+    parser.add_argument('--pipeline', type=bool, default=False, nargs='?', const=True,
+                        help='Benchmark with pipelined state updates.')
+    parser.add_argument('--state_updates', type=str, choices=['delta', 'full', 'merged'], default='delta',
+                        help='How the game state is updated each turn.')
+    parser.add_argument('--no_fast_path', type=bool, default=False, nargs='?', const=True,
+                        help='Resolve every command with the LLM, including routine ones.')
+    parser.add_argument('--parse_cache', type=bool, default=False, nargs='?', const=True,
+                        help='Serve player and scenario parses from the parse cache.  By default every parse is sent, so that runs are comparable.')
+    parser.add_argument('--mock_latency', type=float, default=mock_llm.DEFAULT_LATENCY,
+                        help='Latency of the mock endpoint.')
+    parser.add_argument('--mock_tokens_per_second', type=float, default=mock_llm.DEFAULT_TOKENS_PER_SECOND,
+                        help='Generation speed of the mock endpoint.')
+    parser.add_argument('--include_calls', type=bool, default=False, nargs='?', const=True,
+                        help='Include every individual call in the output.')
+    parser.add_argument('--output', type=str, required=False,
+                        help='File to write the results to (default: standard output).')
+    args = parser.parse_args()
+
+    if args.endpoint:
+        adventure.endpoint = args.endpoint
+    else:
+        mock_llm.latency = args.mock_latency
+        mock_llm.tokens_per_second = args.mock_tokens_per_second
+        server = mock_llm.start_mock_server()
+        adventure.endpoint = f'http://127.0.0.1:{server.server_port}/chat/completions'
+    adventure.api_key = args.api_key
+    if args.routes:
+        adventure.routes = adventure.load_routes(args.routes)
+    adventure.stream_mode = args.stream
+    adventure.pipeline_mode = args.pipeline
+    adventure.state_update_mode = args.state_updates
+    adventure.fast_path_enabled = not args.no_fast_path
+    adventure.parse_cache_enabled = args.parse_cache
+    adventure.seed_dice(args.seed)
+
+    start = time.perf_counter()
+    games = []
+    all_calls = []
+    all_turn_seconds = []
+    for scenario in args.scenarios:
+        for player in args.players:
+            print(f'Benchmarking {scenario} with {player}...', flush=True)
+            game = run_game(scenario, player, args.turns)
+            all_calls += game['calls']
+            all_turn_seconds += game['turn_seconds']
+            if not args.include_calls:
+                del game['calls']
+            games.append(game)
+
+    results = {
+        'benchmark': 'self_play',
+        'timestamp': datetime.datetime.now().isoformat(),
+        'config': {
+            'endpoint': args.endpoint or 'mock',
+            'routes': args.routes,
+            'turns': args.turns,
+            'seed': args.seed,
+            'stream': args.stream,
+            'pipeline': args.pipeline,
+            'state_updates': args.state_updates,
+            'fast_path': not args.no_fast_path,
+            'parse_cache': args.parse_cache
+        },
+        'total_seconds': time.perf_counter() - start,
+        'summary': {
+            'games': len(games),
+            'failed_turns': sum(game['failed_turns'] for game in games),
+            'state_resyncs': sum(game['state_resyncs'] for game in games),
+            'resync_changed_fields': sum(game['resync_changed_fields'] for game in games),
+            'fast_path_commands': sum(game['fast_path']['commands'] for game in games),
+            'fast_path_resolved': sum(game['fast_path']['resolved'] for game in games),
+            'fast_path_seconds_saved': sum(game['fast_path']['estimated_seconds_saved'] or 0.0 for game in games),
+            'structured_outputs': adventure.structured_output_stats,
+            'turn_latency_seconds': summarize(all_turn_seconds),
+            'call_types': summarize_calls(all_calls)
+        },
+        'games': games
+    }
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,255 @@
+import os
+import sys
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+import datetime
+import tempfile
+import subprocess
+import aiohttp
+import mock_llm
+from benchmark import summarize
+
+# Load test for the game server.  Starts a mock endpoint and a game server in separate processes, then plays
+# many concurrent sessions against the server and reports turn latency, throughput, and the CPU time the server
+# process used, as sessions carried per core of server CPU.  A small --session_memory_mb or --idle_seconds
+# exercises the server's session store, spilling sessions to disk and rehydrating them.
+#   python load_test.py --sessions 200 --turns 5 --output load.json
+
+ADVENTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SESSIONS = 100
+DEFAULT_TURNS = 5
+DEFAULT_THINK_TIME = 1.0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+# CPU seconds used so far by a process, from /proc.  Returns None where /proc is not available.
+def process_cpu_seconds(pid: int) -> float:
+    try:
+        with open(f'/proc/{pid}/stat', 'r') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    # utime and stime are fields 14 and 15 of the stat line; the split above starts at field 3
+    return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+
+def wait_for_port(port: int, process: subprocess.Popen, seconds: float = 30):
+    deadline = time.time() + seconds
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f'{process.args[1]} exited with code {process.returncode}')
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise RuntimeError(f'{process.args[1]} did not start listening on port {port}')
+
+
+async def start_session(client: aiohttp.ClientSession, server_url: str, scenario: str, player: str) -> str:
+    async with client.post(f'{server_url}/sessions', json={'scenario': scenario, 'player': player}) as response:
+        response.raise_for_status()
+        return (await response.json())['session_id']
+
+
+# Play a turn over HTTP.  Returns the seconds until the response arrived and until the first narration text
+# (the same, when not streaming).
+async def http_turn(client: aiohttp.ClientSession, server_url: str, session_id: str, command: str):
+    start = time.perf_counter()
+    async with client.post(f'{server_url}/sessions/{session_id}/turn', json={'command': command}) as response:
+        response.raise_for_status()
+        await response.json()
+    seconds = time.perf_counter() - start
+    return seconds, seconds
+
+
+async def websocket_turn(ws, command: str):
+    start = time.perf_counter()
+    first_text_seconds = None
+    await ws.send_json({'command': command})
+    while True:
+        message = await ws.receive_json()
+        if message['type'] == 'text' and first_text_seconds is None:
+            first_text_seconds = time.perf_counter() - start
+        elif message['type'] == 'error':
+            raise RuntimeError(message['error'])
+        elif message['type'] == 'response':
+            seconds = time.perf_counter() - start
+            return seconds, first_text_seconds or seconds
+
+
+# One simulated player: think, then issue a command, for a number of turns
+async def play(client: aiohttp.ClientSession, server_url: str, session_id: str, turns: int, think_time: float, stream: bool, results: dict):
+    rng = random.Random(session_id)
+    ws = await client.ws_connect(f'{server_url}/sessions/{session_id}/ws') if stream else None
+    try:
+        for _ in range(turns):
+            await asyncio.sleep(rng.uniform(0, 2 * think_time))
+            command = rng.choice(mock_llm.self_play_commands)
+            try:
+                if ws:
+                    seconds, first_text_seconds = await websocket_turn(ws, command)
+                else:
+                    seconds, first_text_seconds = await http_turn(client, server_url, session_id, command)
+            except (aiohttp.ClientError, RuntimeError):
+                results['failed_turns'] += 1
+                continue
+            results['turn_seconds'].append(seconds)
+            results['first_text_seconds'].append(first_text_seconds)
+    finally:
+        if ws:
+            await ws.close()
+
+
+async def run_load(server_url: str, server_pid: int, args) -> dict:
+    results = {
+        'failed_turns': 0,
+        'turn_seconds': [],
+        'first_text_seconds': []
+    }
+    connector = aiohttp.TCPConnector(limit=0)
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=600)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as client:
+        # Start one game first so that the rest are served from the parse cache
+        start = time.perf_counter()
+        session_ids = [await start_session(client, server_url, args.scenario, args.player)]
+        session_ids += await asyncio.gather(*[start_session(client, server_url, args.scenario, args.player) for _ in range(args.sessions - 1)])
+        startup_seconds = time.perf_counter() - start
+
+        cpu_before = process_cpu_seconds(server_pid)
+        start = time.perf_counter()
+        await asyncio.gather(*[play(client, server_url, session_id, args.turns, args.think_time, args.stream, results) for session_id in session_ids])
+        wall_seconds = time.perf_counter() - start
+        cpu_after = process_cpu_seconds(server_pid)
+        async with client.get(f'{server_url}/metrics') as response:
+            server_metrics = await response.json()
+
+    turns_played = len(results['turn_seconds'])
+    cpu_seconds = cpu_after - cpu_before if cpu_before is not None else None
+    cores_used = cpu_seconds / wall_seconds if cpu_seconds else None
+    return {
+        'startup_seconds': startup_seconds,
+        'wall_seconds': wall_seconds,
+        'turns_played': turns_played,
+        'failed_turns': results['failed_turns'],
+        'turns_per_second': turns_played / wall_seconds,
+        'turn_latency_seconds': summarize(results['turn_seconds']),
+        'first_text_seconds': summarize(results['first_text_seconds']),
+        'server_cpu_seconds': cpu_seconds,
+        'server_cpu_seconds_per_turn': cpu_seconds / turns_played if cpu_seconds is not None and turns_played else None,
+        'server_cores_used': cores_used,
+        # Sessions one fully busy core could carry at this think time and endpoint latency
+        'sessions_per_core': args.sessions / cores_used if cores_used else None,
+        'session_store': server_metrics['session_store'],
+        'rate_limiting': server_metrics['rate_limiting']
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Game server load test")
+    parser.add_argument('--sessions', type=int, default=DEFAULT_SESSIONS,
+                        help='Number of concurrent game sessions.')
+    parser.add_argument('--turns', type=int, default=DEFAULT_TURNS,
+                        help='Turns played in each session.')
+    parser.add_argument('--think_time', type=float, default=DEFAULT_THINK_TIME,
+                        help='Mean seconds a simulated player waits before each command.')
+    parser.add_argument('--scenario', type=str, default='scenario.txt',
+                        help='Scenario file to play.')
+    parser.add_argument('--player', type=str, default='wizard.txt',
+                        help='Player file to play.')
+    parser.add_argument('--stream', type=bool, default=False, nargs='?', const=True,
+                        help='Play over WebSockets with streamed narration.')
+    parser.add_argument('--pipeline', type=bool, default=False, nargs='?', const=True,
+                        help='Run the server with pipelined state updates.')
+    parser.add_argument('--session_memory_mb', type=int, required=False,
+                        help='Memory ceiling for resident sessions on the server.')
+    parser.add_argument('--idle_seconds', type=float, required=False,
+                        help='Seconds before the server spills an idle session to disk.')
+    parser.add_argument('--rate_limit_rpm', type=int, required=False,
+                        help='Requests per minute quota the server enforces on itself.')
+    parser.add_argument('--rate_limit_tpm', type=int, required=False,
+                        help='Tokens per minute quota the server enforces on itself.')
+    parser.add_argument('--mock_throttle_rate', type=float, default=0.0,
+                        help='Fraction of requests the mock endpoint rejects with 429.')
+    parser.add_argument('--mock_latency', type=float, default=mock_llm.DEFAULT_LATENCY,
+                        help='Latency of the mock endpoint.')
+    parser.add_argument('--mock_tokens_per_second', type=float, default=mock_llm.DEFAULT_TOKENS_PER_SECOND,
+                        help='Generation speed of the mock endpoint.')
+    parser.add_argument('--output', type=str, required=False,
+                        help='File to write the results to (default: standard output).')
+    args = parser.parse_args()
+
+    mock_port = free_port()
+    server_port = free_port()
+    processes = []
+    with tempfile.TemporaryDirectory() as work_dir:
+        try:
+            mock = subprocess.Popen([sys.executable, os.path.join(ADVENTURE_DIR, 'mock_llm.py'), '--port', str(mock_port),
+                                     '--latency', str(args.mock_latency), '--tokens_per_second', str(args.mock_tokens_per_second),
+                                     '--throttle_rate', str(args.mock_throttle_rate)],
+                                    stdout=subprocess.DEVNULL)
+            processes.append(mock)
+            server_command = [sys.executable, os.path.join(ADVENTURE_DIR, 'server.py'), '--port', str(server_port),
+                              '--endpoint', f'http://127.0.0.1:{mock_port}/chat/completions', '--api_key', 'mock',
+                              '--parse_cache_dir', os.path.join(work_dir, 'parse_cache'), '--spill_dir', os.path.join(work_dir, 'sessions')]
+            if args.pipeline:
+                server_command.append('--pipeline')
+            if args.session_memory_mb is not None:
+                server_command += ['--session_memory_mb', str(args.session_memory_mb)]
+            if args.idle_seconds is not None:
+                server_command += ['--idle_seconds', str(args.idle_seconds)]
+            if args.rate_limit_rpm is not None:
+                server_command += ['--rate_limit_rpm', str(args.rate_limit_rpm)]
+            if args.rate_limit_tpm is not None:
+                server_command += ['--rate_limit_tpm', str(args.rate_limit_tpm)]
+            server = subprocess.Popen(server_command, stdout=subprocess.DEVNULL)
+            processes.append(server)
+            wait_for_port(mock_port, mock)
+            wait_for_port(server_port, server)
+
+            print(f'Playing {args.sessions} sessions of {args.turns} turns...', flush=True)
+            load = asyncio.run(run_load(f'http://127.0.0.1:{server_port}', server.pid, args))
+        finally:
+            for process in processes:
+                process.terminate()
+                process.wait()
+
+    results = {
+        'benchmark': 'server_load',
+        'timestamp': datetime.datetime.now().isoformat(),
+        'config': {
+            'sessions': args.sessions,
+            'turns': args.turns,
+            'think_time': args.think_time,
+            'stream': args.stream,
+            'pipeline': args.pipeline,
+            'session_memory_mb': args.session_memory_mb,
+            'idle_seconds': args.idle_seconds,
+            'rate_limit_rpm': args.rate_limit_rpm,
+            'rate_limit_tpm': args.rate_limit_tpm,
+            'mock_throttle_rate': args.mock_throttle_rate,
+            'mock_latency': args.mock_latency,
+            'mock_tokens_per_second': args.mock_tokens_per_second,
+            'cpu_count': os.cpu_count()
+        },
+        'results': load
+    }
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__=="__main__":
+    main()
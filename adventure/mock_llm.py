@@ -0,0 +1,277 @@
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# A local stand-in for the (A)OAI chat completions endpoint, for profiling the game engine offline.
+# It accepts the same requests as the real endpoint and answers with made-up content that conforms to the
+# requested response_format schema, after a simulated delay of latency + completion tokens / token rate.
+# Start it and point the game at it:
+#   python mock_llm.py --port 8000
+#   python adventure.py --endpoint http://localhost:8000/chat/completions --api_key mock --player wizard.txt --scenario scenario.txt
+
+DEFAULT_PORT = 8000
+DEFAULT_LATENCY = 0.3
+DEFAULT_TOKENS_PER_SECOND = 100.0
+DEFAULT_RESPONSE_WORDS = 60
+DEFAULT_THROTTLE_RATE = 0.0
+DEFAULT_RETRY_AFTER = 1.0
+
+# Prompt caching is simulated the way the real service does it: prompts of at least 1024 tokens can have
+# their longest previously seen prefix served from the cache, in 128 token increments.
+CACHE_MIN_TOKENS = 1024
+CACHE_INCREMENT = 128
+
+latency = DEFAULT_LATENCY
+tokens_per_second = DEFAULT_TOKENS_PER_SECOND
+response_words = DEFAULT_RESPONSE_WORDS
+# Fraction of requests rejected with 429 Too Many Requests, to exercise client retries
+throttle_rate = DEFAULT_THROTTLE_RATE
+retry_after = DEFAULT_RETRY_AFTER
+throttle_random = random.Random(0)
+seen_prefixes = set()
+seen_prefixes_lock = threading.Lock()
+
+words = '''the road winds north between tall pines and the wind carries the smell of rain from the mountains
+a lantern swings above the door of the inn where travelers gather to trade rumors of ruins and treasure
+somewhere in the forest an owl calls and the shadows under the trees grow long as the sun sinks'''.split()
+
+# Commands the mock player issues in self-play
+self_play_commands = [
+    'Look around',
+    'Walk north along the road',
+    'Enter the town',
+    'Go to the inn',
+    'Ask the innkeeper about rumors',
+    'Buy a lantern',
+    'Search the area',
+    'Attack the goblin',
+    'Check my inventory',
+    'Rest for an hour'
+]
+
+# Plausible values for fields where an arbitrary string would break the game engine
+field_values = {
+    'dice_to_roll': ['1d20+2', '1d20+5', '1d8+3', '2d6', ''],
+    'danger': ['safe', 'low', 'medium'],
+    'time_of_day': ['18:00'],
+    'sunrise': ['06:45'],
+    'sunset': ['18:30'],
+    'date': ['October 1'],
+    'Status': ['healthy'],
+    'status': ['hostile'],
+    'action_type': ['move', 'attack', 'talk', 'search']
+}
+
+
+def estimate_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+def make_text(rng: random.Random, count: int) -> str:
+    return ' '.join(rng.choice(words) for _ in range(count)).capitalize() + '.'
+
+
+# Generate a value conforming to a JSON schema.  Nullable fields are null, which the state delta treats as unchanged.
+def generate_value(schema: dict, rng: random.Random, name: str = ''):
+    if 'anyOf' in schema:
+        options = schema['anyOf']
+        if {'type': 'null'} in options:
+            return None
+        return generate_value(options[0], rng, name)
+    schema_type = schema.get('type')
+    if isinstance(schema_type, list):
+        if 'null' in schema_type:
+            return None
+        schema_type = schema_type[0]
+    if 'enum' in schema:
+        return schema['enum'][0]
+    if schema_type == 'object':
+        return {key: generate_value(value, rng, key) for key, value in schema.get('properties', {}).items()}
+    if schema_type == 'array':
+        # Lists of things that change the game state are left empty so the mock does not churn the state
+        if name.startswith(('add_', 'remove_', 'update_')) or name in ['monsters', 'NPCs', 'spell_slots_used', 'Spell Effects']:
+            return []
+        return [generate_value(schema.get('items', {}), rng, name)]
+    if schema_type == 'integer':
+        return rng.randint(1, 20) if name not in ['gold_change', 'hp_change', 'xp_change'] else 0
+    if schema_type == 'number':
+        return rng.random()
+    if schema_type == 'boolean':
+        return False
+    if name in field_values:
+        return rng.choice(field_values[name])
+    if name in ['player_response', 'DM_response', 'summary']:
+        return make_text(rng, response_words)
+    return make_text(rng, 3)
+
+
+# Make up the content of a response to a chat completions request
+def generate_content(request: dict, rng: random.Random) -> str:
+    response_format = request.get('response_format')
+    if response_format and response_format.get('type') == 'json_schema':
+        return json.dumps(generate_value(response_format['json_schema']['schema'], rng))
+    # Free-form requests only come from self-play
+    return rng.choice(self_play_commands)
+
+
+# Simulate prompt caching by remembering every prefix of the message list we have seen
+def count_cached_tokens(messages: list) -> int:
+    cached = 0
+    prefix_tokens = 0
+    digest = hashlib.sha256()
+    with seen_prefixes_lock:
+        for message in messages:
+            digest.update(json.dumps(message, sort_keys=True).encode('utf-8'))
+            prefix_tokens += estimate_tokens(json.dumps(message['content']))
+            key = digest.hexdigest()
+            if key in seen_prefixes:
+                cached = prefix_tokens
+            seen_prefixes.add(key)
+    if prefix_tokens < CACHE_MIN_TOKENS:
+        return 0
+    return cached // CACHE_INCREMENT * CACHE_INCREMENT
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        try:
+            request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+        except ValueError as e:
+            self.send_json(400, {'error': {'message': f'Invalid JSON: {e}'}})
+            return
+        if 'messages' not in request:
+            self.send_json(400, {'error': {'message': 'messages is required'}})
+            return
+
+        if throttle_rate and throttle_random.random() < throttle_rate:
+            self.send_json(429, {'error': {'code': '429', 'message': 'Rate limit exceeded.'}}, {'Retry-After': str(retry_after)})
+            return
+
+        # Seed from the request so that identical requests get identical responses
+        rng = random.Random(hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest())
+        content = generate_content(request, rng)
+        prompt_tokens = sum(estimate_tokens(json.dumps(message['content'])) for message in request['messages'])
+        usage = {
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': estimate_tokens(content),
+            'total_tokens': prompt_tokens + estimate_tokens(content),
+            'prompt_tokens_details': {
+                'cached_tokens': count_cached_tokens(request['messages'])
+            }
+        }
+
+        time.sleep(latency)
+        if request.get('stream'):
+            self.send_stream(content, usage, request)
+        else:
+            time.sleep(usage['completion_tokens'] / tokens_per_second)
+            self.send_json(200, {
+                'id': 'chatcmpl-mock',
+                'object': 'chat.completion',
+                'created': int(time.time()),
+                'model': request.get('model', 'mock'),
+                'choices': [{
+                    'index': 0,
+                    'message': {
+                        'role': 'assistant',
+                        'content': content
+                    },
+                    'finish_reason': 'stop'
+                }],
+                'usage': usage
+            })
+
+    def send_json(self, status: int, body: dict, headers: dict = {}):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data: bytes):
+        self.wfile.write(f'{len(data):x}\r\n'.encode('ascii') + data + b'\r\n')
+        self.wfile.flush()
+
+    def send_event(self, event: dict):
+        self.send_chunk(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+
+    # Stream the content as server-sent events, about four characters (one token) per event
+    def send_stream(self, content: str, usage: dict, request: dict):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for i in range(0, len(content), 4):
+            self.send_event({'choices': [{'index': 0, 'delta': {'content': content[i:i + 4]}, 'finish_reason': None}]})
+            time.sleep(1 / tokens_per_second)
+        self.send_event({'choices': [{'index': 0, 'delta': {}, 'finish_reason': 'stop'}]})
+        if (request.get('stream_options') or {}).get('include_usage'):
+            self.send_event({'choices': [], 'usage': usage})
+        self.send_chunk(b'data: [DONE]\n\n')
+        self.send_chunk(b'')
+
+    def log_message(self, format, *args):
+        pass
+
+
+# The default listen backlog of 5 drops connections when many game sessions call at once
+class MockLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+# Start a mock endpoint on a background thread.  Returns the server; its URL is http://host:server_port/chat/completions
+def start_mock_server(port: int = 0, host: str = '127.0.0.1') -> ThreadingHTTPServer:
+    server = MockLLMServer((host, port), MockLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    global latency
+    global tokens_per_second
+    global response_words
+    global throttle_rate
+    global retry_after
+
+    parser = argparse.ArgumentParser(description="Mock chat completions endpoint")
+    parser.add_argument('--host', type=str, default='127.0.0.1',
+                        help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on.')
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY,
+                        help='Seconds to wait before responding, simulating time to first token.')
+    parser.add_argument('--tokens_per_second', type=float, default=DEFAULT_TOKENS_PER_SECOND,
+                        help='Simulated generation speed.')
+    parser.add_argument('--response_words', type=int, default=DEFAULT_RESPONSE_WORDS,
+                        help='Length of generated narration.')
+    parser.add_argument('--throttle_rate', type=float, default=DEFAULT_THROTTLE_RATE,
+                        help='Fraction of requests to reject with 429 Too Many Requests.')
+    parser.add_argument('--retry_after', type=float, default=DEFAULT_RETRY_AFTER,
+                        help='Retry-After seconds sent with throttled responses.')
+    args = parser.parse_args()
+
+    latency = args.latency
+    tokens_per_second = args.tokens_per_second
+    response_words = args.response_words
+    throttle_rate = args.throttle_rate
+    retry_after = args.retry_after
+
+    server = MockLLMServer((args.host, args.port), MockLLMHandler)
+    print(f'Mock LLM endpoint listening on http://{args.host}:{server.server_port}/chat/completions')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,248 @@
+import io
+import os
+import json
+import time
+import argparse
+import datetime
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import requests
+import adventure
+import mock_llm
+
+# Batch self-play.  Plays every scenario/player pair (optionally several games each) for a fixed number of turns,
+# with the games spread over a pool of worker processes.  Each game's transcript is written in save file format,
+# so it can be inspected or resumed with --load_game, and the run reports throughput, failure rate and token spend.
+#   python self_play.py --turns 20 --games 3 --output_dir transcripts               (against a local mock endpoint)
+#   python self_play.py --endpoint <url> --api_key <key> --turns 20 --workers 8     (against a real endpoint)
+
+ADVENTURE_DIR = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ['scenario.txt', 'dungeon.txt']
+PLAYERS = ['wizard.txt', 'cleric.txt', 'rogue.txt', 'paladin.txt']
+DEFAULT_TURNS = 20
+DEFAULT_OUTPUT_DIR = 'transcripts'
+
+
+# Runs in each worker process before its first game
+def configure_worker(config: dict):
+    adventure.endpoint = config['endpoint']
+    adventure.api_key = config['api_key']
+    adventure.routes = config['routes']
+    adventure.stream_mode = False
+    adventure.pipeline_mode = config['pipeline']
+    adventure.state_update_mode = config['state_updates']
+    adventure.parse_cache_dir = config['parse_cache_dir']
+    adventure.parse_cache_enabled = config['parse_cache_enabled']
+    adventure.max_retries = config['max_retries']
+    # Each worker gets an equal share of the quota (0 still means no limit)
+    rpm = config['rate_limit_rpm'] and max(1, config['rate_limit_rpm'] // config['workers'])
+    tpm = config['rate_limit_tpm'] and max(1, config['rate_limit_tpm'] // config['workers'])
+    adventure.configure_rate_limiter(rpm, tpm)
+
+
+def transcript_filename(output_dir: str, job: dict) -> str:
+    scenario = os.path.splitext(os.path.basename(job['scenario']))[0]
+    player = os.path.splitext(os.path.basename(job['player']))[0]
+    return os.path.join(output_dir, f"{scenario}_{player}_{job['game']}.sav")
+
+
+# Play one self-play game and return its results.  A turn that fails is retried with the same command on the
+# next turn, the way the interactive game does it, until adventure.SELF_PLAY_TURN_RETRIES is used up.
+def play_game(job: dict) -> dict:
+    adventure.seed_dice(job['seed'])
+    adventure.call_log = []
+    session = adventure.GameSession()
+    result = {
+        'scenario': job['scenario'],
+        'player': job['player'],
+        'game': job['game'],
+        'seed': job['seed'],
+        'turns': 0,
+        'failed_turns': 0,
+        'error': None,
+        'transcript': None
+    }
+
+    start = time.perf_counter()
+    # The game's own output is not interesting here
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            adventure.read_player_file(session, os.path.join(ADVENTURE_DIR, job['player']))
+            adventure.read_scenario_file(session, os.path.join(ADVENTURE_DIR, job['scenario']))
+            last_response = adventure.turn(session, 'begin the game', False)
+
+            self_play_context = []
+            failed_command = None
+            failures = 0
+            while result['turns'] < job['turns'] and not session.finished:
+                if failed_command:
+                    command = failed_command
+                else:
+                    command = adventure.make_self_play_request(adventure.self_play_prompt, last_response, self_play_context)
+                    self_play_context.append((last_response, command))
+                result['turns'] += 1
+                try:
+                    last_response = adventure.turn(session, command, False)
+                    failed_command = None
+                    failures = 0
+                except (requests.RequestException, KeyError, ValueError):
+                    result['failed_turns'] += 1
+                    failures += 1
+                    failed_command = command if adventure.retry_self_play_command(failures) else None
+                    if not failed_command:
+                        failures = 0
+            adventure.finish_state_update(session, False)
+        except (requests.RequestException, KeyError, ValueError) as e:
+            result['error'] = f'{type(e).__name__}: {e}'
+
+    if session.player:
+        result['transcript'] = adventure.save_game(session.player, session.game_state, session.context, session.context_summary,
+                                                   transcript_filename(job['output_dir'], job), session.world)
+    result['seconds'] = time.perf_counter() - start
+    calls = adventure.call_log
+    adventure.call_log = None
+    result['llm_calls'] = len(calls)
+    result['prompt_tokens'] = sum(call['prompt_tokens'] for call in calls)
+    result['completion_tokens'] = sum(call['completion_tokens'] for call in calls)
+    result['cached_tokens'] = sum(call['cached_tokens'] for call in calls)
+    return result
+
+
+def summarize_games(games: list, seconds: float) -> dict:
+    turns = sum(game['turns'] for game in games)
+    failed_turns = sum(game['failed_turns'] for game in games)
+    prompt_tokens = sum(game['prompt_tokens'] for game in games)
+    completion_tokens = sum(game['completion_tokens'] for game in games)
+    return {
+        'games': len(games),
+        'failed_games': len([game for game in games if game['error']]),
+        'turns': turns,
+        'failed_turns': failed_turns,
+        'turn_failure_rate': failed_turns / turns if turns else None,
+        'turns_per_minute': turns * 60 / seconds if seconds else None,
+        'prompt_tokens': prompt_tokens,
+        'completion_tokens': completion_tokens,
+        'cached_tokens': sum(game['cached_tokens'] for game in games),
+        'tokens_per_game': (prompt_tokens + completion_tokens) / len(games) if games else None
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batch self-play")
+    parser.add_argument('--endpoint', type=str, required=False,
+                        help='URI to OAI or AOAI gpt4o endpoint.  If omitted a local mock endpoint is used.')
+    parser.add_argument('--api_key', type=str, default='',
+                        help='API Key for (A)OAI endpoint.')
+    parser.add_argument('--routes', type=str, required=False,
+                        help='JSON routing table giving each type of LLM call its own endpoints, model, max_tokens and temperature.')
+    parser.add_argument('--scenarios', type=str, nargs='+', default=SCENARIOS,
+                        help='Scenario files to play.')
+    parser.add_argument('--players', type=str, nargs='+', default=PLAYERS,
+                        help='Player files to play each scenario with.')
+    parser.add_argument('--games', type=int, default=1,
+                        help='Number of games to play for each scenario/player pair.')
+    parser.add_argument('--turns', type=int, default=DEFAULT_TURNS,
+                        help='Number of self-play turns per game.')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Seed for the dice.  Each game is seeded with this plus its position in the batch.')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='Number of worker processes.')
+    parser.add_argument('--pipeline', type=bool, default=False, nargs='?', const=True,
+                        help='Play with pipelined state updates.')
+    parser.add_argument('--state_updates', type=str, choices=['delta', 'full', 'merged'], default='delta',
+                        help='How the game state is updated each turn.')
+    parser.add_argument('--rate_limit_rpm', type=int, default=adventure.DEFAULT_RATE_LIMIT_RPM,
+                        help='Requests per minute allowed by the endpoint quota, split between the workers (0 for no limit).')
+    parser.add_argument('--rate_limit_tpm', type=int, default=adventure.DEFAULT_RATE_LIMIT_TPM,
+                        help='Tokens per minute allowed by the endpoint quota, split between the workers (0 for no limit).')
+    parser.add_argument('--max_retries', type=int, default=adventure.DEFAULT_MAX_RETRIES,
+                        help='Times to retry an LLM call that was throttled or failed.')
+    parser.add_argument('--parse_cache_dir', type=str, default=adventure.DEFAULT_PARSE_CACHE_DIR,
+                        help='Directory for caching parsed player and scenario files.')
+    parser.add_argument('--no_parse_cache', type=bool, default=False, nargs='?', const=True,
+                        help='Always parse the player and scenario files with the LLM.')
+    parser.add_argument('--mock_latency', type=float, default=mock_llm.DEFAULT_LATENCY,
+                        help='Latency of the mock endpoint.')
+    parser.add_argument('--mock_tokens_per_second', type=float, default=mock_llm.DEFAULT_TOKENS_PER_SECOND,
+                        help='Generation speed of the mock endpoint.')
+    parser.add_argument('--output_dir', type=str, default=DEFAULT_OUTPUT_DIR,
+                        help='Directory to write the game transcripts to.')
+    parser.add_argument('--output', type=str, required=False,
+                        help='File to write the results to (default: standard output).')
+    args = parser.parse_args()
+
+    endpoint = args.endpoint
+    if not endpoint:
+        mock_llm.latency = args.mock_latency
+        mock_llm.tokens_per_second = args.mock_tokens_per_second
+        server = mock_llm.start_mock_server()
+        endpoint = f'http://127.0.0.1:{server.server_port}/chat/completions'
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    jobs = []
+    for scenario in args.scenarios:
+        for player in args.players:
+            for game in range(1, args.games + 1):
+                jobs.append({
+                    'scenario': scenario,
+                    'player': player,
+                    'game': game,
+                    'seed': args.seed + len(jobs),
+                    'turns': args.turns,
+                    'output_dir': args.output_dir
+                })
+    workers = max(1, min(args.workers, len(jobs)))
+    config = {
+        'endpoint': endpoint,
+        'api_key': args.api_key,
+        'routes': adventure.load_routes(args.routes) if args.routes else {},
+        'pipeline': args.pipeline,
+        'state_updates': args.state_updates,
+        'parse_cache_dir': args.parse_cache_dir,
+        'parse_cache_enabled': not args.no_parse_cache,
+        'max_retries': args.max_retries,
+        'rate_limit_rpm': args.rate_limit_rpm,
+        'rate_limit_tpm': args.rate_limit_tpm,
+        'workers': workers
+    }
+
+    print(f'Playing {len(jobs)} games on {workers} workers...', flush=True)
+    start = time.perf_counter()
+    games = []
+    with ProcessPoolExecutor(max_workers=workers, initializer=configure_worker, initargs=(config,)) as executor:
+        futures = [executor.submit(play_game, job) for job in jobs]
+        for future in as_completed(futures):
+            game = future.result()
+            games.append(game)
+            status = game['error'] or f"{game['turns']} turns, {game['failed_turns']} failed"
+            print(f"{game['scenario']} with {game['player']} (game {game['game']}): {status}", flush=True)
+    seconds = time.perf_counter() - start
+
+    games.sort(key=lambda game: (game['scenario'], game['player'], game['game']))
+    results = {
+        'benchmark': 'batch_self_play',
+        'timestamp': datetime.datetime.now().isoformat(),
+        'config': {
+            'endpoint': args.endpoint or 'mock',
+            'routes': args.routes,
+            'games_per_pair': args.games,
+            'turns': args.turns,
+            'seed': args.seed,
+            'workers': workers,
+            'pipeline': args.pipeline,
+            'state_updates': args.state_updates
+        },
+        'total_seconds': seconds,
+        'summary': summarize_games(games, seconds),
+        'games': games
+    }
+
+    output = json.dumps(results, indent=4)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+
+if __name__=="__main__":
+    main()
@@ -0,0 +1,464 @@
+import os
+import re
+import json
+import time
+import uuid
+import asyncio
+import argparse
+import collections
+import aiohttp
+from aiohttp import web
+import adventure
+import async_engine
+import tracing
+
+# Multi-session game server.  Each game is a GameSession played by the asyncio engine, so one process can host
+# many players at once while their turns wait on the LLM endpoint.
+#   python server.py --endpoint <url> --api_key <key> --port 8080
+#
+#   POST   /sessions              {"scenario": "scenario.txt", "player": "wizard.txt"} or {"pack": "dungeon.pack", "pack_player": "wizard"}
+#                                 Starts a game.  Returns {"session_id", "response"} with the opening narration.
+#   POST   /sessions/{id}/turn    {"command": "look around"}.  Returns {"response", "finished"}.
+#   GET    /sessions/{id}         Player, location and number of turns played.
+#   DELETE /sessions/{id}         Ends the game without saving it.
+#   GET    /sessions/{id}/ws      WebSocket.  Send {"command": ...}; the narration streams back as {"type": "text", "text": ...}
+#                                 messages followed by {"type": "response", "response": ..., "finished": ...}.
+#   GET    /metrics               Session store statistics and, with --metrics, the metrics registry.
+#
+# Scenario, player and pack files are looked up by name in the content directory.  Clients cannot save, load
+# or quit through files on the server, or turn on debug output (see async_engine.server_mode).
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8080
+DEFAULT_CONTENT_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SESSION_MEMORY_MB = 256
+DEFAULT_IDLE_SECONDS = 900
+DEFAULT_SPILL_DIR = os.path.join(os.path.expanduser('~'), '.lldm', 'sessions')
+
+content_dir = DEFAULT_CONTENT_DIR
+
+# Session store.  Resident sessions are kept in memory in least recently used order.  Sessions left idle for
+# idle_seconds, and the least recently used ones whenever the resident sessions grow past the memory ceiling,
+# are spilled to disk in save file format and rehydrated through load_game on their next request.  Spilled
+# sessions also survive a restart of the server.
+session_memory_bytes = DEFAULT_SESSION_MEMORY_MB * 1024 * 1024
+idle_seconds = DEFAULT_IDLE_SECONDS
+spill_dir = DEFAULT_SPILL_DIR
+
+# Resident sessions by id, least recently used first.  Each entry holds the session, a lock that keeps its turns
+# in order, the number of requests using it, when it was last used and its approximate size in memory.
+sessions = collections.OrderedDict()
+spilled_sessions = set()
+store_stats = {
+    'spills': 0,
+    'rehydrations': 0,
+    'rehydration_seconds': 0.0,
+    'max_rehydration_seconds': 0.0
+}
+SESSION_ID_PATTERN = re.compile('[0-9a-f]{32}')
+
+
+def json_error(error_class, message: str):
+    return error_class(text=json.dumps({'error': message}), content_type='application/json')
+
+
+# Resolve a file name in the content directory.  Paths are not accepted, so clients cannot read other files.
+def content_path(name) -> str:
+    if not isinstance(name, str) or not name or os.path.basename(name) != name:
+        raise json_error(web.HTTPBadRequest, f'Invalid file name: {name}')
+    path = os.path.join(content_dir, name)
+    if not os.path.isfile(path):
+        raise json_error(web.HTTPNotFound, f'{name} not found')
+    return path
+
+
+def read_content(name) -> str:
+    with open(content_path(name), 'r') as f:
+        return f.read()
+
+
+async def read_json(request: web.Request) -> dict:
+    try:
+        body = await request.json()
+    except ValueError:
+        raise json_error(web.HTTPBadRequest, 'Request body must be JSON')
+    if not isinstance(body, dict):
+        raise json_error(web.HTTPBadRequest, 'Request body must be a JSON object')
+    return body
+
+
+def spill_path(session_id: str) -> str:
+    return os.path.join(spill_dir, session_id + '.sav')
+
+
+# Approximate memory held by a session, measured by the size of the data it would save
+def session_bytes(session: adventure.GameSession) -> int:
+    return (len(adventure.compact_json(session.player)) + len(adventure.compact_json(session.game_state)) +
+            sum(len(entry[0]) + len(entry[1]) for entry in session.context) + len(session.context_summary['summary']) +
+            sum(len(entity) for entities in session.world.values() for kind in entities.values() for entity in kind.values()))
+
+
+def add_session(session: adventure.GameSession) -> dict:
+    entry = {
+        'session': session,
+        'lock': asyncio.Lock(),
+        'active': 0,
+        'last_active': time.time(),
+        'bytes': session_bytes(session)
+    }
+    sessions[session.session_id] = entry
+    enforce_memory_ceiling()
+    return entry
+
+
+# Look up a session by id, rehydrating it from disk if it was spilled
+def get_entry(session_id: str) -> dict:
+    entry = sessions.get(session_id)
+    if entry:
+        sessions.move_to_end(session_id)
+        return entry
+    if session_id not in spilled_sessions:
+        raise json_error(web.HTTPNotFound, 'No such session')
+
+    with tracing.span('session_rehydrate', session_id=session_id):
+        start = time.perf_counter()
+        session = adventure.GameSession(session_id)
+        try:
+            adventure.load_game(session, spill_path(session_id))
+        except (OSError, ValueError, KeyError) as e:
+            raise json_error(web.HTTPInternalServerError, f'Could not restore the session: {e}')
+        os.remove(spill_path(session_id))
+        spilled_sessions.discard(session_id)
+        elapsed = time.perf_counter() - start
+    store_stats['rehydrations'] += 1
+    store_stats['rehydration_seconds'] += elapsed
+    store_stats['max_rehydration_seconds'] = max(store_stats['max_rehydration_seconds'], elapsed)
+    tracing.observe('session_rehydrate.seconds', elapsed)
+    return add_session(session)
+
+
+# Write a resident session to disk and drop it from memory.  Sessions in the middle of a turn are skipped, as
+# are sessions whose background state update is still running or failed (the next turn retries it).
+def spill_session(entry: dict) -> bool:
+    session = entry['session']
+    if entry['active']:
+        return False
+    pending = session.pending_state_update
+    if pending:
+        if not pending['task'].done() or pending['task'].cancelled() or pending['task'].exception():
+            return False
+        session.game_state = pending['task'].result()
+        session.pending_state_update = None
+
+    os.makedirs(spill_dir, exist_ok=True)
+    adventure.save_session(session, spill_path(session.session_id))
+    adventure.close_journal(session)
+    del sessions[session.session_id]
+    spilled_sessions.add(session.session_id)
+    store_stats['spills'] += 1
+    return True
+
+
+# Spill the least recently used sessions until the resident ones fit in the memory ceiling.  The session used
+# most recently always stays resident.
+def enforce_memory_ceiling():
+    resident_bytes = sum(entry['bytes'] for entry in sessions.values())
+    for entry in list(sessions.values())[:-1]:
+        if resident_bytes <= session_memory_bytes:
+            break
+        if spill_session(entry):
+            resident_bytes -= entry['bytes']
+
+
+def spill_idle_sessions():
+    cutoff = time.time() - idle_seconds
+    for entry in list(sessions.values()):
+        if entry['last_active'] <= cutoff:
+            spill_session(entry)
+
+
+async def spill_idle_sessions_periodically():
+    while True:
+        await asyncio.sleep(max(1, idle_seconds / 4))
+        spill_idle_sessions()
+
+
+def get_request_entry(request: web.Request) -> dict:
+    session_id = request.match_info['session_id']
+    if not SESSION_ID_PATTERN.fullmatch(session_id):
+        raise json_error(web.HTTPNotFound, 'No such session')
+    return get_entry(session_id)
+
+
+def read_command(body: dict) -> str:
+    command = body.get('command')
+    if not isinstance(command, str) or not command.strip():
+        raise json_error(web.HTTPBadRequest, 'command is required')
+    return command
+
+
+# Play a turn in a session, one turn at a time per session
+async def play_turn(entry: dict, command: str, on_text=None) -> str:
+    session = entry['session']
+    entry['active'] += 1
+    try:
+        async with entry['lock']:
+            try:
+                response = await async_engine.turn(session, command, on_text)
+            except async_engine.REQUEST_ERRORS as e:
+                raise json_error(web.HTTPBadGateway, f'Turn failed: {e}')
+    finally:
+        entry['active'] -= 1
+        entry['last_active'] = time.time()
+    if session.finished:
+        sessions.pop(session.session_id, None)
+        adventure.close_journal(session)
+        return response
+    entry['bytes'] = session_bytes(session)
+    enforce_memory_ceiling()
+    return response
+
+
+async def create_session(request: web.Request) -> web.Response:
+    body = await read_json(request)
+    session = adventure.GameSession(uuid.uuid4().hex)
+    try:
+        if body.get('pack'):
+            response = adventure.start_from_pack(session, content_path(body['pack']), body.get('pack_player'))
+        else:
+            scenario_text = read_content(body.get('scenario'))
+            player_text = read_content(body.get('player'))
+            response = await async_engine.start_game(session, scenario_text, player_text)
+    except async_engine.REQUEST_ERRORS as e:
+        raise json_error(web.HTTPBadGateway, f'Could not start the game: {e}')
+    add_session(session)
+    return web.json_response({'session_id': session.session_id, 'response': response})
+
+
+async def session_turn(request: web.Request) -> web.Response:
+    command = read_command(await read_json(request))
+    entry = get_request_entry(request)
+    response = await play_turn(entry, command)
+    return web.json_response({'response': response, 'finished': entry['session'].finished})
+
+
+async def session_info(request: web.Request) -> web.Response:
+    session = get_request_entry(request)['session']
+    return web.json_response({
+        'session_id': session.session_id,
+        'player': session.player.get('Name'),
+        'location': session.game_state.get('location'),
+        'turns': len([entry for entry in session.context if entry[0] not in adventure.PINNED_CONTEXT_ENTRIES])
+    })
+
+
+async def delete_session(request: web.Request) -> web.Response:
+    session_id = request.match_info['session_id']
+    if session_id in sessions:
+        adventure.close_journal(sessions.pop(session_id)['session'])
+    elif session_id in spilled_sessions:
+        os.remove(spill_path(session_id))
+        spilled_sessions.discard(session_id)
+    else:
+        raise json_error(web.HTTPNotFound, 'No such session')
+    return web.json_response({'deleted': session_id})
+
+
+async def session_websocket(request: web.Request) -> web.WebSocketResponse:
+    session_id = request.match_info['session_id']
+    get_request_entry(request)
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+
+    async def send_text(text: str):
+        await ws.send_json({'type': 'text', 'text': text})
+
+    async for message in ws:
+        if message.type != aiohttp.WSMsgType.TEXT:
+            continue
+        try:
+            command = read_command(json.loads(message.data))
+            # Look the session up for every command; it may have been spilled while the player was idle
+            entry = get_entry(session_id)
+            response = await play_turn(entry, command, send_text)
+        except (ValueError, AttributeError):
+            await ws.send_json({'type': 'error', 'error': 'Expected {"command": ...}'})
+            continue
+        except web.HTTPException as e:
+            await ws.send_json({'type': 'error', 'error': json.loads(e.text)['error']})
+            continue
+        await ws.send_json({'type': 'response', 'response': response, 'finished': entry['session'].finished})
+        if entry['session'].finished:
+            break
+    await ws.close()
+    return ws
+
+
+async def metrics(request: web.Request) -> web.Response:
+    rehydrations = store_stats['rehydrations']
+    return web.json_response({
+        'session_store': {
+            'resident': len(sessions),
+            'spilled': len(spilled_sessions),
+            'resident_bytes': sum(entry['bytes'] for entry in sessions.values()),
+            'memory_ceiling_bytes': session_memory_bytes,
+            'spills': store_stats['spills'],
+            'rehydrations': rehydrations,
+            'mean_rehydration_seconds': store_stats['rehydration_seconds'] / rehydrations if rehydrations else None,
+            'max_rehydration_seconds': store_stats['max_rehydration_seconds']
+        },
+        'rate_limiting': adventure.rate_limit_stats,
+        'fast_path': adventure.fast_path_summary(),
+        'structured_outputs': adventure.structured_output_stats,
+        'counters': tracing.metrics['counters'],
+        'histograms': tracing.metrics['histograms']
+    })
+
+
+# Pick up sessions spilled by a previous run and start the idle sweep
+async def start_session_store(app: web.Application):
+    if os.path.isdir(spill_dir):
+        for name in os.listdir(spill_dir):
+            session_id = name[:-len('.sav')]
+            if name.endswith('.sav') and SESSION_ID_PATTERN.fullmatch(session_id):
+                spilled_sessions.add(session_id)
+    app['idle_sweep'] = asyncio.create_task(spill_idle_sessions_periodically())
+
+
+# Spill every resident session on shutdown so that games carry on after a restart
+async def stop_session_store(app: web.Application):
+    app['idle_sweep'].cancel()
+    for entry in list(sessions.values()):
+        await async_engine.finish_state_update(entry['session'])
+        spill_session(entry)
+
+
+async def close_http_client(app: web.Application):
+    await async_engine.close_http_client()
+
+
+def make_app() -> web.Application:
+    # Every app built here serves remote clients, however it is run
+    async_engine.server_mode = True
+    app = web.Application()
+    app.add_routes([
+        web.post('/sessions', create_session),
+        web.post('/sessions/{session_id}/turn', session_turn),
+        web.get('/sessions/{session_id}', session_info),
+        web.delete('/sessions/{session_id}', delete_session),
+        web.get('/sessions/{session_id}/ws', session_websocket),
+        web.get('/metrics', metrics)
+    ])
+    app.on_startup.append(start_session_store)
+    app.on_cleanup.append(stop_session_store)
+    app.on_cleanup.append(close_http_client)
+    return app
+
+
+def main():
+    global content_dir
+    global session_memory_bytes
+    global idle_seconds
+    global spill_dir
+
+    parser = argparse.ArgumentParser(description="Multi-session game server")
+    parser.add_argument('--host', type=str, default=DEFAULT_HOST,
+                        help='Address to listen on.')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT,
+                        help='Port to listen on.')
+    parser.add_argument('--endpoint', type=str, default=adventure.DEFAULT_ENDPOINT,
+                        help='URI to OAI or AOAI gpt4o endpoint.')
+    parser.add_argument('--api_key', type=str, required=False,
+                        help='API Key for (A)OAI endpoint (if not using keyvault)')
+    parser.add_argument('--routes', type=str, required=False,
+                        help='JSON routing table giving each type of LLM call its own endpoints, model, max_tokens and temperature.')
+    parser.add_argument('--key_vault', type=str, default=adventure.DEFAULT_KEY_VAULT,
+                        help='Name of the key vault to use to lookup the API Key')
+    parser.add_argument('--secret_name', type=str, default=adventure.DEFAULT_SN,
+                        help='Name of the secret in the key vault containing the API Key')
+    parser.add_argument('--key_cache_hours', type=float, default=adventure.DEFAULT_KEY_CACHE_HOURS,
+                        help='Hours to cache the API Key from the key vault on disk (0 to always fetch it).')
+    parser.add_argument('--content_dir', type=str, default=DEFAULT_CONTENT_DIR,
+                        help='Directory holding the scenario, player and pack files clients may start games from.')
+    parser.add_argument('--session_memory_mb', type=int, default=DEFAULT_SESSION_MEMORY_MB,
+                        help='Approximate memory the resident sessions may use before the least recently used are spilled to disk.')
+    parser.add_argument('--idle_seconds', type=float, default=DEFAULT_IDLE_SECONDS,
+                        help='Spill sessions to disk after this many seconds without a request.')
+    parser.add_argument('--spill_dir', type=str, default=DEFAULT_SPILL_DIR,
+                        help='Directory for spilled sessions.')
+    parser.add_argument('--pipeline', type=bool, default=False, nargs='?',
+                        const=True, help='Reply with the narration before the state update finishes (default: False).')
+    parser.add_argument('--state_updates', type=str, choices=['delta', 'full', 'merged'], default='delta',
+                        help='Update the game state each turn from a delta (default), by regenerating the full state, or from a delta returned with the narration.')
+    parser.add_argument('--state_resync_turns', type=int, default=adventure.DEFAULT_STATE_RESYNC_TURNS,
+                        help='In delta mode, regenerate the full game state every this many turns (0 to never resync).')
+    parser.add_argument('--context_budget', type=int, default=adventure.DEFAULT_CONTEXT_BUDGET,
+                        help='Approximate token budget for the conversation context sent with each request (0 disables compaction).')
+    parser.add_argument('--context_recent_turns', type=int, default=adventure.DEFAULT_CONTEXT_RECENT_TURNS,
+                        help='Number of most recent turns always sent verbatim rather than summarized.')
+    parser.add_argument('--context_recall_turns', type=int, default=adventure.DEFAULT_CONTEXT_RECALL_TURNS,
+                        help='Number of summarized turns relevant to the command to send verbatim with each request.')
+    parser.add_argument('--pool_size', type=int, default=async_engine.DEFAULT_POOL_SIZE,
+                        help='Maximum number of connections to keep open to the endpoint.')
+    parser.add_argument('--connect_timeout', type=float, default=adventure.DEFAULT_CONNECT_TIMEOUT,
+                        help='Seconds to wait when connecting to the endpoint.')
+    parser.add_argument('--read_timeout', type=float, default=adventure.DEFAULT_READ_TIMEOUT,
+                        help='Seconds to wait for the endpoint to respond.')
+    parser.add_argument('--rate_limit_rpm', type=int, default=adventure.DEFAULT_RATE_LIMIT_RPM,
+                        help='Requests per minute allowed by the endpoint quota, shared by all sessions (0 for no limit).')
+    parser.add_argument('--rate_limit_tpm', type=int, default=adventure.DEFAULT_RATE_LIMIT_TPM,
+                        help='Tokens per minute allowed by the endpoint quota, shared by all sessions (0 for no limit).')
+    parser.add_argument('--max_retries', type=int, default=adventure.DEFAULT_MAX_RETRIES,
+                        help='Times to retry an LLM call that was throttled or failed.')
+    parser.add_argument('--parse_cache_dir', type=str, default=adventure.DEFAULT_PARSE_CACHE_DIR,
+                        help='Directory for caching parsed player and scenario files.')
+    parser.add_argument('--no_parse_cache', type=bool, default=False, nargs='?',
+                        const=True, help='Always parse the player and scenario files with the LLM (default: False).')
+    parser.add_argument('--no_fast_path', type=bool, default=False, nargs='?',
+                        const=True, help='Resolve every command with the LLM, including routine ones (default: False).')
+    parser.add_argument('--trace_file', type=str, required=False,
+                        help='Append a JSONL trace of every turn phase and LLM request to this file.')
+    parser.add_argument('--metrics', type=bool, default=False, nargs='?',
+                        const=True, help='Collect latency and token metrics, served at /metrics (default: False).')
+    args = parser.parse_args()
+
+    if args.api_key:
+        adventure.api_key = args.api_key
+    else:
+        if not args.key_vault or not args.secret_name:
+            parser.error("Must specify either --api_key or both --key_vault and --secret_name")
+        adventure.key_cache_hours = args.key_cache_hours
+        adventure.api_key = adventure.key_vault_api_key(args.key_vault, args.secret_name)
+    adventure.endpoint = args.endpoint
+    if args.routes:
+        try:
+            adventure.routes = adventure.load_routes(args.routes)
+        except (OSError, ValueError) as e:
+            parser.error(f'Could not load the routing table: {e}')
+    adventure.pipeline_mode = args.pipeline
+    adventure.state_update_mode = args.state_updates
+    adventure.state_resync_turns = args.state_resync_turns
+    adventure.context_budget = args.context_budget
+    adventure.context_recent_turns = args.context_recent_turns
+    adventure.context_recall_turns = args.context_recall_turns
+    adventure.parse_cache_dir = args.parse_cache_dir
+    adventure.configure_rate_limiter(args.rate_limit_rpm, args.rate_limit_tpm)
+    adventure.max_retries = args.max_retries
+    adventure.parse_cache_enabled = not args.no_parse_cache
+    adventure.fast_path_enabled = not args.no_fast_path
+    async_engine.pool_size = args.pool_size
+    async_engine.connect_timeout = args.connect_timeout
+    async_engine.read_timeout = args.read_timeout
+    content_dir = args.content_dir
+    session_memory_bytes = args.session_memory_mb * 1024 * 1024
+    idle_seconds = args.idle_seconds
+    spill_dir = args.spill_dir
+    if args.trace_file:
+        tracing.add_sink(tracing.jsonl_sink(args.trace_file))
+    if args.metrics:
+        tracing.add_sink(tracing.metrics_sink)
+
+    web.run_app(make_app(), host=args.host, port=args.port)
+
+if __name__=="__main__":
+    main()
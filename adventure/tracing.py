@@ -0,0 +1,179 @@
+import json
+import time
+import uuid
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+# Lightweight tracing and metrics for the game engine.
+# Code is instrumented with spans:
+#   with tracing.span('turn', command=command) as current:
+#       ...
+#       current['attributes']['outcome'] = 'ok'
+# Finished spans are handed to every registered sink.  Two sinks are provided: a JSONL trace file
+# (jsonl_sink) and an in-process metrics registry with counters and histograms (metrics_sink).
+# When no sinks are registered, spans cost next to nothing.
+
+sinks = []
+
+# The span currently open in this thread or task; new spans become its children
+current_span = contextvars.ContextVar('current_span', default=None)
+
+# Histogram bucket upper bounds
+SECONDS_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0]
+SIZE_BUCKETS = [100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000, 250000]
+
+metrics = {
+    'counters': {},
+    'histograms': {}
+}
+metrics_lock = threading.Lock()
+
+
+def add_sink(sink):
+    sinks.append(sink)
+
+
+def remove_sink(sink):
+    sinks.remove(sink)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    if not sinks:
+        yield {'name': name, 'attributes': attributes}
+        return
+
+    parent = current_span.get()
+    new_span = {
+        'name': name,
+        'trace_id': parent['trace_id'] if parent else uuid.uuid4().hex,
+        'span_id': uuid.uuid4().hex[:16],
+        'parent_id': parent['span_id'] if parent else None,
+        'start': time.time(),
+        'duration_seconds': None,
+        'status': 'ok',
+        'attributes': attributes
+    }
+    token = current_span.set(new_span)
+    start = time.perf_counter()
+    try:
+        yield new_span
+    except BaseException as e:
+        new_span['status'] = 'error'
+        new_span['attributes']['error'] = f'{type(e).__name__}: {e}'
+        raise
+    finally:
+        new_span['duration_seconds'] = time.perf_counter() - start
+        current_span.reset(token)
+        for sink in list(sinks):
+            sink(new_span)
+
+
+# Decorator that runs the whole function in a span
+def traced(name: str):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+# Add attributes to the innermost open span, if any
+def set_attributes(**attributes):
+    open_span = current_span.get()
+    if open_span:
+        open_span['attributes'].update(attributes)
+
+
+# Return a sink that appends each finished span as one JSON line to a file
+def jsonl_sink(filename: str):
+    lock = threading.Lock()
+    trace_file = open(filename, 'a', encoding='utf-8')
+
+    def write_span(finished_span: dict):
+        line = json.dumps(finished_span, default=str) + '\n'
+        with lock:
+            trace_file.write(line)
+            trace_file.flush()
+    return write_span
+
+
+def increment(name: str, value: int = 1):
+    with metrics_lock:
+        metrics['counters'][name] = metrics['counters'].get(name, 0) + value
+
+
+def observe(name: str, value: float, buckets: list = SECONDS_BUCKETS):
+    with metrics_lock:
+        histogram = metrics['histograms'].get(name)
+        if not histogram:
+            histogram = {
+                'count': 0,
+                'sum': 0,
+                'min': None,
+                'max': None,
+                'buckets': buckets,
+                'bucket_counts': [0] * (len(buckets) + 1)
+            }
+            metrics['histograms'][name] = histogram
+        histogram['count'] += 1
+        histogram['sum'] += value
+        histogram['min'] = value if histogram['min'] is None else min(histogram['min'], value)
+        histogram['max'] = value if histogram['max'] is None else max(histogram['max'], value)
+        for i, bound in enumerate(histogram['buckets']):
+            if value <= bound:
+                histogram['bucket_counts'][i] += 1
+                break
+        else:
+            histogram['bucket_counts'][-1] += 1
+
+
+# Estimate a percentile from a histogram's buckets
+def histogram_percentile(histogram: dict, p: float) -> float:
+    if not histogram['count']:
+        return None
+    target = histogram['count'] * p / 100
+    seen = 0
+    for i, count in enumerate(histogram['bucket_counts']):
+        seen += count
+        if seen >= target:
+            return histogram['buckets'][i] if i < len(histogram['buckets']) else histogram['max']
+    return histogram['max']
+
+
+# Sink that feeds the metrics registry.  LLM requests are broken down by call type.
+def metrics_sink(finished_span: dict):
+    name = finished_span['name']
+    attributes = finished_span['attributes']
+    if name == 'llm_request' and attributes.get('call_type'):
+        name = f"llm_request.{attributes['call_type']}"
+    increment(f'{name}.count')
+    if finished_span['status'] == 'error':
+        increment(f'{name}.errors')
+    observe(f'{name}.seconds', finished_span['duration_seconds'])
+    for attribute in ['prompt_tokens', 'completion_tokens', 'cached_tokens', 'retries']:
+        if attributes.get(attribute):
+            increment(f'{name}.{attribute}', attributes[attribute])
+    for attribute in ['request_bytes', 'response_bytes']:
+        if attribute in attributes:
+            observe(f'{name}.{attribute}', attributes[attribute], SIZE_BUCKETS)
+    if 'queue_seconds' in attributes:
+        observe(f'{name}.queue_seconds', attributes['queue_seconds'])
+
+
+# Format the metrics registry as a human readable report
+def metrics_report() -> str:
+    lines = []
+    with metrics_lock:
+        for name in sorted(metrics['counters']):
+            lines.append(f"{name}: {metrics['counters'][name]}")
+        for name in sorted(metrics['histograms']):
+            histogram = metrics['histograms'][name]
+            mean = histogram['sum'] / histogram['count']
+            lines.append(f"{name}: count {histogram['count']}, mean {mean:.3f}, p50 <= {histogram_percentile(histogram, 50)}, "
+                         f"p95 <= {histogram_percentile(histogram, 95)}, max {histogram['max']:.3f}")
+    return '\n'.join(lines)